@@ -4,8 +4,11 @@ Purpose: Create QSI Tower Report and Features using PLS-CADD XML
 
 import arcpy
 import csv
+import numpy as np
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 if __name__ == "__main__" and __package__ is None:
     sys.path.append(
@@ -20,17 +23,84 @@ from reload_modules import reload_modules
 reload_modules(root)
 
 
+from utils.bom import (material_tables, summarize_materials,
+                       write_material_summary)
+from utils.catalog import catalog_line
 from utils.messages import add_message, add_warning, add_error
-from utils.plscadd_xml import (xml_to_tower_report, xml_to_spans,
-                               TOWER_REPORT_FIELDS, TOWER_REPORT_FIELD_TYPES)
+from utils.misc import add_indexes, safe_name
+from utils.plscadd_xml import (expand_xml_inputs, root_tables, xml_line,
+                               xml_dir, xml_root, xml_size, xml_stem,
+                               xml_to_tower_report_df,
+                               xml_to_spans, tower_report_path,
+                               write_tower_report, SPAN_INDEXES,
+                               SPATIAL_INDEX, TOWER_REPORT_FIELD_TYPES,
+                               TOWER_REPORT_INDEXES, tower_report_fields)
+from utils.pipeline import prefetch
+from utils.progress import (BackgroundProgress, Cancelled, Progress,
+                            cleanup_outputs)
 from utils.settings import Settings
-
-
-def tower_report_to_shape(tower_report_csv, out_shp=None, out_sr=None):
-    """Creates a shapefile from csv of tower report"""
+from utils.spatial import nearest_neighbour_chain
+from utils.xml_validation import XmlValidationError, check_xml
+
+
+def tower_report_rows(tower_report, fields=None):
+    """Yield (fields, rows) from tower report csv, DataFrame or records
+
+    Args:
+        tower_report: csv path, pandas DataFrame or list of dicts
+        fields (list): fields to return, default report_fields
+    """
+    if fields is None:
+        fields = report_fields(tower_report)
+
+    if isinstance(tower_report, str):
+        with open(tower_report, 'r') as rf:
+            for row in csv.DictReader(rf):
+                yield [row[f] for f in fields] + \
+                      [float(row['X']), float(row['Y'])]
+
+    elif hasattr(tower_report, 'itertuples'):
+        df = tower_report.reindex(columns=fields)
+        df = df.astype(object).where(df.notna(), None)
+        xy = tower_report[['X', 'Y']].to_numpy(dtype=float).tolist()
+        for row, (x, y) in zip(df.itertuples(index=False, name=None), xy):
+            yield list(row) + [x, y]
+
+    else:
+        for row in tower_report:
+            yield [row.get(f) for f in fields] + \
+                  [float(row['X']), float(row['Y'])]
+
+
+def report_fields(tower_report):
+    """Fields of a tower report csv, DataFrame or records, see
+    utils.plscadd_xml.tower_report_fields"""
+    if isinstance(tower_report, str):
+        with open(tower_report, 'r') as rf:
+            columns = next(csv.reader(rf), [])
+    elif hasattr(tower_report, 'columns'):
+        columns = list(tower_report.columns)
+    else:
+        columns = list(tower_report[0]) if tower_report else []
+    return tower_report_fields(columns)
+
+
+def tower_report_to_shape(tower_report, out_shp=None, out_sr=None,
+                          progress=None):
+    """Creates a shapefile from tower report
+
+    Args:
+        tower_report: csv path, or in-memory report as pandas DataFrame
+            (see xml_to_tower_report_df) or list of dicts
+        out_shp: output, required unless tower_report is a csv path
+        out_sr: spatial reference
+        progress: optional utils.progress.Progress for rows written
+    """
 
     if not out_shp:
-        out_shp = os.path.splitext(tower_report_csv)[0] + '.shp'
+        if not isinstance(tower_report, str):
+            raise ValueError('out_shp required for in-memory tower report')
+        out_shp = os.path.splitext(tower_report)[0] + '.shp'
 
     arcpy.CreateFeatureclass_management(out_path=os.path.dirname(out_shp),
                                         out_name=os.path.basename(out_shp),
@@ -39,25 +109,28 @@ def tower_report_to_shape(tower_report_csv, out_shp=None, out_sr=None):
         arcpy.DefineProjection_management(out_shp, out_sr)
 
     # Add fields to output shapefile
-    for field in TOWER_REPORT_FIELDS:
+    fields = report_fields(tower_report)
+    for field in fields:
         arcpy.AddField_management(out_shp, field,
                                   TOWER_REPORT_FIELD_TYPES.get(field, 'TEXT'))
 
+    if progress:
+        progress.stage('structures', 0 if isinstance(tower_report, str)
+                       else len(tower_report))
     with arcpy.da.InsertCursor(
-            out_shp, TOWER_REPORT_FIELDS + ['SHAPE@X', 'SHAPE@Y']) as icurs:
-        with open(tower_report_csv, 'r') as rf:
-            csv_r = csv.DictReader(rf)
-            for cnt, row in enumerate(csv_r):
-                irow = [row[f] for f in TOWER_REPORT_FIELDS] + \
-                       [float(row['X']), float(row['Y'])]
-                icurs.insertRow(irow)
+            out_shp, fields + ['SHAPE@X', 'SHAPE@Y']) as icurs:
+        for irow in tower_report_rows(tower_report, fields):
+            icurs.insertRow(irow)
+            if progress:
+                progress.add_rows()
 
+    add_indexes(out_shp, TOWER_REPORT_INDEXES, SPATIAL_INDEX)
     return out_shp
 
 
 def tower_report_to_span_shp(tower_report_shp, spans, sr=None):
-    """Draw spans using tower report, assumes spans follow tower order"""
-    # Create span feature, assuming structure order
+    """Draw spans using tower report, structure order is rebuilt spatially
+    by a nearest neighbour chain seeded from a dead end"""
     arcpy.CreateFeatureclass_management(
         out_path=os.path.dirname(spans),
         out_name=os.path.basename(spans),
@@ -68,108 +141,238 @@ def tower_report_to_span_shp(tower_report_shp, spans, sr=None):
 
     # Add required fields
     span_fields = ['SN', 'BST', 'BST_TAG', 'BST_ID', 'AST', 'AST_TAG',
-                   'AST_ID', 'SPAN_TAG', 'SPAN_NAME']
+                   'AST_ID', 'SPAN_TAG', 'SPAN_NAME', 'QC_FLAG']
 
     span_field_types = {'SN': 'LONG', 'BST': 'LONG', 'BST_TAG': 'TEXT',
                         'BST_ID': 'TEXT', 'AST': 'LONG', 'AST_TAG': 'TEXT',
                         'AST_ID': 'TEXT', 'SPAN_TAG': 'TEXT',
-                        'SPAN_NAME': 'TEXT'}
+                        'SPAN_NAME': 'TEXT', 'QC_FLAG': 'TEXT'}
 
     for field in span_fields:
         if field != 'SHAPE@':
             arcpy.AddField_management(spans, field, span_field_types[field])
 
-    # Draw spans but connecting structures in order
-    s_fields = TOWER_REPORT_FIELDS + ['SHAPE@']
+    # Read structures once
+    s_fields = ['QSI_TOWER', 'STR_GEOTAG', 'STRUCTURE', 'STR_TYPE',
+                'SHAPE@XY']
+    with arcpy.da.SearchCursor(tower_report_shp, s_fields) as cursor:
+        structures = [row for row in cursor]
+
+    if len(structures) < 2:
+        return spans
+
+    qsi, geotags, names, str_types, xy = zip(*structures)
+    xy = np.array(xy, dtype=float)
+    dead_ends = np.array([t == 'Dead End' for t in str_types])
+
+    chain = nearest_neighbour_chain(xy, dead_ends=dead_ends)
+    flagged = sum(1 for _, _, flag in chain if flag)
+    if flagged:
+        add_warning('    - WARNING: {} spans flagged as branch or ambiguous, '
+                    'see QC_FLAG'.format(flagged))
+
     i_fields = span_fields + ['SHAPE@']
     with arcpy.da.InsertCursor(spans, i_fields) as icurs:
+        for cnt, (b, a, flag) in enumerate(chain):
+            span_tag = '{}-{}'.format(geotags[b], geotags[a])
+            span_name = '{}-{}'.format(names[b], names[a])
+            geom = arcpy.Polyline(arcpy.Array([arcpy.Point(*xy[b]),
+                                               arcpy.Point(*xy[a])]), sr)
 
-        # Initialize 'from attributes'
-        from_geotag, from_structure, from_qsi = None, None, None
-        from_geom = None
+            icurs.insertRow([cnt + 1, qsi[b], geotags[b], names[b],
+                             qsi[a], geotags[a], names[a], span_tag,
+                             span_name, flag, geom])
 
-        for cnt, row in enumerate(
-                arcpy.da.SearchCursor(tower_report_shp, s_fields)):
+    add_indexes(spans, SPAN_INDEXES, SPATIAL_INDEX)
+    return spans
 
-            # Assign 'to' attributes
-            to_geotag = row[s_fields.index('STR_GEOTAG')]
-            to_structure = row[s_fields.index('STRUCTURE')]
-            to_qsi = row[s_fields.index('QSI_TOWER')]
-            to_geom = row[s_fields.index('SHAPE@')].firstPoint
 
-            if cnt > 0:
-                # Draw spans assuming order better insert handling
-                span_cnt = cnt
-                span_tag = '{}-{}'.format(from_geotag, to_geotag)
-                span_name = '{}-{}'.format(from_structure, to_structure)
-                geom = arcpy.Polyline(arcpy.Array([from_geom, to_geom]))
+def prepare_xml(xml_file, export_shapes=False, keep_comments=None,
+                progress=None, parallel=False):
+    """Parse, validate and build the structures, topology and tower report
+    of one xml, no arcpy calls so it can run ahead on a background thread
+    (see main)
+
+    Args:
+        parallel (bool or int): parse the tables across processes, see
+            utils.plscadd_xml.xml_root
+
+    Returns:
+        (root, tower report DataFrame, xml_line or None)
+    """
+    if progress:
+        progress.stage('parsing')
+    root = xml_root(xml_file, progress, parallel)
+    check_xml(root, spans=export_shapes)
+    try:
+        line = xml_line(root)
+    except (KeyError, ValueError):
+        line = None  # no staking report, the report falls back
+    return root, xml_to_tower_report_df(root, comments=keep_comments,
+                                        line=line), line
+
+
+def process_xml(xml_file, dst_dir=None, export_shapes=False,
+                keep_comments=None, spatial_reference=None, catalog=None,
+                progress=None, materials=None, blowout=False,
+                prepared=None, parallel=False, write_report=True):
+    """Tower report csv (and optionally shapes) for a single xml
+
+    Args:
+        xml_file (str): xml, compressed xml or zip member path
+        dst_dir (str): output folder, default next to the xml
+        export_shapes (bool): also write structure and span shapefiles
+        keep_comments: structure comment numbers to keep
+        spatial_reference: output spatial reference
+        catalog (str): optional structure catalog to ingest into
+        progress (Progress): progress/cancellation, partial outputs are
+            removed when cancelled
+        materials (list): material_tables of the xml are appended, see
+            utils.bom.summarize_materials
+        blowout (bool): with export_shapes, also write blowout envelope
+            polygons and the insulator swing csv, see utils.blowout
+        prepared (tuple): prepare_xml result, parsed ahead of time
+        parallel (bool or int): parse the tables across processes
+        write_report (bool): write the tower report csv, False keeps only
+            the shapes, catalog and materials
+
+    Returns:
+        dict of output name: path
+    """
+    # Determine output file path
+    dst = None
+    if dst_dir:
+        dst = os.path.join(dst_dir, xml_stem(xml_file, archive=True) +
+                           '_XML_TOWER_REPORT.csv').upper()
+
+    tower_report = tower_report_path(xml_file, dst)
+    tower_report_shp = os.path.splitext(tower_report)[0] + '.shp'
+    span_shp = os.path.splitext(tower_report)[0] + '_SPANS.shp'
+    blowout_shp = os.path.splitext(tower_report)[0] + '_BLOWOUT.shp'
+    swing_csv = os.path.splitext(tower_report)[0] + '_SWING.csv'
+    outputs = {'tower_report': tower_report} if write_report else {}
+    try:
+        root, report_df, line = prepared or prepare_xml(
+            xml_file, export_shapes, keep_comments, progress, parallel)
+
+        # Csv is a side output, written while shapes are built
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            csv_job = pool.submit(write_tower_report, report_df,
+                                  tower_report) if write_report else None
 
-                # TODO handle better
-                irow = [span_cnt, from_qsi, from_geotag, from_structure,
-                        to_qsi, to_geotag, to_structure, span_tag, span_name,
-                        geom]
+            if export_shapes:
+                tower_report_to_shape(report_df, tower_report_shp,
+                                      out_sr=spatial_reference,
+                                      progress=progress)
+                outputs['structures'] = tower_report_shp
+
+                try:
+                    xml_to_spans(root, span_shp, sr=spatial_reference,
+                                 progress=progress, line=line,
+                                 out_blowout=blowout_shp if blowout
+                                 else None,
+                                 out_swing=swing_csv if blowout else None)
+                    if blowout:
+                        outputs['blowout'] = blowout_shp
+                        outputs['swing'] = swing_csv
+                except ValueError:
+                    add_warning('    - WARNING: Attempting to create '
+                                'spans from structure locations, '
+                                'qc closely')
+                    tower_report_to_span_shp(tower_report_shp, span_shp,
+                                             sr=spatial_reference)
+                outputs['spans'] = span_shp
 
-                icurs.insertRow(irow)
+            if csv_job:
+                csv_job.result()
 
-            # Update 'from' attributes for next span
-            from_geotag = to_geotag
-            from_structure = to_structure
-            from_qsi = to_qsi
-            from_geom = to_geom
+        if catalog:
+            if progress:
+                progress.stage('catalog')
+            catalog_line(catalog, safe_name(xml_stem(xml_file, archive=True)),
+                         report_df, span_shp if export_shapes else None,
+                         xml_file, root_tables(root))
+            outputs['catalog'] = catalog
 
-    return spans
+        if materials is not None:
+            materials.append(material_tables(
+                root, xml_stem(xml_file, archive=True)))
 
+    except Cancelled:
+        add_warning('\n      - WARNING: Cancelled, removing partial '
+                    'outputs for {}'.format(os.path.basename(xml_file)))
+        cleanup_outputs(([tower_report] if write_report else []) +
+                        [tower_report_shp, span_shp] +
+                        ([blowout_shp, swing_csv] if blowout else []))
+        raise
+
+    return outputs
 
 
 def main():
     # Inputs
-    xml_files = arcpy.GetParameterAsText(0).split(';')
+    xml_files = expand_xml_inputs(arcpy.GetParameterAsText(0))
     dst_dir = arcpy.GetParameterAsText(1)
     export_shapes = arcpy.GetParameter(2)
     keep_comments = arcpy.GetParameter(3)
     spatial_reference = arcpy.GetParameterAsText(4)
+    catalog = arcpy.GetParameterAsText(5) \
+        if arcpy.GetArgumentCount() > 5 else None
+    materials = [] if arcpy.GetArgumentCount() > 6 and \
+        arcpy.GetParameter(6) else None
+    blowout = arcpy.GetArgumentCount() > 7 and bool(arcpy.GetParameter(7))
+    write_report = arcpy.GetArgumentCount() <= 8 or \
+        bool(arcpy.GetParameter(8))
 
     # Convert xml files to tower reports
     add_message('\n 1. Processing {} input xml files'.format(
         len(xml_files)))
 
-    arcpy.SetProgressor('step', 'Processing xmls...', 0, len(xml_files), 1)
-    for cnt, xml_file in enumerate(sorted(xml_files)):
-        arcpy.SetProgressorPosition(cnt + 1)
-        add_message('\n    - {}'.format(os.path.basename(xml_file)))
-
-        # Determine output file path
-        dst = None
-        if dst_dir:
-            dst = os.path.join(dst_dir, os.path.splitext(
-                os.path.basename(xml_file))[0] +
-                               '_XML_TOWER_REPORT.csv').upper()
-
-        try:
-            tower_report = xml_to_tower_report(xml_file, dst, comments=keep_comments)
-
-
-            if export_shapes:
-                tower_report_shp = os.path.splitext(tower_report)[0] + '.shp'
-                span_shp = os.path.splitext(tower_report)[0] + '_SPANS.shp'
+    progress = Progress.for_files(xml_files, 'Processing xmls',
+                                  size=xml_size)
 
-                tower_report_to_shape(tower_report, out_sr=spatial_reference)
-
-                try:
-                    xml_to_spans(xml_file, span_shp, sr=spatial_reference)
-                except ValueError:
-                    add_warning('    - WARNING: Attempting to create spans '
-                                'assuming structure order is followed exactly, '
-                                'qc closely')
-                    tower_report_to_span_shp(tower_report_shp, span_shp, sr=spatial_reference)
-
-        except Exception as e:
-            add_error('\n      - ERROR: Could not process, {}'.format(e))
+    # The next xml is parsed and validated while this one is written
+    stop = threading.Event()
 
+    def prepare(xml_file):
+        add_message('\n    - {}'.format(os.path.basename(xml_file)))
+        return prepare_xml(xml_file, export_shapes, keep_comments,
+                           BackgroundProgress(stop))
+
+    try:
+        for xml_file, prepared, error in prefetch(prepare, sorted(xml_files),
+                                                  stop=stop,
+                                                  check=progress.check):
+            try:
+                if error is not None:
+                    raise error
+                progress.add_bytes(xml_size(xml_file))
+                process_xml(xml_file, dst_dir, export_shapes, keep_comments,
+                            spatial_reference, catalog, progress, materials,
+                            blowout, prepared, write_report=write_report)
+
+            except Cancelled:
+                break
+
+            except XmlValidationError as e:
+                add_warning('\n      - WARNING: {}, skipped'.format(e))
+
+            except Exception as e:
+                add_error('\n      - ERROR: Could not process, {}'.format(e))
+    except Cancelled:  # while waiting on the next xml
+        pass
+
+    # One material summary for the whole delivery
+    if materials:
+        add_message('\n 2. Material summary')
+        summary_dir = dst_dir or xml_dir(xml_files[0])
+        for path in write_material_summary(summarize_materials(materials),
+                                           summary_dir):
+            add_message('    - {}'.format(path))
+
+    progress.report(force=True)
     return len(xml_files)
 
 
 if __name__ == '__main__':
-    log = main()
-    log.report['Size'] = log.ret
-    log.submit_log()
+    main()
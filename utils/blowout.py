@@ -0,0 +1,311 @@
+"""
+Purpose: Insulator swing angles and horizontal conductor blowout envelopes
+         for every wire of every span under each checked weather case
+Notes: Wires x cases x vertices are computed as one broadcast array. The
+       wire shape is the section catenary (see CATENARY_FIELD), loads of a
+       weather case only rotate it about its chord, cable tensions are not
+       re-solved per case as PLS-CADD does
+"""
+
+try:
+    import arcpy
+except ImportError:  # headless, see xmltool.py
+    arcpy = None
+import os
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+from utils.catenary import catenary_points, low_point_offset
+from utils.misc import add_indexes
+from utils.xml_tables import xml_table_element_dict
+
+# criteria table: CRITERIA value
+CASE_TABLES = OrderedDict([
+    ('insulator_swing_criteria', 'SWING'),
+    ('blowout_and_departure_angle_report_criteria', 'BLOWOUT')])
+
+# Insulators hanging at least this steep (degrees below horizontal) swing
+SUSPENSION_MIN_ANGLE = 45.
+
+BLOWOUT_FIELDS = ['SECTION', 'WIRE', 'BST', 'BST_SET', 'BST_PHASE',
+                  'AST', 'AST_SET', 'AST_PHASE', 'CABLE_FILE', 'WC',
+                  'WEATHER_CASE', 'CRITERIA', 'WIRE_SWING', 'BST_SWING',
+                  'AST_SWING', 'BLOWOUT', 'SHAPE@']
+
+BLOWOUT_FIELD_TYPES = {'SECTION': 'SHORT',
+                       'WIRE': 'SHORT',
+                       'BST_SET': 'SHORT',
+                       'BST_PHASE': 'SHORT',
+                       'AST_SET': 'SHORT',
+                       'AST_PHASE': 'SHORT',
+                       'WC': 'SHORT',
+                       'WIRE_SWING': 'DOUBLE',
+                       'BST_SWING': 'DOUBLE',
+                       'AST_SWING': 'DOUBLE',
+                       'BLOWOUT': 'DOUBLE'}
+
+BLOWOUT_INDEXES = ['SECTION', 'BST', 'AST', 'WC']
+
+SWING_COLUMNS = ['STRUCTURE', 'SET_NO', 'PHASE', 'WC', 'WEATHER_CASE',
+                 'CRITERIA', 'SUSPENSION', 'LENGTH', 'WIND_SPAN',
+                 'WEIGHT_SPAN', 'SWING', 'SWING_DIST']
+
+
+def _floats(rows, key):
+    return np.array([float(r.get(key) or 0.) for r in rows])
+
+
+def weather_cases(xml_tables):
+    """Weather cases named by the swing and blowout criteria
+
+    Returns:
+        DataFrame with WC, WEATHER_CASE, CRITERIA and the loads used:
+        WIND_PRES (psf), ICE_THICK (in), ICE_DENSITY (pcf), NESC_K (lb/ft)
+    """
+    criteria = OrderedDict()
+    for tagname, label in CASE_TABLES.items():
+        if tagname not in xml_tables:
+            continue
+        for row in xml_table_element_dict(xml_tables[tagname],
+                                          as_list=True):
+            labels = criteria.setdefault(int(row['wc']), [])
+            if label not in labels:
+                labels.append(label)
+
+    rows = [r for r in xml_table_element_dict(xml_tables['weather_cases'],
+                                              as_list=True)
+            if int(r['wc']) in criteria]
+    return pd.DataFrame(OrderedDict([
+        ('WC', [int(r['wc']) for r in rows]),
+        ('WEATHER_CASE', [r.get('description') or '' for r in rows]),
+        ('CRITERIA', [';'.join(criteria[int(r['wc'])]) for r in rows]),
+        ('WIND_PRES', _floats(rows, 'wind_pres') *
+         _floats(rows, 'weather_load_factor')),
+        ('ICE_THICK', _floats(rows, 'wire_ice_thick')),
+        ('ICE_DENSITY', _floats(rows, 'wire_ice_density')),
+        ('NESC_K', _floats(rows, 'nesc_constant'))]))
+
+
+def _cable_key(name):
+    return os.path.basename(str(name).replace('\\', '/')).lower()
+
+
+def cable_properties(xml_tables, cable_names):
+    """Outside diameter (in) and unit weight (lb/ft) per wire, NaN if the
+    cable is not in cable_data_report"""
+    cables = {}
+    for row in xml_table_element_dict(xml_tables['cable_data_report'],
+                                      as_list=True):
+        cables[_cable_key(row['cable_name'])] = (
+            float(row['outside_diameter']), float(row['unit_weight']))
+    props = np.array([cables.get(_cable_key(n), (np.nan, np.nan))
+                      for n in cable_names], dtype=float).reshape(-1, 2)
+    return props[:, 0], props[:, 1]
+
+
+def wire_loads(diameter, weight, cases):
+    """Transverse and vertical load per foot, (wires, cases) arrays
+
+    Args:
+        diameter (ndarray): (N,) outside diameter in inches
+        weight (ndarray): (N,) bare unit weight in lb/ft
+        cases (DataFrame): see weather_cases
+    """
+    d = diameter[:, None] / 12.
+    t = cases['ICE_THICK'].values[None, :] / 12.
+    ice = cases['ICE_DENSITY'].values[None, :] * np.pi * t * (d + t)
+    transverse = cases['WIND_PRES'].values[None, :] * (d + 2 * t)
+    vertical = weight[:, None] + ice
+    # NESC constant adds to the resultant, keeping its direction
+    resultant = np.hypot(transverse, vertical)
+    scale = (resultant + cases['NESC_K'].values[None, :]) / resultant
+    return transverse * scale, vertical * scale
+
+
+def blowout_envelopes(records, attachments, b_pos, a_pos, diameter, weight,
+                      cases, n_points=21):
+    """Swing angles and envelope polygons for every wire and case
+
+    Conductor and insulators swing to either side of the span, so each
+    envelope is the plan view wire offset both ways by the blowout at each
+    vertex: insulator swing, interpolated between the ends, plus the wire
+    sag rotated by its swing angle.
+
+    Args:
+        records (list): wire records, see span_wire_attachments
+        attachments (AttachmentTable): attachment points
+        b_pos, a_pos (ndarray): (N,) back and ahead attachment rows
+        diameter, weight (ndarray): (N,) cable properties
+        cases (DataFrame): see weather_cases
+        n_points (int): vertices along each side of an envelope
+
+    Returns:
+        (swing, envelopes, rings): swing is a DataFrame of SWING_COLUMNS
+        per attachment and case, envelopes a (N, K, 4) array of WIRE_SWING,
+        BST_SWING, AST_SWING (degrees) and BLOWOUT (ft), rings a
+        (N, K, 2 * n_points, 2) array of polygon XY
+    """
+    data = attachments.data
+    k = len(cases)
+    start = attachments.wire_xyz(b_pos)
+    end = attachments.wire_xyz(a_pos)
+    c = np.array([r[9] for r in records], dtype=float).reshape(-1)
+    points = catenary_points(start, end, c, n_points)
+
+    # sag below the chord at each vertex (N, P), 0 for straight chords
+    chord = np.linspace(start[:, 2], end[:, 2], points.shape[1], axis=1)
+    sag = np.clip(chord - points[:, :, 2], 0., None)
+
+    transverse, vertical = wire_loads(diameter, weight, cases)
+    wire_swing = np.arctan2(transverse, vertical)  # (N, K)
+
+    # Wind and weight span carried by each attachment
+    span = np.hypot(*(end - start)[:, :2].T)
+    low = np.where(np.isfinite(c) & (c > 0) & (span > 0),
+                   low_point_offset(span, end[:, 2] - start[:, 2],
+                                    np.where(c > 0, c, 1.)), span / 2)
+    wind_span = np.zeros(len(data))
+    weight_span = np.zeros(len(data))
+    np.add.at(wind_span, b_pos, span / 2)
+    np.add.at(wind_span, a_pos, span / 2)
+    np.add.at(weight_span, b_pos, low)
+    np.add.at(weight_span, a_pos, span - low)
+
+    att_transverse = np.zeros((len(data), k))
+    att_vertical = np.zeros((len(data), k))
+    np.add.at(att_transverse, b_pos, transverse * (span / 2)[:, None])
+    np.add.at(att_transverse, a_pos, transverse * (span / 2)[:, None])
+    np.add.at(att_vertical, b_pos, vertical * low[:, None])
+    np.add.at(att_vertical, a_pos, vertical * (span - low)[:, None])
+
+    # Only hanging insulators swing, strain insulators follow the wire
+    drop = data['ins_z'] - data['wire_z']
+    suspension = (data['length'] > 0) & (
+        np.degrees(np.arcsin(np.clip(drop / np.where(
+            data['length'] > 0, data['length'], 1.), -1., 1.))) >=
+        SUSPENSION_MIN_ANGLE)
+    att_swing = np.where(suspension[:, None],
+                         np.arctan2(att_transverse, att_vertical), 0.)
+    att_dist = data['length'][:, None] * np.sin(att_swing)
+
+    # Blowout at each vertex (N, K, P): insulators plus rotated sag
+    t = np.linspace(0., 1., points.shape[1])
+    offset = (att_dist[b_pos][:, :, None] * (1 - t) +
+              att_dist[a_pos][:, :, None] * t +
+              sag[:, None, :] * np.sin(np.abs(wire_swing))[:, :, None])
+
+    xy = points[:, :, :2]
+    direction = (end - start)[:, :2]
+    length = np.hypot(*direction.T)
+    normal = np.column_stack([-direction[:, 1], direction[:, 0]]) / \
+        np.where(length > 0, length, 1.)[:, None]
+    left = xy[:, None, :, :] + offset[..., None] * normal[:, None, None, :]
+    right = xy[:, None, :, :] - offset[..., None] * normal[:, None, None, :]
+    rings = np.concatenate([left, right[:, :, ::-1, :]], axis=2)
+
+    envelopes = np.stack([
+        np.degrees(wire_swing),
+        np.degrees(att_swing[b_pos]), np.degrees(att_swing[a_pos]),
+        offset.max(axis=2)], axis=2)
+
+    swing = pd.DataFrame(OrderedDict([
+        ('STRUCTURE', np.repeat(data['structure'], k)),
+        ('SET_NO', np.repeat(data['set_no'], k)),
+        ('PHASE', np.repeat(data['phase_no'], k)),
+        ('WC', np.tile(cases['WC'].values, len(data))),
+        ('WEATHER_CASE', np.tile(cases['WEATHER_CASE'].values, len(data))),
+        ('CRITERIA', np.tile(cases['CRITERIA'].values, len(data))),
+        ('SUSPENSION', np.repeat(suspension, k)),
+        ('LENGTH', np.repeat(data['length'], k).round(2)),
+        ('WIND_SPAN', np.repeat(wind_span, k).round(2)),
+        ('WEIGHT_SPAN', np.repeat(weight_span, k).round(2)),
+        ('SWING', np.degrees(att_swing).reshape(-1).round(2)),
+        ('SWING_DIST', att_dist.reshape(-1).round(2))]))
+    carried = np.repeat(wind_span > 0, k)
+
+    return swing[carried].reset_index(drop=True), envelopes, rings
+
+
+def xml_blowout(root, xml_tables=None, structures=None, n_points=21):
+    """Swing and blowout envelopes of one XML, see blowout_envelopes
+
+    Args:
+        root (Element): parsed XML, see xml_root
+        xml_tables (dict): default root_tables(root)
+        structures (StructureTable): default hub_structures(root)
+        n_points (int): vertices along each side of an envelope
+
+    Returns:
+        (swing, records, rings), swing with STRUCTURE as structure
+        numbers, records lists of BLOWOUT_FIELDS (without SHAPE@) and
+        rings a list of (2 * n_points, 2) polygon arrays
+    """
+    from utils.plscadd_xml import (hub_structures, root_tables,
+                                   span_wire_attachments)
+
+    if xml_tables is None:
+        xml_tables = root_tables(root)
+    if structures is None:
+        structures = hub_structures(root, xml_tables)
+    records, attachments, b_pos, a_pos = span_wire_attachments(
+        xml_tables, structures=structures)
+    cases = weather_cases(xml_tables)
+    diameter, weight = cable_properties(xml_tables,
+                                        [r[8] for r in records])
+    swing, envelopes, rings = blowout_envelopes(
+        records, attachments, b_pos, a_pos, diameter, weight, cases,
+        n_points)
+
+    swing['STRUCTURE'] = structures.numbers()[swing['STRUCTURE'].values]
+
+    out_records, out_rings = [], []
+    for i, rec in enumerate(records):
+        for j, case in enumerate(cases.itertuples(index=False)):
+            if not np.isfinite(envelopes[i, j]).all():
+                continue
+            out_records.append(rec[:9] + [
+                case.WC, case.WEATHER_CASE, case.CRITERIA] +
+                [round(float(v), 2) for v in envelopes[i, j]])
+            out_rings.append(rings[i, j])
+    return swing, out_records, out_rings
+
+
+def write_blowout(root, out_envelopes, sr=None, out_swing=None,
+                  xml_tables=None, structures=None, n_points=21,
+                  progress=None):
+    """Write blowout envelope polygons, and the insulator swing csv
+
+    Args:
+        root (Element): parsed XML, see xml_root
+        out_envelopes (str): output polygon feature class
+        sr (SpatialReference): XML coordinate system
+        out_swing (str): insulator swing csv (optional)
+    """
+    swing, records, rings = xml_blowout(root, xml_tables, structures,
+                                        n_points)
+    if out_swing:
+        swing[SWING_COLUMNS].to_csv(out_swing, index=False, quoting=1,
+                                    quotechar='"', encoding='utf-8')
+    if progress:
+        progress.stage('blowout', len(records))
+
+    arcpy.CreateFeatureclass_management(os.path.dirname(out_envelopes),
+                                        os.path.basename(out_envelopes),
+                                        geometry_type='POLYGON',
+                                        spatial_reference=sr)
+    for field in BLOWOUT_FIELDS:
+        if field != 'SHAPE@':
+            arcpy.AddField_management(out_envelopes, field,
+                                      BLOWOUT_FIELD_TYPES.get(field, 'TEXT'))
+
+    with arcpy.da.InsertCursor(out_envelopes, BLOWOUT_FIELDS) as icurs:
+        for rec, ring in zip(records, rings):
+            geom = arcpy.Polygon(
+                arcpy.Array([arcpy.Point(*p) for p in ring.tolist()]), sr)
+            icurs.insertRow(rec + [geom])
+            if progress:
+                progress.add_rows()
+
+    add_indexes(out_envelopes, BLOWOUT_INDEXES)
+    return out_envelopes
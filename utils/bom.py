@@ -0,0 +1,214 @@
+"""
+Purpose: Material rollups from PLS-CADD XML bill of material tables
+Notes: PLS-CADD writes one bill_of_material_of_new_items_for_structure
+       table per structure (titledetail is the structure number), all with
+       the same tagname, so they are streamed rather than read through
+       root_tables which keeps only the last one
+"""
+
+import os
+import pandas as pd
+from collections import OrderedDict
+
+from utils.xml_tables import ParsedXml, et, xml_table_element_dict
+
+BOM_TABLE = 'bill_of_material_of_new_items_for_structure'
+STRUCTURE_MATERIAL_TABLE = 'structure_material_list_report'
+CABLE_MATERIAL_TABLE = 'cable_material_list_report'
+STRINGING_TABLE = 'section_stringing_data'
+MATERIAL_TABLES = (BOM_TABLE, STRUCTURE_MATERIAL_TABLE, CABLE_MATERIAL_TABLE,
+                   STRINGING_TABLE)
+
+# xml column: output column
+BOM_COLUMNS = OrderedDict([
+    ('str_no', 'STRUCTURE'), ('stock_number', 'STOCK_NUMBER'),
+    ('description', 'DESCRIPTION'), ('unit_of_measure', 'UNIT'),
+    ('quantity', 'QUANTITY'), ('total_material_cost', 'MATERIAL_COST'),
+    ('total_labor_cost', 'LABOR_COST'), ('total_cost', 'TOTAL_COST')])
+STRUCTURE_MATERIAL_COLUMNS = OrderedDict([
+    ('structure_file_name', 'STRUCTURE_FILE'),
+    ('number_in_selected_line', 'COUNT')])
+CABLE_MATERIAL_COLUMNS = OrderedDict([
+    ('cable_file_name', 'CABLE_FILE'), ('number_of_sections', 'SECTIONS'),
+    ('cable_length_at_stringing_condition', 'LENGTH_FT')])
+
+# per structure summary rows, recomputed by the rollups
+BOM_SUBTOTALS = ('Material Subtotal', 'Labor Subtotal', 'Total')
+
+BOM_SUMS = ['QUANTITY', 'MATERIAL_COST', 'LABOR_COST', 'TOTAL_COST']
+PART_KEY = ['STOCK_NUMBER', 'DESCRIPTION', 'UNIT']
+
+
+def iter_tables(xml, tagnames):
+    """Every instance of the given tables, including repeated tagnames
+
+    Args:
+        xml: parsed root, or a path streamed with iterparse (see open_xml)
+            so only one table is held in memory at a time
+        tagnames (iterable): table tagnames to yield
+
+    Yields:
+        (tagname, titledetail, row dicts)
+    """
+    tagnames = set(tagnames)
+    if isinstance(xml, ParsedXml):
+        xml = xml.xml_file  # repeated tables are only kept in the file
+    if et.iselement(xml):
+        for table in xml:
+            if table.tag == 'table' and table.get('tagname') in tagnames:
+                yield (table.get('tagname'), table.get('titledetail'),
+                       xml_table_element_dict(table, as_list=True))
+        return
+
+    from utils.plscadd_xml import open_xml
+    with open_xml(xml) as f:
+        root = None
+        for event, elem in et.iterparse(f, events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event != 'end' or elem.tag != 'table':
+                continue
+            if elem.get('tagname') in tagnames:
+                yield (elem.get('tagname'), elem.get('titledetail'),
+                       xml_table_element_dict(elem, as_list=True))
+            root.clear()
+
+
+def _frame(rows, columns):
+    return pd.DataFrame([[r.get(c) for c in columns] for r in rows],
+                        columns=list(columns.values()))
+
+
+def _numeric(df, columns):
+    for col in columns:
+        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0.)
+    return df
+
+
+def material_tables(xml, line_name):
+    """Bill of material, structure and cable material lists of one XML
+
+    Each structure's parts are assigned to the lowest numbered section
+    strung through it, so section totals add up to the line total.
+
+    Args:
+        xml: parsed root or path
+        line_name (str): LINE column value
+
+    Returns:
+        dict of 'bom', 'structures', 'cables' DataFrames
+    """
+    bom, structures, cables = [], [], []
+    sections = {}
+    for tagname, detail, rows in iter_tables(xml, MATERIAL_TABLES):
+        if tagname == BOM_TABLE:
+            for row in rows:
+                row.setdefault('str_no', detail)
+            bom.extend(rows)
+        elif tagname == STRUCTURE_MATERIAL_TABLE:
+            structures.extend(rows)
+        elif tagname == CABLE_MATERIAL_TABLE:
+            cables.extend(rows)
+        else:
+            for row in rows:
+                section = int(row['section_number'])
+                number = row['struct_number']
+                sections[number] = min(sections.get(number, section),
+                                       section)
+
+    bom = _numeric(_frame(bom, BOM_COLUMNS), BOM_SUMS)
+    bom['STOCK_NUMBER'] = bom['STOCK_NUMBER'].fillna('')
+    bom = bom[~((bom['STOCK_NUMBER'] == '') &
+                bom['DESCRIPTION'].isin(BOM_SUBTOTALS))].reset_index(drop=True)
+    bom['UNIT'] = bom['UNIT'].fillna('')
+    bom.insert(0, 'LINE', line_name)
+    bom.insert(2, 'SECTION', bom['STRUCTURE'].map(sections).astype('Int64'))
+
+    structures = _numeric(_frame(structures, STRUCTURE_MATERIAL_COLUMNS),
+                          ['COUNT'])
+    structures.insert(0, 'LINE', line_name)
+    cables = _numeric(_frame(cables, CABLE_MATERIAL_COLUMNS),
+                      ['SECTIONS', 'LENGTH_FT'])
+    cables.insert(0, 'LINE', line_name)
+    return {'bom': bom, 'structures': structures, 'cables': cables}
+
+
+def summarize_materials(tables):
+    """Delivery wide material rollups
+
+    Args:
+        tables (list): material_tables results, one per line
+
+    Returns:
+        OrderedDict of summary name to DataFrame
+    """
+    bom = pd.concat([t['bom'] for t in tables], ignore_index=True)
+    structures = pd.concat([t['structures'] for t in tables],
+                           ignore_index=True)
+    cables = pd.concat([t['cables'] for t in tables], ignore_index=True)
+
+    def rollup(df, by, sums):
+        if df.empty:
+            return pd.DataFrame(columns=by + sums)
+        return df.groupby(by, sort=True, dropna=False)[sums].sum() \
+            .reset_index()
+
+    by_part = bom.assign(
+        N_LINES=bom['LINE'],
+        N_STRUCTURES=bom['LINE'] + '|' + bom['STRUCTURE'].astype(str)
+    ).groupby(PART_KEY, sort=True, dropna=False).agg(
+        dict([('N_LINES', 'nunique'), ('N_STRUCTURES', 'nunique')] +
+             [(c, 'sum') for c in BOM_SUMS])).reset_index()
+
+    structure_files = structures.assign(
+        STRUCTURE_FILE=structures['STRUCTURE_FILE'].map(
+            lambda p: os.path.basename(str(p).replace('\\', '/'))))
+    cable_files = cables.assign(CABLE_FILE=cables['CABLE_FILE'].map(
+        lambda p: os.path.basename(str(p).replace('\\', '/'))))
+
+    return OrderedDict([
+        ('by_part', by_part),
+        ('by_line', rollup(bom, ['LINE'] + PART_KEY, BOM_SUMS)),
+        ('by_section', rollup(bom, ['LINE', 'SECTION'] + PART_KEY,
+                              BOM_SUMS)),
+        ('by_structure', rollup(bom, ['LINE', 'STRUCTURE'] + PART_KEY,
+                                BOM_SUMS)),
+        ('structure_files', rollup(structure_files, ['STRUCTURE_FILE'],
+                                   ['COUNT'])),
+        ('cable_files', rollup(cable_files, ['CABLE_FILE'],
+                               ['SECTIONS', 'LENGTH_FT'])),
+    ])
+
+
+def write_material_summary(summary, dst_dir, prefix='Material_Summary'):
+    """One csv per rollup in dst_dir
+
+    Returns:
+        list of csv paths
+    """
+    paths = []
+    for name, df in summary.items():
+        path = os.path.join(dst_dir, '{}_{}.csv'.format(prefix, name))
+        df.to_csv(path, index=False, quoting=1, quotechar='"',
+                  encoding='utf-8')
+        paths.append(path)
+    return paths
+
+
+def delivery_materials(xml_files, dst_dir, line_names=None):
+    """Stream every XML of a delivery and write its material summary
+
+    Args:
+        xml_files (list): XML paths
+        dst_dir (str): output folder
+        line_names (list): LINE per xml (default the xml name)
+
+    Returns:
+        list of csv paths
+    """
+    from utils.plscadd_xml import xml_stem
+    if line_names is None:
+        line_names = [xml_stem(f, archive=True) for f in xml_files]
+    return write_material_summary(summarize_materials(
+        [material_tables(f, n) for f, n in zip(xml_files, line_names)]),
+        dst_dir)
@@ -0,0 +1,365 @@
+"""
+Purpose: Persistent system-wide catalog of structures and spans produced
+         from PLS-CADD XML, stored in SQLite with an R-tree spatial index
+Notes: Locations are stored as longitude/latitude so lines from different
+       state plane zones can be queried together
+"""
+
+import itertools
+import math
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from utils.geotagging import geotag_codes
+
+FEET_PER_DEGREE_LAT = 364000.  # approximate, refined by exact distance
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lines (
+    line_id INTEGER PRIMARY KEY,
+    line_name TEXT UNIQUE NOT NULL,
+    xml_file TEXT,
+    ingested TEXT DEFAULT CURRENT_TIMESTAMP);
+
+CREATE TABLE IF NOT EXISTS structures (
+    id INTEGER PRIMARY KEY,
+    line_id INTEGER NOT NULL REFERENCES lines(line_id),
+    qsi_tower INTEGER,
+    structure TEXT,
+    str_geotag TEXT,
+    str_type TEXT,
+    x REAL, y REAL, z1 REAL, z2 REAL, h REAL,
+    latitude REAL, longitude REAL);
+CREATE INDEX IF NOT EXISTS structures_geotag ON structures(str_geotag);
+CREATE INDEX IF NOT EXISTS structures_line ON structures(line_id, qsi_tower);
+CREATE INDEX IF NOT EXISTS structures_name ON structures(structure);
+
+CREATE TABLE IF NOT EXISTS spans (
+    id INTEGER PRIMARY KEY,
+    line_id INTEGER NOT NULL REFERENCES lines(line_id),
+    span_tag TEXT,
+    bst_tag TEXT, ast_tag TEXT,
+    bst_id TEXT, ast_id TEXT,
+    section INTEGER,
+    cable_file TEXT,
+    bst_lat REAL, bst_lon REAL, ast_lat REAL, ast_lon REAL);
+CREATE INDEX IF NOT EXISTS spans_tag ON spans(span_tag);
+CREATE INDEX IF NOT EXISTS spans_bst ON spans(bst_tag);
+CREATE INDEX IF NOT EXISTS spans_ast ON spans(ast_tag);
+CREATE INDEX IF NOT EXISTS spans_line ON spans(line_id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS structures_rtree USING rtree(
+    id, min_lon, max_lon, min_lat, max_lat);
+CREATE VIRTUAL TABLE IF NOT EXISTS spans_rtree USING rtree(
+    id, min_lon, max_lon, min_lat, max_lat);
+"""
+
+STRUCTURE_COLUMNS = ['QSI_TOWER', 'STRUCTURE', 'STR_GEOTAG', 'STR_TYPE',
+                     'X', 'Y', 'Z1', 'Z2', 'H', 'LATITUDE', 'LONGITUDE']
+
+SPAN_COLUMNS = ['SPAN_TAG', 'BST_TAG', 'AST_TAG', 'BST_ID', 'AST_ID',
+                'SECTION', 'CABLE_FILE']
+
+
+def _distance_ft(lat1, lon1, lat2, lon2):
+    """Equirectangular distance in feet, adequate below a few miles"""
+    lat1, lon1 = np.radians(lat1), np.radians(lon1)
+    lat2, lon2 = np.radians(lat2), np.radians(lon2)
+    x = (lon2 - lon1) * np.cos((lat1 + lat2) / 2)
+    y = lat2 - lat1
+    return np.hypot(x, y) * 20902231.  # mean earth radius, ft
+
+
+class StructureCatalog(object):
+    """SQLite catalog keyed by line and STR_GEOTAG
+
+    Usage:
+        with StructureCatalog(path) as cat:
+            cat.ingest_tower_report('LINE', report_df)
+            cat.near(37.62, -122.11, 500)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    # Ingest
+    def line_id(self, line_name, xml_file=None):
+        cur = self.conn.execute(
+            'SELECT line_id FROM lines WHERE line_name = ?', (line_name,))
+        row = cur.fetchone()
+        if row:
+            self.conn.execute(
+                'UPDATE lines SET xml_file = COALESCE(?, xml_file), '
+                'ingested = CURRENT_TIMESTAMP WHERE line_id = ?',
+                (xml_file, row[0]))
+            return row[0]
+
+        cur = self.conn.execute(
+            'INSERT INTO lines (line_name, xml_file) VALUES (?, ?)',
+            (line_name, xml_file))
+        return cur.lastrowid
+
+    def _clear(self, table, line_id):
+        self.conn.execute(
+            'DELETE FROM {0}_rtree WHERE id IN '
+            '(SELECT id FROM {0} WHERE line_id = ?)'.format(table),
+            (line_id,))
+        self.conn.execute('DELETE FROM {} WHERE line_id = ?'.format(table),
+                          (line_id,))
+
+    def ingest_tower_report(self, line_name, tower_report, xml_file=None):
+        """Replace a line's structures
+
+        Args:
+            line_name (str): catalog key, e.g. safe_name of the xml
+            tower_report: csv path or DataFrame, see xml_to_tower_report_df
+            xml_file (str): source, stored for reference
+
+        Returns:
+            number of structures
+        """
+        if isinstance(tower_report, str):
+            tower_report = pd.read_csv(tower_report, encoding='utf-8')
+
+        df = tower_report.reindex(columns=STRUCTURE_COLUMNS)
+        df = df.astype(object).where(df.notna(), None)
+
+        with self.conn:
+            line_id = self.line_id(line_name, xml_file)
+            self._clear('structures', line_id)
+
+            start = self._next_id('structures')
+            ids = range(start, start + len(df))
+            self.conn.executemany(
+                'INSERT INTO structures (id, line_id, qsi_tower, structure, '
+                'str_geotag, str_type, x, y, z1, z2, h, latitude, longitude) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ([i, line_id] + list(r) for i, r in
+                 zip(ids, df.itertuples(index=False, name=None))))
+
+            self.conn.executemany(
+                'INSERT INTO structures_rtree VALUES (?, ?, ?, ?, ?)',
+                ((i, lon, lon, lat, lat) for i, lat, lon in
+                 zip(ids, df['LATITUDE'], df['LONGITUDE'])
+                 if lat is not None and lon is not None))
+
+        return len(df)
+
+    def ingest_spans(self, line_name, spans, xml_file=None):
+        """Replace a line's spans
+
+        Args:
+            line_name (str): catalog key
+            spans: DataFrame or list of dicts with SPAN_COLUMNS, span ends
+                are located using the line's catalogued structures
+
+        Returns:
+            number of spans
+        """
+        df = pd.DataFrame(list(spans)) if not isinstance(
+            spans, pd.DataFrame) else spans
+        df = df.reindex(columns=SPAN_COLUMNS)
+        df = df.astype(object).where(df.notna(), None)
+
+        with self.conn:
+            line_id = self.line_id(line_name, xml_file)
+            self._clear('spans', line_id)
+
+            locations = {tag: (lat, lon) for tag, lat, lon in
+                         self.conn.execute(
+                             'SELECT str_geotag, latitude, longitude FROM '
+                             'structures WHERE line_id = ?', (line_id,))}
+            none = (None, None)
+
+            start = self._next_id('spans')
+            rows, boxes = [], []
+            for i, r in enumerate(df.itertuples(index=False, name=None)):
+                b_lat, b_lon = locations.get(r[1], none)
+                a_lat, a_lon = locations.get(r[2], none)
+                rows.append([start + i, line_id] + list(r) +
+                            [b_lat, b_lon, a_lat, a_lon])
+                if None not in (b_lat, b_lon, a_lat, a_lon):
+                    boxes.append((start + i, min(b_lon, a_lon),
+                                  max(b_lon, a_lon), min(b_lat, a_lat),
+                                  max(b_lat, a_lat)))
+
+            self.conn.executemany(
+                'INSERT INTO spans (id, line_id, span_tag, bst_tag, ast_tag, '
+                'bst_id, ast_id, section, cable_file, bst_lat, bst_lon, '
+                'ast_lat, ast_lon) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.conn.executemany(
+                'INSERT INTO spans_rtree VALUES (?, ?, ?, ?, ?)', boxes)
+
+        return len(df)
+
+    def _next_id(self, table):
+        return (self.conn.execute(
+            'SELECT MAX(id) FROM {}'.format(table)).fetchone()[0] or 0) + 1
+
+    # Queries
+    def query(self, sql, params=()):
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def lines(self):
+        return self.query('SELECT * FROM lines ORDER BY line_name')
+
+    def structures(self, line_name=None, geotag=None):
+        """Structures by line and/or geotag"""
+        where, params = [], []
+        if line_name:
+            where.append('l.line_name = ?')
+            params.append(line_name)
+        if geotag:
+            where.append('s.str_geotag = ?')
+            params.append(geotag)
+
+        return self.query(
+            'SELECT l.line_name, s.* FROM structures s JOIN lines l '
+            'USING (line_id){} ORDER BY l.line_name, s.qsi_tower'.format(
+                ' WHERE ' + ' AND '.join(where) if where else ''), params)
+
+    def spans_at(self, geotag):
+        """Spans attached to a structure in any line"""
+        return self.query(
+            'SELECT l.line_name, s.* FROM spans s JOIN lines l '
+            'USING (line_id) WHERE s.bst_tag = ? OR s.ast_tag = ?',
+            (geotag, geotag))
+
+    def near(self, latitude, longitude, distance_ft, spans=False):
+        """Structures (or spans) within distance_ft of a point"""
+        d_lat = distance_ft / FEET_PER_DEGREE_LAT
+        d_lon = d_lat / max(math.cos(math.radians(latitude)), 1e-6)
+        table = 'spans' if spans else 'structures'
+
+        df = self.query(
+            'SELECT l.line_name, t.* FROM {0}_rtree r '
+            'JOIN {0} t ON t.id = r.id JOIN lines l USING (line_id) '
+            'WHERE r.max_lon >= ? AND r.min_lon <= ? '
+            'AND r.max_lat >= ? AND r.min_lat <= ?'.format(table),
+            (longitude - d_lon, longitude + d_lon,
+             latitude - d_lat, latitude + d_lat))
+
+        if spans:
+            # Distance to the segment, flat approximation
+            a = np.c_[df['bst_lon'], df['bst_lat']]
+            b = np.c_[df['ast_lon'], df['ast_lat']]
+            p = np.array([longitude, latitude])
+            ab = b - a
+            denom = np.maximum((ab ** 2).sum(axis=1), 1e-18)
+            t = np.clip(((p - a) * ab).sum(axis=1) / denom, 0, 1)
+            closest = a + ab * t[:, None]
+            df['distance_ft'] = _distance_ft(latitude, longitude,
+                                             closest[:, 1], closest[:, 0])
+        else:
+            df['distance_ft'] = _distance_ft(latitude, longitude,
+                                             df['latitude'], df['longitude'])
+
+        return df[df['distance_ft'] <= distance_ft].sort_values(
+            'distance_ft').reset_index(drop=True)
+
+    def shared_structures(self):
+        """Geotags catalogued in more than one line"""
+        return self.query(
+            'SELECT s.str_geotag, COUNT(DISTINCT s.line_id) AS n_lines, '
+            'GROUP_CONCAT(DISTINCT l.line_name) AS lines '
+            'FROM structures s JOIN lines l USING (line_id) '
+            'GROUP BY s.str_geotag HAVING COUNT(DISTINCT s.line_id) > 1 '
+            'ORDER BY n_lines DESC, s.str_geotag')
+
+    def geotag_collisions(self, n=1):
+        """Structures of different lines whose geotags differ by 1..n
+
+        These are usually the same structure with a rounding difference
+        between circuits.
+        """
+        df = self.query('SELECT s.id, l.line_name, s.str_geotag, s.structure '
+                        'FROM structures s JOIN lines l USING (line_id)')
+        if df.empty:
+            return df
+
+        hemi, lon, lat = geotag_codes(df['str_geotag'])
+        hemis = {h: i for i, h in enumerate(sorted(set(hemi)))}
+        h = np.array([hemis[x] for x in hemi], dtype=np.int64)
+        code = (h * 10 ** 9 + lon) * 10 ** 8 + lat
+
+        order = np.argsort(code, kind='stable')
+        sorted_code = code[order]
+        line = df['line_name'].to_numpy()
+
+        pairs = []
+        for d_lon, d_lat in itertools.product(range(-n, n + 1), repeat=2):
+            if (d_lon, d_lat) <= (0, 0):
+                continue  # each unordered offset once, exact handled apart
+            target = (h * 10 ** 9 + lon + d_lon) * 10 ** 8 + lat + d_lat
+            lo = np.searchsorted(sorted_code, target, 'left')
+            hi = np.searchsorted(sorted_code, target, 'right')
+            for i in np.flatnonzero(hi > lo):
+                for j in order[lo[i]:hi[i]]:
+                    if line[i] != line[j]:
+                        pairs.append((i, j))
+
+        if not pairs:
+            return pd.DataFrame(columns=['line_a', 'geotag_a', 'structure_a',
+                                         'line_b', 'geotag_b',
+                                         'structure_b'])
+
+        i, j = np.array(pairs).T
+        return pd.DataFrame({
+            'line_a': line[i], 'geotag_a': df['str_geotag'].to_numpy()[i],
+            'structure_a': df['structure'].to_numpy()[i],
+            'line_b': line[j], 'geotag_b': df['str_geotag'].to_numpy()[j],
+            'structure_b': df['structure'].to_numpy()[j]})
+
+
+def span_records(spans_fc):
+    """Read SPAN_COLUMNS from a span feature class written by xml_to_spans
+    or tower_report_to_span_shp"""
+    import arcpy
+
+    fields = {f.name.upper() for f in arcpy.ListFields(spans_fc)}
+    s_fields = [f for f in SPAN_COLUMNS if f in fields]
+    with arcpy.da.SearchCursor(spans_fc, s_fields) as cursor:
+        return [dict(zip(s_fields, row)) for row in cursor]
+
+
+def catalog_line(catalog_path, line_name, tower_report, spans_fc=None,
+                 xml_file=None, xml_tables=None):
+    """Ingest one converted line into the catalog at catalog_path
+
+    The line's design criteria tables are added to the catalog's criteria
+    library when xml_tables (see root_tables) is given.
+    """
+    if not catalog_path:
+        return None
+
+    folder = os.path.dirname(catalog_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    with StructureCatalog(catalog_path) as cat:
+        cat.ingest_tower_report(line_name, tower_report, xml_file)
+        if spans_fc:
+            cat.ingest_spans(line_name, span_records(spans_fc), xml_file)
+
+    if xml_tables:
+        from utils.criteria import CriteriaLibrary
+        with CriteriaLibrary(catalog_path) as lib:
+            lib.ingest(line_name, xml_tables, xml_file)
+
+    return catalog_path
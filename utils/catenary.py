@@ -0,0 +1,62 @@
+"""
+Purpose: Vectorized catenary geometry for wire spans
+"""
+
+import numpy as np
+
+
+def low_point_offset(span_length, dz, c):
+    """Horizontal distance from start attachment to catenary low point
+
+    Args:
+        span_length (ndarray): horizontal span lengths
+        dz (ndarray): end elevation minus start elevation
+        c (ndarray): catenary constants (H/w)
+    """
+    half = span_length / (2 * c)
+    return span_length / 2 - c * np.arcsinh(dz / (2 * c * np.sinh(half)))
+
+
+def catenary_points(start, end, c, n_points=21):
+    """Densify catenary curves for many spans at once
+
+    Args:
+        start (ndarray): (N, 3) start attachment XYZ
+        end (ndarray): (N, 3) end attachment XYZ
+        c (ndarray): (N,) catenary constants, non positive or NaN values
+            are drawn as straight chords
+        n_points (int): vertices per curve, including attachments
+
+    Returns:
+        (N, n_points, 3) array of vertices
+    """
+    start = np.asarray(start, dtype=float).reshape(-1, 3)
+    end = np.asarray(end, dtype=float).reshape(-1, 3)
+    c = np.broadcast_to(np.asarray(c, dtype=float), (len(start),)).copy()
+
+    t = np.linspace(0, 1, max(int(n_points), 2))
+    pts = start[:, None, :] + (end - start)[:, None, :] * t[None, :, None]
+
+    span_length = np.hypot(*(end - start)[:, :2].T)
+    dz = end[:, 2] - start[:, 2]
+    curved = np.isfinite(c) & (c > 0) & (span_length > 0)
+    if not curved.any():
+        return pts
+
+    L, h, cc = span_length[curved], dz[curved], c[curved]
+    s0 = low_point_offset(L, h, cc)
+    s = L[:, None] * t[None, :]
+
+    # z relative to start attachment, exact at both ends
+    z = cc[:, None] * (np.cosh((s - s0[:, None]) / cc[:, None]) -
+                       np.cosh(-s0[:, None] / cc[:, None]))
+    pts[curved, :, 2] = start[curved, 2][:, None] + z
+
+    return pts
+
+
+def mid_span_sag(points):
+    """Maximum vertical distance between chord and curve per span"""
+    chord = np.linspace(points[:, 0, 2], points[:, -1, 2],
+                        points.shape[1], axis=1)
+    return (chord - points[:, :, 2]).max(axis=1)
@@ -0,0 +1,215 @@
+"""
+Purpose: Content addressed library of PLS-CADD design criteria tables
+         (weather cases, tension, sagging, clearance criteria ...) shared
+         by every line in a catalog
+Notes: Each table is stored once under the hash of its rows, each line
+       references a criteria set (the hash of its table hashes), so lines
+       built from the same criteria file share one copy
+"""
+
+import hashlib
+import json
+import sqlite3
+import pandas as pd
+from collections import OrderedDict
+
+from utils.xml_tables import xml_table_element_dict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS criteria_tables (
+    hash TEXT PRIMARY KEY,
+    tagname TEXT NOT NULL,
+    n_rows INTEGER,
+    content TEXT);
+
+CREATE TABLE IF NOT EXISTS criteria_values (
+    hash TEXT NOT NULL REFERENCES criteria_tables(hash),
+    rownum INTEGER,
+    col TEXT,
+    value TEXT,
+    num REAL);
+CREATE INDEX IF NOT EXISTS criteria_values_text ON criteria_values(col, value);
+CREATE INDEX IF NOT EXISTS criteria_values_num ON criteria_values(col, num);
+CREATE INDEX IF NOT EXISTS criteria_values_hash ON criteria_values(hash);
+
+CREATE TABLE IF NOT EXISTS criteria_sets (
+    set_hash TEXT NOT NULL,
+    tagname TEXT NOT NULL,
+    table_hash TEXT NOT NULL REFERENCES criteria_tables(hash),
+    PRIMARY KEY (set_hash, tagname));
+CREATE INDEX IF NOT EXISTS criteria_sets_table ON criteria_sets(table_hash);
+
+CREATE TABLE IF NOT EXISTS line_criteria (
+    line_name TEXT PRIMARY KEY,
+    set_hash TEXT NOT NULL,
+    xml_file TEXT,
+    ingested TEXT DEFAULT CURRENT_TIMESTAMP);
+CREATE INDEX IF NOT EXISTS line_criteria_set ON line_criteria(set_hash);
+"""
+
+CRITERIA_TABLES = ('weather_cases',)  # plus every *_criteria table
+
+
+def is_criteria_table(tagname):
+    return tagname in CRITERIA_TABLES or tagname.endswith('_criteria')
+
+
+def criteria_tables(xml_tables):
+    """Rows of the criteria tables of an XML
+
+    Args:
+        xml_tables (dict): tagname: table element, see root_tables
+
+    Returns:
+        OrderedDict of tagname to row dicts, sorted by tagname
+    """
+    return OrderedDict(
+        (name, xml_table_element_dict(xml_tables[name], as_list=True))
+        for name in sorted(xml_tables) if is_criteria_table(name))
+
+
+def _hash(obj):
+    text = json.dumps(obj, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def table_hash(tagname, rows):
+    """Content hash of a criteria table, independent of column order"""
+    return _hash([tagname, rows])
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CriteriaLibrary(object):
+    """Criteria tables and the lines that use them
+
+    Usage:
+        with CriteriaLibrary(catalog_path) as lib:
+            lib.ingest('LINE', xml_tables)
+            lib.lines_using('weather_cases', description='GO95 Light',
+                            wind_pres=8)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    # Ingest
+    def add_table(self, tagname, rows):
+        """Store a table unless its content is already stored
+
+        Returns:
+            table hash
+        """
+        digest = table_hash(tagname, rows)
+        with self.conn:
+            cur = self.conn.execute(
+                'INSERT OR IGNORE INTO criteria_tables VALUES (?, ?, ?, ?)',
+                (digest, tagname, len(rows), json.dumps(rows)))
+            if cur.rowcount:
+                self.conn.executemany(
+                    'INSERT INTO criteria_values VALUES (?, ?, ?, ?, ?)',
+                    ((digest, i, col, value, _number(value))
+                     for i, row in enumerate(rows)
+                     for col, value in row.items()))
+        return digest
+
+    def ingest(self, line_name, xml_tables, xml_file=None):
+        """Reference a line to the criteria set of its XML
+
+        Returns:
+            criteria set hash
+        """
+        hashes = OrderedDict((name, self.add_table(name, rows)) for name, rows
+                             in criteria_tables(xml_tables).items())
+        set_hash = _hash(hashes)
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO criteria_sets VALUES (?, ?, ?)',
+                ((set_hash, name, digest) for name, digest in hashes.items()))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO line_criteria '
+                '(line_name, set_hash, xml_file) VALUES (?, ?, ?)',
+                (line_name, set_hash, xml_file))
+        return set_hash
+
+    # Queries
+    def query(self, sql, params=()):
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def sets(self):
+        """Criteria sets with the number of lines using each"""
+        return self.query(
+            'SELECT set_hash, COUNT(*) AS n_lines, GROUP_CONCAT(line_name) '
+            'AS lines FROM line_criteria GROUP BY set_hash '
+            'ORDER BY n_lines DESC')
+
+    def table(self, tagname, line_name=None, table_hash=None):
+        """A criteria table by line or hash as a DataFrame"""
+        if table_hash is None:
+            row = self.conn.execute(
+                'SELECT s.table_hash FROM line_criteria l JOIN criteria_sets '
+                's USING (set_hash) WHERE l.line_name = ? AND s.tagname = ?',
+                (line_name, tagname)).fetchone()
+            if row is None:
+                return pd.DataFrame()
+            table_hash = row[0]
+        row = self.conn.execute(
+            'SELECT content FROM criteria_tables WHERE hash = ?',
+            (table_hash,)).fetchone()
+        return pd.DataFrame(json.loads(row[0])) if row else pd.DataFrame()
+
+    def lines_using(self, tagname, **values):
+        """Lines whose criteria table has a row matching every column value
+
+        Numbers are compared numerically (8 matches '8.0'), text exactly.
+
+        Example:
+            lines_using('weather_cases', description='GO95 Light',
+                        wind_pres=8)
+
+        Returns:
+            DataFrame of line_name, set_hash, table_hash, rownum
+        """
+        where, params = [], []
+        for col, value in values.items():
+            number = _number(value)
+            if number is None:
+                where.append('(v.col = ? AND v.value = ?)')
+                params += [col, value]
+            else:
+                where.append('(v.col = ? AND v.num = ?)')
+                params += [col, number]
+
+        match = ('SELECT v.hash, v.rownum FROM criteria_values v '
+                 'JOIN criteria_tables t ON t.hash = v.hash '
+                 'WHERE t.tagname = ?')
+        if where:
+            match += ' AND ({}) GROUP BY v.hash, v.rownum ' \
+                     'HAVING COUNT(*) = {}'.format(' OR '.join(where),
+                                                   len(where))
+        else:
+            match += ' GROUP BY v.hash, v.rownum'
+        return self.query(
+            'SELECT DISTINCT l.line_name, l.set_hash, m.hash AS table_hash, '
+            'm.rownum FROM ({}) m JOIN criteria_sets s ON s.table_hash = '
+            'm.hash AND s.tagname = ? JOIN line_criteria l USING (set_hash) '
+            'ORDER BY l.line_name, m.rownum'.format(match),
+            [tagname] + params + [tagname])
@@ -76,6 +76,41 @@ def geotag_round_errors(tags, n=3):
     return conflicts, tags
 
 
+def geotag_issues(tags, names=None, n=3):
+    """Geotag QC within one line
+
+    Flags structures without a geotag, repeated geotags and geotags within
+    +/- n of another structure's (usually a rounding difference).
+
+    Args:
+        tags (list): STR_GEOTAG per structure
+        names (list): STRUCTURE per structure, for reporting
+        n (int): near duplicate tolerance in the last digit
+
+    Yields:
+        dict of STR_GEOTAG, STRUCTURE, ISSUE, OTHER_STRUCTURE
+    """
+    names = list(names) if names is not None else [None] * len(tags)
+    first = {}
+    for i, tag in enumerate(tags):
+        if tag:
+            first.setdefault(tag, i)
+
+    for i, (tag, name) in enumerate(zip(tags, names)):
+        if not tag:
+            yield {'STR_GEOTAG': tag, 'STRUCTURE': name, 'ISSUE': 'MISSING',
+                   'OTHER_STRUCTURE': None}
+            continue
+        if first[tag] != i:
+            yield {'STR_GEOTAG': tag, 'STRUCTURE': name,
+                   'ISSUE': 'DUPLICATE', 'OTHER_STRUCTURE': names[first[tag]]}
+        for other in surrounding_geotags(tag, n):
+            if other != tag and other in first:
+                yield {'STR_GEOTAG': tag, 'STRUCTURE': name,
+                       'ISSUE': 'NEAR {}'.format(other),
+                       'OTHER_STRUCTURE': names[first[other]]}
+
+
 def surrounding_span_ids(span_id, nbr_delim='+', str_delim='-', n=4,
                          union=True):
     line_nbr, span_tag = span_id.split(nbr_delim)
@@ -110,3 +145,29 @@ def surrounding_span_tags(span_tag, str_delim='-', n=1, union=True):
         return span_tags.union(flipped)
     else:
         return span_tags, flipped
+
+
+def geotag_codes(tags):
+    """Vectorized split of geotags into integer longitude/latitude codes
+
+    Args:
+        tags (iterable): geotags, e.g. 'W12253924N3807613'
+
+    Returns:
+        (hemispheres, lon_codes, lat_codes), hemispheres is the prefix and
+        suffix letters ('WN'), codes are int64 arrays, -1 where invalid
+    """
+    import numpy as np
+    import pandas as pd
+
+    parts = pd.Series(list(tags), dtype=object).astype(str).str.extract(
+        r'^([EW])(\d+)([NS])(\d+)$')
+    valid = parts[0].notna().to_numpy()
+
+    hemispheres = (parts[0].fillna('') + parts[2].fillna('')).to_numpy()
+    lon = np.full(len(parts), -1, dtype=np.int64)
+    lat = np.full(len(parts), -1, dtype=np.int64)
+    lon[valid] = parts.loc[valid, 1].astype(np.int64).to_numpy()
+    lat[valid] = parts.loc[valid, 3].astype(np.int64).to_numpy()
+
+    return hemispheres, lon, lat
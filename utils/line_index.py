@@ -0,0 +1,220 @@
+"""
+Purpose: Identify which planning line(s) an XML belongs to from structure
+         locations, using an R-tree over the planning line segments that is
+         built once per layer and cached in SQLite
+Notes: Segments are stored as longitude/latitude (WGS84) so XMLs from any
+       state plane zone can be matched
+"""
+
+import math
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+from utils.catalog import FEET_PER_DEGREE_LAT, _distance_ft
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+
+CREATE TABLE IF NOT EXISTS lines (
+    line_id INTEGER PRIMARY KEY,
+    line_name TEXT NOT NULL,
+    sap_func_l TEXT);
+CREATE INDEX IF NOT EXISTS lines_name ON lines(line_name);
+
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    line_id INTEGER NOT NULL REFERENCES lines(line_id),
+    lon1 REAL, lat1 REAL, lon2 REAL, lat2 REAL);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS segments_rtree USING rtree(
+    id, min_lon, max_lon, min_lat, max_lat);
+"""
+
+LINE_FIELDS = ['LINE_NAME', 'SAP_FUNC_L']
+
+
+def layer_signature(layer):
+    """Source path and modification time, changes when the layer is edited
+
+    File geodatabases are folders, so the newest file inside is used.
+    """
+    import arcpy
+    path = arcpy.Describe(layer).catalogPath
+    folder = path
+    while folder and not os.path.exists(folder):
+        folder = os.path.dirname(folder)
+    if os.path.isdir(folder):
+        mtime = max([os.path.getmtime(os.path.join(folder, f))
+                     for f in os.listdir(folder)] or [0])
+    else:
+        mtime = os.path.getmtime(folder) if folder else 0
+    return '{}|{:.0f}'.format(path, mtime)
+
+
+def default_cache_path(layer):
+    """Cache next to the layer's geodatabase"""
+    import arcpy
+    path = arcpy.Describe(layer).catalogPath
+    gdb = path
+    while gdb and not gdb.lower().endswith('.gdb'):
+        parent = os.path.dirname(gdb)
+        if parent == gdb:
+            gdb = path
+            break
+        gdb = parent
+    return os.path.splitext(gdb)[0] + '_line_index.sqlite'
+
+
+class LineIndex(object):
+    """R-tree of planning line segments with LINE_NAME and SAP_FUNC_L
+
+    Usage:
+        with LineIndex.for_layer(lines_lyr) as index:
+            index.identify(latitudes, longitudes)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    @classmethod
+    def for_layer(cls, layer, cache_path=None):
+        """Open the cached index of a layer, (re)building it when stale"""
+        index = cls(cache_path or default_cache_path(layer))
+        signature = layer_signature(layer)
+        if index.signature() != signature:
+            index.build(layer, signature)
+        return index
+
+    def signature(self):
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'signature'").fetchone()
+        return row[0] if row else None
+
+    def build(self, layer, signature=None):
+        """Read the layer once (as WGS84) and index every segment"""
+        import arcpy
+        with self.conn:
+            for table in ('segments_rtree', 'segments', 'lines', 'meta'):
+                self.conn.execute('DELETE FROM {}'.format(table))
+
+            line_ids = {}
+            seg_id = 0
+            with arcpy.da.SearchCursor(
+                    layer, LINE_FIELDS + ['SHAPE@'],
+                    spatial_reference=arcpy.SpatialReference(4326)) as cursor:
+                for line_name, sap_no, shape in cursor:
+                    if not line_name or shape is None:
+                        continue
+                    key = (line_name, None if sap_no is None
+                           else '{}'.format(sap_no))
+                    if key not in line_ids:
+                        line_ids[key] = self.conn.execute(
+                            'INSERT INTO lines (line_name, sap_func_l) '
+                            'VALUES (?, ?)', key).lastrowid
+
+                    rows, boxes = [], []
+                    for part in shape:
+                        pts = [(p.X, p.Y) for p in part if p is not None]
+                        for (x1, y1), (x2, y2) in zip(pts[:-1], pts[1:]):
+                            seg_id += 1
+                            rows.append((seg_id, line_ids[key],
+                                         x1, y1, x2, y2))
+                            boxes.append((seg_id, min(x1, x2), max(x1, x2),
+                                          min(y1, y2), max(y1, y2)))
+                    self.conn.executemany(
+                        'INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?)',
+                        rows)
+                    self.conn.executemany(
+                        'INSERT INTO segments_rtree VALUES (?, ?, ?, ?, ?)',
+                        boxes)
+
+            self.conn.execute("INSERT INTO meta VALUES ('signature', ?)",
+                              (signature,))
+        return self
+
+    def lines(self):
+        """OrderedDict of LINE_NAME -> SAP_FUNC_L, no layer scan"""
+        return OrderedDict(self.conn.execute(
+            'SELECT line_name, sap_func_l FROM lines '
+            'WHERE sap_func_l IS NOT NULL ORDER BY line_id'))
+
+    def nearest_lines(self, latitude, longitude, distance_ft):
+        """(line_id, distance_ft) of lines within distance_ft of a point"""
+        d_lat = distance_ft / FEET_PER_DEGREE_LAT
+        d_lon = d_lat / max(math.cos(math.radians(latitude)), 1e-6)
+        rows = self.conn.execute(
+            'SELECT s.line_id, s.lon1, s.lat1, s.lon2, s.lat2 '
+            'FROM segments_rtree r JOIN segments s ON s.id = r.id '
+            'WHERE r.max_lon >= ? AND r.min_lon <= ? '
+            'AND r.max_lat >= ? AND r.min_lat <= ?',
+            (longitude - d_lon, longitude + d_lon,
+             latitude - d_lat, latitude + d_lat)).fetchall()
+        if not rows:
+            return {}
+
+        seg = np.array(rows, dtype=float)
+        scale = math.cos(math.radians(latitude))
+        a = seg[:, 1:3] * [scale, 1]
+        ab = seg[:, 3:5] * [scale, 1] - a
+        p = np.array([longitude * scale, latitude])
+        t = np.clip(((p - a) * ab).sum(axis=1) /
+                    np.maximum((ab ** 2).sum(axis=1), 1e-18), 0, 1)
+        closest = a + ab * t[:, None]
+        dist = _distance_ft(latitude, longitude, closest[:, 1],
+                            closest[:, 0] / scale)
+
+        nearest = {}
+        for line_id, d in zip(seg[:, 0].astype(int).tolist(), dist.tolist()):
+            if d <= distance_ft and d < nearest.get(line_id, np.inf):
+                nearest[line_id] = d
+        return nearest
+
+    def identify(self, latitudes, longitudes, tolerance_ft=150.,
+                 min_fraction=0.5):
+        """Planning lines that the structures lie along
+
+        Args:
+            latitudes, longitudes: structure locations (NaN skipped)
+            tolerance_ft (float): max structure to line distance
+            min_fraction (float): share of structures a line must be near
+
+        Returns:
+            DataFrame of line_name, sap_func_l, fraction, median_ft ranked
+            best first
+        """
+        lat = np.asarray(latitudes, dtype=float)
+        lon = np.asarray(longitudes, dtype=float)
+        valid = ~(np.isnan(lat) | np.isnan(lon))
+        n = int(valid.sum())
+
+        hits = {}
+        for y, x in zip(lat[valid].tolist(), lon[valid].tolist()):
+            for line_id, d in self.nearest_lines(y, x, tolerance_ft).items():
+                hits.setdefault(line_id, []).append(d)
+
+        columns = ['line_name', 'sap_func_l', 'fraction', 'median_ft']
+        if not hits or not n:
+            return pd.DataFrame(columns=columns)
+
+        names = dict((i, (name, sap)) for i, name, sap in self.conn.execute(
+            'SELECT line_id, line_name, sap_func_l FROM lines'))
+        df = pd.DataFrame(
+            [names[i] + (len(d) / n, float(np.median(d)))
+             for i, d in hits.items()], columns=columns)
+        df = df[df['fraction'] >= min_fraction]
+        return df.sort_values(['fraction', 'median_ft'],
+                              ascending=[False, True]).reset_index(drop=True)
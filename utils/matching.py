@@ -0,0 +1,123 @@
+"""
+Batch structure-name matching for OH conductor reconciliation
+"""
+
+import numpy as np
+
+EXACT = 1.4
+SUBSTRING = 1.3
+SUFFIX = 1.2
+SUFFIX_SUBSTRING = 1.1
+
+
+def _contains(a, b):
+    """Element-wise `b in a` over broadcast string arrays"""
+    return np.char.find(a, b) >= 0
+
+
+def _slash_part(s):
+    """Second '/'-separated part of each string (str.split('/')[1])"""
+    tail = np.char.partition(s, '/')[..., 2]
+    return np.char.partition(tail, '/')[..., 0]
+
+
+def _char_sets(strings, alphabet):
+    """Boolean (N, len(alphabet)) character presence matrix"""
+    index = {c: i for i, c in enumerate(alphabet)}
+    sets = np.zeros((len(strings), len(alphabet)), dtype=np.int32)
+    for i, s in enumerate(strings):
+        sets[i, [index[c] for c in set(s)]] = 1
+    return sets
+
+
+def similarity_matrix(names, candidates):
+    """Score every name against every candidate in one step
+
+    Scores are tiered: exact 1.4, substring 1.3, equal '/' suffix 1.2,
+    '/' suffix substring 1.1, then the character-set Jaccard ratio.
+
+    Args:
+        names (list): record structure names (rows)
+        candidates (list): structure/section names to match against (columns)
+
+    Returns:
+        (len(names), len(candidates)) float array
+    """
+    a = np.array([f'{n}' for n in names], dtype=str)[:, None]
+    b = np.array([f'{c}' for c in candidates], dtype=str)[None, :]
+    if a.size == 0 or b.size == 0:
+        return np.zeros((a.shape[0], b.shape[1]))
+
+    alphabet = sorted(set(''.join(a.ravel())) | set(''.join(b.ravel())))
+    sa = _char_sets(a.ravel(), alphabet)
+    sb = _char_sets(b.ravel(), alphabet)
+    common = sa @ sb.T
+    union = sa.sum(axis=1)[:, None] + sb.sum(axis=1)[None, :] - common
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = np.where(union > 0, common / union, 0.)
+
+    a_part, b_part = _slash_part(a), _slash_part(b)
+    slashes = _contains(a, '/') & _contains(b, '/')
+    part_sub = _contains(a_part, b_part) | _contains(b_part, a_part)
+    scores = np.select(
+        [a == b,
+         _contains(a, b) | _contains(b, a),
+         slashes & (a_part == b_part),
+         slashes & part_sub],
+        [EXACT, SUBSTRING, SUFFIX, SUFFIX_SUBSTRING], scores)
+    return scores
+
+
+def _align(scores):
+    """Max-weight monotonic one-to-one alignment of rows to columns"""
+    n_rows, n_cols = scores.shape
+    total = np.zeros((n_rows + 1, n_cols + 1))
+    for i in range(1, n_rows + 1):
+        prev = total[i - 1]
+        step = np.maximum(prev[1:], prev[:-1] + scores[i - 1])
+        total[i, 1:] = np.maximum.accumulate(step)
+
+    matches = np.full(n_rows, -1, dtype=np.int64)
+    i, j = n_rows, n_cols
+    while i > 0 and j > 0:
+        if total[i, j] == total[i - 1, j - 1] + scores[i - 1, j - 1] \
+                and np.isfinite(scores[i - 1, j - 1]):
+            matches[i - 1] = j - 1
+            i, j = i - 1, j - 1
+        elif total[i, j] == total[i - 1, j]:
+            i -= 1
+        else:
+            j -= 1
+    return matches, total[-1, -1]
+
+
+def ordered_assignment(scores, min_score=0., allow_reverse=True):
+    """Assign each row to at most one column, keeping order along the line
+
+    Solves the maximum total score matching in which no two rows share a
+    column and row order follows column order. Pairs scoring at or below
+    min_score are never matched. With allow_reverse the columns may also
+    run in the opposite direction (line digitised the other way); the
+    better of the two directions wins.
+
+    Args:
+        scores (array): (rows, columns) similarity matrix
+        min_score (float): pairs must score above this to match
+        allow_reverse (bool): also try the reversed column order
+
+    Returns:
+        int array of matched column per row (-1 where unmatched)
+    """
+    scores = np.asarray(scores, dtype=float)
+    scores = np.where(scores > min_score, scores, -np.inf)
+    if scores.size == 0:
+        return np.full(scores.shape[0], -1, dtype=np.int64)
+
+    matches, total = _align(scores)
+    if allow_reverse:
+        rev_matches, rev_total = _align(scores[:, ::-1])
+        if rev_total > total:
+            n_cols = scores.shape[1]
+            matches = np.where(rev_matches >= 0,
+                               n_cols - 1 - rev_matches, -1)
+    return matches
@@ -1,17 +1,67 @@
-import arcpy
+try:
+    import arcpy
+except ImportError:  # headless, see xmltool.py
+    arcpy = None
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+def _captured(level, msg):
+    """Buffer the message if this thread is capturing, see
+    captured_messages"""
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is None:
+        return False
+    buffer.append((level, msg))
+    return True
 
 
 def add_message(msg):
-    arcpy.AddMessage(msg)
+    if _captured('message', msg):
+        return
+    if arcpy:
+        arcpy.AddMessage(msg)
     print(msg)
 
 
 def add_warning(msg):
-    arcpy.AddWarning(msg)
+    if _captured('warning', msg):
+        return
+    if arcpy:
+        arcpy.AddWarning(msg)
     print(msg)
 
 
 def add_error(msg):
-    arcpy.AddError(msg)
+    if _captured('error', msg):
+        return
+    if arcpy:
+        arcpy.AddError(msg)
     print(msg)
 
+
+@contextmanager
+def captured_messages():
+    """Collect this thread's messages instead of sending them to arcpy
+
+    Background threads use this so arcpy is only called from the main
+    thread, which sends the list on with replay_messages.
+
+    Yields:
+        list of (level, message)
+    """
+    previous = getattr(_local, 'buffer', None)
+    _local.buffer = []
+    try:
+        yield _local.buffer
+    finally:
+        _local.buffer = previous
+
+
+def replay_messages(messages):
+    levels = {'message': add_message, 'warning': add_warning,
+              'error': add_error}
+    for level, msg in messages:
+        levels[level](msg)
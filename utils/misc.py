@@ -1,7 +1,17 @@
-import arcpy
+try:
+    import arcpy
+except ImportError:  # headless, see xmltool.py
+    arcpy = None
+import fnmatch
+import json
+import numpy as np
 import os
+import queue
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.messages import add_warning
 
 
 class Timer:
@@ -37,47 +47,226 @@ def safe_name(s, upper=True):
     return s
 
 # File/folder functions
-def find_files(search_directory, search_str=None, ext=None, recursive=True):
-    if not recursive:
-        _files = [os.path.join(search_directory, _file)
-                  for _file in os.listdir(search_directory)
-                  if search_str.lower() in _file.lower()]
-
-        if ext:
-            _files = [f for f in _files if f.endswith(ext)]
-
-        return _files
-
-    file_list = []
-    if os.path.exists(search_directory):
-        for root, dirs, files in os.walk(search_directory):
-            for _file in files:
-                if search_str and search_str.lower() not in _file.lower():
-                    continue
+def compile_name_filter(search_str=None, ext=None, pattern=None, regex=None):
+    """Build a single filename predicate, compiling every filter once
+
+    Args:
+        search_str (str): case-insensitive substring
+        ext (str or list): extension(s), with or without leading '.'
+        pattern (str or list): glob pattern(s), e.g. '*_SHAPES.gdb'
+        regex (str or compiled pattern): regular expression (re.search)
+    """
+    search_str = search_str.lower() if search_str else None
+    exts = {e.replace('.', '') for e in ensure_iterable(ext)}
+    globs = [re.compile(fnmatch.translate(p), flags=re.IGNORECASE)
+             for p in ensure_iterable(pattern)]
+    if isinstance(regex, str):
+        regex = re.compile(regex)
+
+    def _match(name):
+        if search_str and search_str not in name.lower():
+            return False
+        if exts and os.path.splitext(name)[1].replace('.', '') not in exts:
+            return False
+        if globs and not any(g.match(name) for g in globs):
+            return False
+        if regex and not regex.search(name):
+            return False
+        return True
 
-                if ext and os.path.splitext(_file)[1].replace('.', '') \
-                        != ext.replace('.', ''):
+    return _match
+
+
+def _scan_dir(path, cache=None):
+    """Return (files, dirs) names for a single directory
+
+    Uses the cached listing if the directory modified time is unchanged"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return [], []
+
+    if cache is not None:
+        cached = cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                    else:
+                        files.append(entry.name)
+                except OSError:
                     continue
+    except OSError:
+        return [], []
+
+    if cache is not None:
+        cache[path] = (mtime, files, dirs)
+
+    return files, dirs
+
+
+# Directories one scanning task walks before handing the rest back
+SCAN_BATCH = 256
+
+
+def _scan_batch(paths, cache=None, recursive=True, limit=SCAN_BATCH):
+    """Walk paths depth first, up to limit directories
+
+    Returns:
+        ([(path, files, dirs), ...], directories left to scan)
+    """
+    stack, listings = paths[::-1], []
+    while stack and len(listings) < limit:
+        path = stack.pop()
+        files, dirs = _scan_dir(path, cache)
+        listings.append((path, files, dirs))
+        if recursive:
+            stack.extend(os.path.join(path, d) for d in reversed(dirs))
+    return listings, stack[::-1]
+
+
+def load_scan_cache(cache_file):
+    """Load directory listings cached by a previous scan_directory run"""
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r') as f:
+            return {k: tuple(v) for k, v in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_scan_cache(cache, cache_file):
+    with open(cache_file, 'w') as f:
+        json.dump(cache, f)
+
+
+def scan_directory(search_directory, search_str=None, ext=None, pattern=None,
+                   regex=None, recursive=True, dirs=False, workers=8,
+                   cache_file=None):
+    """Generator of matching paths, subtrees are scanned on a thread pool
+
+    Each task walks up to SCAN_BATCH directories, what is left is split
+    between the idle threads. Paths come in completion order, see
+    find_files for a sorted list.
+
+    Args:
+        search_directory (str): root folder
+        search_str, ext, pattern, regex: see compile_name_filter
+        recursive (bool): descend into sub folders
+        dirs (bool): yield matching folders rather than files
+        workers (int): number of scanning threads
+        cache_file (str): optional json file of directory listings, only
+            directories modified since the last run are rescanned
+    """
+    if not os.path.isdir(search_directory):
+        return
+
+    match = compile_name_filter(search_str, ext, pattern, regex)
+    cache = load_scan_cache(cache_file) if cache_file else None
+
+    workers = max(1, int(workers))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    finished = queue.Queue()
+
+    def submit(paths):
+        executor.submit(_scan_batch, paths, cache, recursive
+                        ).add_done_callback(finished.put)
+
+    try:
+        submit([search_directory])
+        running = 1
+        while running:
+            # Drain every finished task at once
+            done = [finished.get()]
+            while True:
+                try:
+                    done.append(finished.get_nowait())
+                except queue.Empty:
+                    break
+            running -= len(done)
+
+            for future in done:
+                listings, rest = future.result()
+                for root, _files, _dirs in listings:
+                    for name in (_dirs if dirs else _files):
+                        if match(name):
+                            yield os.path.join(root, name)
+
+                # Leftover directories are shared between the idle threads
+                parts = max(1, min(len(rest), workers - running))
+                for i in range(parts if rest else 0):
+                    submit(rest[i::parts])
+                    running += 1
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    # Only persisted when the walk was fully consumed
+    if cache_file:
+        save_scan_cache(cache, cache_file)
 
-                file_list.append(os.path.join(root, _file))
 
-    return file_list
+def find_files(search_directory, search_str=None, ext=None, recursive=True):
+    return sorted(scan_directory(search_directory, search_str=search_str,
+                                 ext=ext, recursive=recursive))
 
 
 def find_dirs(search_directory, search_str):
-    dir_list = []
-    if os.path.exists(search_directory):
-        for root, dirs, files in os.walk(search_directory):
-            for _dir in dirs:
-                if search_str.lower() in _dir.lower():
-                    dir_list.append(os.path.join(root, _dir))
-    return dir_list
+    return sorted(scan_directory(search_directory, search_str=search_str,
+                                 dirs=True))
 
 
 def count_records(fc_or_lyr):
     return int(arcpy.GetCount_management(fc_or_lyr)[0])
 
 
+def add_indexes(fc, fields=(), spatial=True):
+    """Add attribute indexes and (re)build the spatial index of a feature
+    class. Call once the rows are loaded, so inserts do not maintain the
+    indexes and the spatial grid is sized from the loaded features.
+
+    Args:
+        fc: feature class (shapefile or geodatabase)
+        fields (list): fields to index individually, missing or already
+            indexed fields are skipped
+        spatial (bool): add or rebuild the spatial index
+
+    Returns:
+        list of fields indexed
+    """
+    if str(fc).lower().startswith(('in_memory', 'memory')):
+        return []
+
+    existing = {f.name.upper(): f.name for f in arcpy.ListFields(fc)}
+    indexed = {i.fields[0].name.upper() for i in arcpy.ListIndexes(fc)
+               if len(i.fields) == 1}
+    added = []
+    for field in fields:
+        if field.upper() not in existing or field.upper() in indexed:
+            continue
+        try:
+            arcpy.AddIndex_management(fc, [existing[field.upper()]],
+                                      'IDX_{}'.format(field.upper()))
+            added.append(field)
+        except arcpy.ExecuteError as e:
+            add_warning('\n    - WARNING: Could not index {} of {}, '
+                        '{}'.format(field, os.path.basename(fc), e))
+
+    if spatial:
+        try:
+            arcpy.AddSpatialIndex_management(fc)
+        except arcpy.ExecuteError as e:
+            add_warning('\n    - WARNING: Could not add spatial index '
+                        'to {}, {}'.format(os.path.basename(fc), e))
+    return added
+
+
 def approximate_match_value(key, dict1, dict2, margin=0.05, abs_val=1):
     """Determine Whether or Not Value Associated with Key Approximately Match:
     margin: relative percent change allowed (0.05 = 5%)
@@ -107,6 +296,29 @@ def approximate_match_value(key, dict1, dict2, margin=0.05, abs_val=1):
         return False
 
 
+def approximate_match_array(a1, a2, margin=0.05, abs_val=1):
+    """Vectorized approximate_match_value for equal length arrays, returns
+    boolean array. NaN compared to NaN is treated as a match."""
+    d1 = np.asarray(a1, dtype=float)
+    d2 = np.asarray(a2, dtype=float)
+
+    diff = np.abs(d2 - d1)
+    m1 = np.abs(margin * d1)
+    m2 = np.abs(margin * d2)
+
+    with np.errstate(invalid='ignore'):
+        result = np.select(
+            [diff == 0,
+             diff > abs_val,
+             (diff < abs_val) & (m1 < abs_val) & (m2 < abs_val),
+             (diff > m1) | (diff > m2),
+             diff < abs_val],
+            [True, False, True, False, True], default=False)
+
+    both_nan = np.isnan(d1) & np.isnan(d2)
+    return result.astype(bool) | both_nan
+
+
 # DXF
 DXF_UNITS = """\
 $INSUNITS
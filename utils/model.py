@@ -0,0 +1,411 @@
+"""
+Purpose: Compact records for structures, sections, attachments and
+         conductor records parsed from PLS-CADD XML and ArcGIS tables
+Notes: Bulk tables are structured numpy arrays addressed by integer keys,
+       small tables are __slots__ records
+"""
+
+import numpy as np
+from collections import OrderedDict
+
+from utils.geotagging import calc_geotag
+
+STRUCTURE_DTYPE = np.dtype([('number', 'i4'),
+                            ('geotag', 'U17'),
+                            ('x', 'f8'), ('y', 'f8'), ('z', 'f8'),
+                            ('height', 'f8'),
+                            ('latitude', 'f8'), ('longitude', 'f8'),
+                            ('station', 'f8'), ('offset', 'f8'),
+                            ('name', 'O')])  # comment text, any length
+
+ATTACHMENT_DTYPE = np.dtype([('structure', 'i4'),
+                             ('set_no', 'i2'), ('phase_no', 'i2'),
+                             ('section', 'i4'),
+                             ('wire_x', 'f8'), ('wire_y', 'f8'),
+                             ('wire_z', 'f8'),
+                             ('ins_x', 'f8'), ('ins_y', 'f8'),
+                             ('ins_z', 'f8'),
+                             ('length', 'f8')])
+
+SPAN_WIRE_DTYPE = np.dtype([('section', 'i4'), ('wire', 'i2'),
+                            ('bst_row', 'i4'), ('ast_row', 'i4'),
+                            ('bst', 'i4'), ('bst_set', 'i2'),
+                            ('bst_phase', 'i2'),
+                            ('ast', 'i4'), ('ast_set', 'i2'),
+                            ('ast_phase', 'i2'),
+                            ('span', 'i4'),
+                            ('bst_att', 'i8'), ('ast_att', 'i8')])
+
+
+def _float(row, *keys):
+    for k in keys:
+        v = row.get(k)
+        if v not in (None, ''):
+            return float(v)
+    return np.nan
+
+
+def _int(v, default=0):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return default
+
+
+# Resolution cost of a stringing row without an attachment at the hub
+MISSING_ATTACHMENT = 1e9
+
+
+class StructureTable(object):
+    """Structures as a structured array plus structure_number lookup
+
+    PLS-CADD allows one structure number on several hubs, keys holds the
+    last row and duplicates every row of such numbers. Rows referencing a
+    structure by number are resolved with nearest or resolve.
+    """
+    __slots__ = ('data', 'keys', 'duplicates')
+
+    def __init__(self, data, keys, duplicates=None):
+        self.data = data
+        self.keys = keys  # structure_number (xml text): row index
+        self.duplicates = duplicates or {}  # structure_number: row indices
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, structure_number):
+        return self.data[self.keys[structure_number]]
+
+    def index(self, structure_number):
+        return self.keys[structure_number]
+
+    def numbers(self):
+        """structure_number (xml text) of each row"""
+        numbers = np.empty(len(self.data), dtype=object)
+        for number, i in self.keys.items():
+            numbers[i] = number
+        for number, rows in self.duplicates.items():
+            numbers[rows] = number
+        return numbers
+
+    def nearest(self, structure_number, x, y):
+        """Row of the structure numbered structure_number nearest to x, y"""
+        rows = self.duplicates.get(structure_number)
+        if rows is None:
+            return self.keys[structure_number]
+        dist = np.hypot(self.data['x'][rows] - x, self.data['y'][rows] - y)
+        if not np.isfinite(dist).any():
+            return self.keys[structure_number]
+        return rows[int(np.nanargmin(dist))]
+
+    def resolve(self, rows, attachments=None):
+        """Structure row of each section_stringing_data row
+
+        Duplicated structure numbers are resolved within their section:
+        hubs holding an attachment of the row's set and section first,
+        then the shortest path through the section.
+
+        Args:
+            rows (list): section_stringing_data dicts, in order
+            attachments (AttachmentTable): built with this table
+
+        Returns:
+            int64 array, one row index per stringing row
+        """
+        index = np.array([self.keys[r['struct_number']] for r in rows],
+                         dtype=np.int64)
+        if not self.duplicates:
+            return index
+
+        attached = set()
+        if attachments is not None:
+            d = attachments.data
+            attached = set(zip(d['structure'].tolist(), d['set_no'].tolist(),
+                               d['section'].tolist()))
+
+        sections = OrderedDict()
+        for i, row in enumerate(rows):
+            sections.setdefault(row['section_number'], []).append(i)
+
+        x, y = self.data['x'], self.data['y']
+        for sect, idx in sections.items():
+            candidates = [self.duplicates.get(rows[i]['struct_number'],
+                                              [index[i]]) for i in idx]
+            if all(len(c) == 1 for c in candidates):
+                continue
+
+            # Shortest path through the candidate hubs of each row
+            cost, back, prev = None, [], None
+            for i, cand in zip(idx, candidates):
+                key = (_int(rows[i]['set_number']), _int(sect))
+                node = np.array([MISSING_ATTACHMENT *
+                                 ((h,) + key not in attached) for h in cand])
+                if cost is None:
+                    cost = node
+                    back.append(None)
+                else:
+                    step = cost[:, None] + np.nan_to_num(np.hypot(
+                        x[prev][:, None] - x[cand][None, :],
+                        y[prev][:, None] - y[cand][None, :]))
+                    best = step.argmin(axis=0)
+                    cost = step[best, np.arange(len(cand))] + node
+                    back.append(best)
+                prev = cand
+
+            j = int(cost.argmin())
+            for k in range(len(idx) - 1, -1, -1):
+                index[idx[k]] = candidates[k][j]
+                if back[k] is not None:
+                    j = int(back[k][j])
+
+        return index
+
+    @classmethod
+    def from_xml(cls, rows, name_key='structure_comment_1'):
+        """Build from construction_staking_report or structure_coordinates
+        rows (dicts from xml_table_element_dict), in the given order.
+
+        Non numeric structure numbers are numbered after the largest
+        numeric one, in order of first appearance, so they never collide
+        with a real structure number.
+        """
+        data = np.zeros(len(rows), dtype=STRUCTURE_DTYPE)
+        keys, duplicates = {}, {}
+        numbers = [row.get('structure_number', row.get('struct_number'))
+                   for row in rows]
+        numeric = [_int(n, None) for n in numbers]
+        substitutes = {}
+        next_number = max([n for n in numeric if n is not None] + [0]) + 1
+        for number, value in zip(numbers, numeric):
+            if value is None and number not in substitutes:
+                substitutes[number] = next_number
+                next_number += 1
+
+        for i, row in enumerate(rows):
+            number = numbers[i]
+            if number in keys:
+                duplicates.setdefault(number, [keys[number]]).append(i)
+            keys[number] = i
+
+            lat = _float(row, 'latitude')
+            lon = _float(row, 'longitude')
+            data[i] = (substitutes.get(number, numeric[i]),
+                       calc_geotag(lat, lon)
+                       if np.isfinite(lat) and np.isfinite(lon) else '',
+                       _float(row, 'x_easting', 'x'),
+                       _float(row, 'y_northing', 'y'),
+                       _float(row, 'z_elevation', 'z'),
+                       _float(row, 'structure_height_or_pole_length',
+                              'structure_height'),
+                       lat, lon,
+                       _float(row, 'station'), _float(row, 'offset'),
+                       row.get(name_key) or '')
+
+        return cls(data, keys, duplicates)
+
+
+class AttachmentTable(object):
+    """Attachment points sorted by integer (structure, set, phase) key"""
+    __slots__ = ('data', 'codes')
+
+    def __init__(self, data):
+        self.codes = self.encode(data['structure'], data['set_no'],
+                                 data['phase_no'])
+        order = np.argsort(self.codes, kind='stable')
+        self.data = data[order]
+        self.codes = self.codes[order]
+
+    def __len__(self):
+        return len(self.data)
+
+    @staticmethod
+    def encode(structure, set_no, phase_no):
+        return (np.asarray(structure, dtype=np.int64) << 32) | \
+               (np.asarray(set_no, dtype=np.int64) << 16) | \
+               np.asarray(phase_no, dtype=np.int64)
+
+    def lookup(self, structure, set_no, phase_no):
+        """Row positions for key arrays, -1 where not found"""
+        codes = self.encode(structure, set_no, phase_no)
+        pos = np.searchsorted(self.codes, codes)
+        pos = np.minimum(pos, max(len(self.codes) - 1, 0))
+        found = len(self.codes) > 0 and self.codes[pos] == codes
+        return np.where(found, pos, -1)
+
+    @classmethod
+    def from_xml(cls, rows, structures):
+        """Build from structure_attachment_coordinates rows
+
+        Duplicated structure numbers go to the nearest hub.
+
+        Args:
+            rows (list): dicts from xml_table_element_dict
+            structures (StructureTable): provides structure row index
+        """
+        data = np.zeros(len(rows), dtype=ATTACHMENT_DTYPE)
+        for i, row in enumerate(rows):
+            x = _float(row, 'wire_attach_point_x')
+            y = _float(row, 'wire_attach_point_y')
+            data[i] = (structures.nearest(row['struct_number'], x, y),
+                       _int(row['set_no']), _int(row['phase_no']),
+                       _int(row.get('section_number')),
+                       x, y,
+                       _float(row, 'wire_attach_point_z'),
+                       _float(row, 'insulator_attach_point_x'),
+                       _float(row, 'insulator_attach_point_y'),
+                       _float(row, 'insulator_attach_point_z'),
+                       0)
+
+        data['length'] = np.sqrt(
+            (data['ins_x'] - data['wire_x']) ** 2 +
+            (data['ins_y'] - data['wire_y']) ** 2 +
+            (data['ins_z'] - data['wire_z']) ** 2)
+
+        return cls(data)
+
+    def wire_xyz(self, pos):
+        d = self.data[pos]
+        return np.column_stack([d['wire_x'], d['wire_y'], d['wire_z']])
+
+
+class SpanWireTable(object):
+    """Every strung wire keyed by section, set and phase at both ends
+
+    Each section in section_stringing_data is walked in order, wire k runs
+    from phase int(phasing[k]) of one set to the next structure's set.
+    bst_row/ast_row are the stringing rows of both ends, span the
+    LineTopology span and bst_att/ast_att the AttachmentTable rows (-1
+    when not known).
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    @classmethod
+    def from_xml(cls, rows, structures, topology=None, attachments=None):
+        """Build from section_stringing_data rows
+
+        Args:
+            rows (list): section_stringing_data dicts, in order
+            structures (StructureTable): provides structure row index
+            topology (LineTopology): fills span
+            attachments (AttachmentTable): fills bst_att and ast_att
+        """
+        index = structures.resolve(rows, attachments).tolist()
+        sections = {}
+        for i, row in enumerate(rows):
+            sections.setdefault(row['section_number'], []).append(i)
+
+        wires = []
+        for sect, idx in sections.items():
+            for b, a in zip(idx[:-1], idx[1:]):
+                b_row, a_row = rows[b], rows[a]
+                bst, ast = index[b], index[a]
+                span = topology.span(bst, ast) if topology else None
+                for wire, (b_ph, a_ph) in enumerate(
+                        zip(b_row['phasing'] or '', a_row['phasing'] or '')):
+                    wires.append((int(sect), wire + 1, b, a,
+                                  bst, int(b_row['set_number']), int(b_ph),
+                                  ast, int(a_row['set_number']), int(a_ph),
+                                  -1 if span is None else span, -1, -1))
+
+        data = np.array(wires, dtype=SPAN_WIRE_DTYPE)
+        if attachments is not None:
+            data['bst_att'] = attachments.lookup(
+                data['bst'], data['bst_set'], data['bst_phase'])
+            data['ast_att'] = attachments.lookup(
+                data['ast'], data['ast_set'], data['ast_phase'])
+        return cls(data)
+
+    def attached(self):
+        """Boolean mask of wires with attachments at both ends"""
+        return (self.data['bst_att'] >= 0) & (self.data['ast_att'] >= 0)
+
+    def span_mismatch(self, structures, attachments):
+        """Attachment to attachment minus hub to hub span length (ft), NaN
+        where not attached"""
+        d = self.data
+        found = self.attached()
+        hubs = structures.data
+        hub_span = np.hypot(hubs['x'][d['ast']] - hubs['x'][d['bst']],
+                            hubs['y'][d['ast']] - hubs['y'][d['bst']])
+        att = attachments.data
+        b = np.where(found, d['bst_att'], 0)
+        a = np.where(found, d['ast_att'], 0)
+        att_span = np.hypot(att['wire_x'][a] - att['wire_x'][b],
+                            att['wire_y'][a] - att['wire_y'][b])
+        return np.where(found, att_span - hub_span, np.nan)
+
+    def circuits(self):
+        """Group wires into circuit spans, one per section, back set and
+        ahead set of a span, in stringing order
+
+        Returns:
+            (first, group), first wire of each circuit span and the
+            circuit span of each wire
+        """
+        d = self.data
+        if not len(d):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        keys = np.column_stack([d['section'], d['bst'], d['bst_set'],
+                                d['ast'], d['ast_set']])
+        _, first, group = np.unique(keys, axis=0, return_index=True,
+                                    return_inverse=True)
+        order = np.argsort(first, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        return first[order], rank[group.reshape(-1)]
+
+
+class Section(object):
+    """section_geometry_data row"""
+    __slots__ = ('sec_no', 'from_str', 'to_str', 'phases', 'wires_per_phase',
+                 'cable_file', 'notes')
+
+    def __init__(self, sec_no, from_str, to_str, phases, wires_per_phase,
+                 cable_file, notes):
+        self.sec_no = sec_no
+        self.from_str = from_str
+        self.to_str = to_str
+        self.phases = phases
+        self.wires_per_phase = wires_per_phase
+        self.cable_file = cable_file
+        self.notes = notes
+
+    @property
+    def total_wires(self):
+        return self.phases * self.wires_per_phase
+
+    @classmethod
+    def from_xml(cls, row):
+        return cls(_int(row['sec_no']), row['from_str'], row['to_str'],
+                   _int(row['number_of_phases']),
+                   _int(row['wires_per_phase']),
+                   row['cable_file_name'], row['sec_notes'])
+
+
+class ConductorRecord(object):
+    """OH conductor table record and its best structure/section match"""
+    __slots__ = ('sap_func_loc_no', 'conductor_type', 'conductor_size',
+                 'conductor_strand', 'from_structure', 'to_structure',
+                 'best_match', 'best_match_percent')
+
+    def __init__(self, sap_func_loc_no, conductor_type, conductor_size,
+                 conductor_strand, from_structure, to_structure):
+        self.sap_func_loc_no = sap_func_loc_no
+        self.conductor_type = conductor_type
+        self.conductor_size = conductor_size
+        self.conductor_strand = conductor_strand
+        self.from_structure = from_structure
+        self.to_structure = to_structure
+        self.best_match = 0
+        self.best_match_percent = 0
+
+    @property
+    def wire(self):
+        return '{} {}{}'.format(self.conductor_type, self.conductor_size,
+                                self.conductor_strand)
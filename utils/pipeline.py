@@ -0,0 +1,74 @@
+"""
+Overlap preparing the next input (parse, validation, geometry) with writing
+the current one
+Notes: arcpy is not thread safe, so only the consumer (main) thread writes.
+       The preparing thread must not call arcpy, its messages are buffered
+       and replayed on the main thread (see utils.messages)
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from utils.messages import captured_messages, replay_messages
+
+
+def _prepare(func, item):
+    with captured_messages() as messages:
+        try:
+            return func(item), None, messages
+        except Exception as e:
+            return None, e, messages
+
+
+def prefetch(func, items, depth=1, stop=None, check=None, interval=0.5):
+    """Yield func(item) for each item, preparing the next ones in the
+    background while the caller works on the current one
+
+    At most depth items are prepared ahead of the one being consumed
+    (bounded queue), so at most depth + 1 results are held in memory.
+    Errors raised by func are yielded, not raised, so the caller handles
+    them in order with the rest of its per item errors.
+
+    Args:
+        func (callable): prepare one item, must not call arcpy
+        items (iterable): inputs, in processing order
+        depth (int): items prepared ahead, at least 1
+        stop (threading.Event): set when the consumer stops early, pass it
+            to func (e.g. through BackgroundProgress) so work in flight
+            can be abandoned
+        check (callable): called on this thread every interval seconds
+            while waiting on an item, e.g. Progress.check to raise
+            Cancelled
+
+    Yields:
+        (item, result, error), error is None on success
+    """
+    items = iter(items)
+    stop = stop if stop is not None else threading.Event()
+    pending = deque()
+    pool = ThreadPoolExecutor(max_workers=1,
+                              thread_name_prefix='prefetch')
+
+    def submit_next():
+        for item in items:
+            pending.append((item, pool.submit(_prepare, func, item)))
+            return
+
+    try:
+        for _ in range(max(int(depth), 1)):
+            submit_next()
+        while pending:
+            item, future = pending.popleft()
+            while check is not None and \
+                    not wait([future], timeout=interval).done:
+                check()
+            result, error, messages = future.result()
+            submit_next()
+            replay_messages(messages)
+            yield item, result, error
+    finally:
+        stop.set()
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
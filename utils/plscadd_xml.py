@@ -1,17 +1,36 @@
-import arcpy
+try:
+    import arcpy
+except ImportError:  # headless, see xmltool.py
+    arcpy = None
+import bz2
 import csv
+import gzip
+import lzma
 import os
+import re
+import zipfile
 import numpy as np
 import pandas as pd
 from collections import OrderedDict
-from utils.geotagging import calc_geotag
+from contextlib import ExitStack, contextmanager
+from utils.blowout import write_blowout
+from utils.catenary import catenary_points, mid_span_sag
+from utils.messages import add_warning
+from utils.misc import add_indexes, scan_directory
+from utils.model import (AttachmentTable, Section, SpanWireTable,
+                         StructureTable)
+from utils.progress import ProgressFile
+from utils.state_plane import fill_lat_lon
+from utils.topology import LineTopology
+from utils.xml_tables import ParsedXml, parallel_xml, xml_table_element_dict
 
 try:
     import xml.etree.cElementTree as et
 except ImportError:
     import xml.etree.ElementTree as et
 
-arcpy.env.overwriteOutput = True
+if arcpy:
+    arcpy.env.overwriteOutput = True
 
 # Fields to be written
 TOWER_REPORT_FIELDS = ['QSI_TOWER', 'STRUCTURE', 'X', 'Y', 'Z1', 'Z2', 'H',
@@ -31,15 +50,16 @@ ATTACHMENT_FIELD_TYPES = {'SET_NO': 'LONG', 'PHASE': 'LONG',
                           'INS_X': 'DOUBLE', 'INS_Y': 'DOUBLE',
                           'INS_Z': 'DOUBLE'}
 
-ATTACHMENT_XML_FIELD_MAP = {'SECTION': 'section',
-                            'SET_NO': 'set_no',
-                            'PHASE': 'phase_no',
-                            'LENGTH': 'length', 'COND_X': 'wire_attachment_x',
-                            'COND_Y': 'wire_attachment_y',
-                            'COND_Z': 'wire_attachment_z',
-                            'INS_X': 'insulator_attachment_x',
-                            'INS_Y': 'insulator_attachment_y',
-                            'INS_Z': 'insulator_attachment_z'}
+# ATTACHMENT_FIELDS: utils.model.ATTACHMENT_DTYPE field
+ATTACHMENT_ARRAY_FIELD_MAP = {'SET_NO': 'set_no',
+                              'PHASE': 'phase_no',
+                              'LENGTH': 'length',
+                              'COND_X': 'wire_x',
+                              'COND_Y': 'wire_y',
+                              'COND_Z': 'wire_z',
+                              'INS_X': 'ins_x',
+                              'INS_Y': 'ins_y',
+                              'INS_Z': 'ins_z'}
 
 SPAN_FIELDS = ['SN', 'SECTION',
                'BST', 'BST_TAG', 'BST_ID', 'BST_STATION', 'BST_OFFSET',
@@ -67,6 +87,68 @@ SPAN_FIELD_TYPES = {'SN': 'SHORT',
                     'WIRES_TOTAL': 'SHORT',
                     'CABLE_FILE': 'TEXT'}
 
+WIRE_FIELDS = ['SECTION', 'WIRE', 'BST', 'BST_SET', 'BST_PHASE',
+               'AST', 'AST_SET', 'AST_PHASE', 'CABLE_FILE', 'CATENARY',
+               'SPAN_LGTH', 'SAG', 'SHAPE@']
+
+WIRE_FIELD_TYPES = {'SECTION': 'SHORT',
+                    'WIRE': 'SHORT',
+                    'BST': 'TEXT',
+                    'BST_SET': 'SHORT',
+                    'BST_PHASE': 'SHORT',
+                    'AST': 'TEXT',
+                    'AST_SET': 'SHORT',
+                    'AST_PHASE': 'SHORT',
+                    'CABLE_FILE': 'TEXT',
+                    'CATENARY': 'DOUBLE',
+                    'SPAN_LGTH': 'DOUBLE',
+                    'SAG': 'DOUBLE'}
+
+CIRCUIT_SPAN_FIELDS = ['SECTION', 'CIRCUIT', 'CIRCUITS',
+                       'BST', 'BST_TAG', 'BST_SET', 'BST_PHASES',
+                       'AST', 'AST_TAG', 'AST_SET', 'AST_PHASES',
+                       'SPAN_TAG', 'PHASES', 'WIRES_PER_PHASE',
+                       'CABLE_FILE', 'SHAPE@']
+
+CIRCUIT_SPAN_FIELD_TYPES = {'SECTION': 'SHORT',
+                            'CIRCUIT': 'SHORT',
+                            'CIRCUITS': 'SHORT',
+                            'BST': 'SHORT',
+                            'BST_SET': 'SHORT',
+                            'AST': 'SHORT',
+                            'AST_SET': 'SHORT',
+                            'PHASES': 'SHORT',
+                            'WIRES_PER_PHASE': 'SHORT'}
+
+# Attribute indexes added to each output once it is loaded (empty list to
+# skip), SPATIAL_INDEX rebuilds the spatial index for the loaded extent
+TOWER_REPORT_INDEXES = ['QSI_TOWER', 'STRUCTURE', 'STR_GEOTAG']
+ATTACHMENT_INDEXES = ['STR_GEOTAG']
+SPAN_INDEXES = ['SECTION', 'SPAN_TAG', 'BST_TAG', 'AST_TAG', 'BST_ID',
+                'AST_ID', 'CABLE_FILE']
+WIRE_INDEXES = ['SECTION', 'BST', 'AST', 'CABLE_FILE']
+CIRCUIT_SPAN_INDEXES = ['SECTION', 'SPAN_TAG', 'BST_TAG', 'AST_TAG']
+SPATIAL_INDEX = True
+
+# Columns read from the XML, everything else is skipped while parsing
+STRUCTURE_HUB = {'stake_description': 'Structure Hub'}  # or 'C/L Hub'
+STAKING_COLUMNS = ('structure_number', 'stake_description', 'station',
+                   'offset', 'x_easting', 'y_northing', 'z_elevation',
+                   'structure_height_or_pole_length', 'longitude',
+                   'latitude', 'structure_comment_1')
+ATTACHMENT_COLUMNS = ('struct_number', 'set_no', 'phase_no',
+                      'section_number', 'wire_attach_point_x',
+                      'wire_attach_point_y', 'wire_attach_point_z',
+                      'insulator_attach_point_x', 'insulator_attach_point_y',
+                      'insulator_attach_point_z')
+
+# section_sagging_data field used for wire shape
+CATENARY_FIELD = 'sagging_data_catenary_constant'
+
+# Wires whose attachment span differs from the hub span by more (ft) are
+# attached to the wrong structure and dropped
+SPAN_TOLERANCE = 100.
+
 
 def capitalize_dict_keys(_dict):
     upper_dict = {}
@@ -76,9 +158,9 @@ def capitalize_dict_keys(_dict):
     return upper_dict
 
 
-def xml_header_info(xml_file, header_tag='creator'):
-    tree = et.parse(xml_file)
-    root = tree.getroot()
+def root_header(root, header_tag='creator'):
+    if isinstance(root, ParsedXml):
+        return root.headers.get(header_tag)
 
     headers = None
     for branch in root:
@@ -89,81 +171,446 @@ def xml_header_info(xml_file, header_tag='creator'):
     return headers
 
 
-def get_xml_tables(xml_file):
-    tree = et.parse(xml_file)
-    root = tree.getroot()
-    tables = {branch.get('tagname'): branch for branch in root
-              if branch.tag == 'table' and int(branch.get('nrows'))}
+def root_tables(root):
+    if isinstance(root, ParsedXml):
+        return dict(root.tables)
+    return {branch.get('tagname'): branch for branch in root
+            if branch.tag == 'table' and int(branch.get('nrows'))}
+
+
+def xml_header_info(xml_file, header_tag='creator'):
+    return root_header(xml_root(xml_file), header_tag)
+
+
+def get_xml_tables(xml_file, parallel=False):
+    return root_tables(xml_root(xml_file, parallel=parallel))
+
+
+# Compressed inputs, streamed into the parser without extracting
+XML_COMPRESSION = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+XML_PATTERNS = ['*.xml', '*.xml.gz', '*.xml.bz2', '*.xml.xz', '*.zip']
+
+# archive.zip/member.xml, archive.zip!member.xml or archive.zip::member.xml
+ZIP_MEMBER_RE = re.compile(r'^(.+?\.zip)(?:[\\/!]|::)(.+)$', re.IGNORECASE)
 
-    return tables
 
+def split_zip_member(xml_file):
+    """(archive, member) of a zip member path, (None, None) otherwise
 
-def xml_table_element_dict(table, tags=None, as_list=False):
-    """Converts XML Table Element to Python Dictionary
-       table is element where element.tag=='table'
-       if tags=None, return all tags. Else, return only Tags.
+    A bare .zip path resolves to its only .xml member.
     """
-    output = {}
-    if as_list:
-        output = []
+    match = ZIP_MEMBER_RE.match(xml_file)
+    if match and os.path.isfile(match.group(1)):
+        return match.group(1), match.group(2).replace('\\', '/')
+    if xml_file.lower().endswith('.zip'):
+        members = zip_xml_members(xml_file)
+        if len(members) != 1:
+            raise ValueError('{} has {} xml files, use archive.zip/member.xml'
+                             .format(xml_file, len(members)))
+        return split_zip_member(members[0])
+    return None, None
 
-    for row in table:
-        row_num = int(row.get('rownum'))
-        row_dict = {}
 
-        for col in row:
-            if (tags and (col.tag not in tags)) or col.tag == 'rowtext':
-                continue
-            row_dict[col.tag] = col.text
+def zip_xml_members(zip_file):
+    """archive.zip/member.xml paths of every xml in a zip"""
+    with zipfile.ZipFile(zip_file) as zf:
+        return ['{}/{}'.format(zip_file, n) for n in zf.namelist()
+                if n.lower().endswith('.xml')]
 
-        if as_list:
-            output.append(row_dict)
-        else:
-            output[row_num] = row_dict
 
-    return output
+def expand_xml_inputs(xml_inputs):
+    """Expand folders and zip archives into individual xml paths
+
+    Args:
+        xml_inputs (str or list): ';'-separated string or list of xml,
+            compressed xml, zip (all xml members) or folder paths
+    """
+    if isinstance(xml_inputs, str):
+        xml_inputs = xml_inputs.split(';')
+
+    xml_files = []
+    for item in xml_inputs:
+        item = item.strip().strip("'")
+        if os.path.isdir(item):
+            xml_files.extend(expand_xml_inputs(
+                sorted(scan_directory(item, pattern=XML_PATTERNS))))
+        elif item.lower().endswith('.zip') and os.path.isfile(item):
+            xml_files.extend(zip_xml_members(item))
+        elif item:
+            xml_files.append(item)
+    return xml_files
+
+
+def xml_stem(xml_file, archive=False):
+    """File name without folder, archive or .xml/.gz/.bz2/.xz extensions
+
+    archive=True prefixes zip members with the archive name (d.zip/c.xml
+    is D_C), so members of different archives get their own output names.
+    """
+    zip_file, member = split_zip_member(xml_file) \
+        if '.zip' in xml_file.lower() else (None, None)
+    name = os.path.basename(member or xml_file)
+    stem, ext = os.path.splitext(name)
+    if ext.lower() in XML_COMPRESSION:
+        stem, ext = os.path.splitext(stem)
+    if ext.lower() != '.xml':
+        stem = os.path.splitext(name)[0]
+    if archive and zip_file:
+        zip_stem = os.path.splitext(os.path.basename(zip_file))[0]
+        if zip_stem.lower() != stem.lower():
+            stem = zip_stem + '_' + stem
+    return stem
+
+
+def xml_dir(xml_file):
+    """Folder holding the xml, or its archive"""
+    archive, _ = split_zip_member(xml_file) \
+        if '.zip' in xml_file.lower() else (None, None)
+    return os.path.dirname(archive or xml_file)
+
+
+def xml_size(xml_file):
+    """Bytes the parser progress is measured in (compressed on disk, zip
+    members by uncompressed size)"""
+    archive, member = split_zip_member(xml_file) \
+        if '.zip' in xml_file.lower() else (None, None)
+    if archive:
+        with zipfile.ZipFile(archive) as zf:
+            return zf.getinfo(member).file_size
+    return os.path.getsize(xml_file) if os.path.isfile(xml_file) else 0
+
+
+@contextmanager
+def open_xml(xml_file, progress=None):
+    """Binary stream of a plain, compressed (.gz, .bz2, .xz) or zip member
+    XML, decompressed on the fly. The declared encoding (windows-1252 for
+    PLS-CADD) is left to the parser.
 
+    Args:
+        xml_file (str): path, see split_zip_member for zip members
+        progress (utils.progress.Progress): bytes read/cancel checks
+    """
+    archive, member = split_zip_member(xml_file) \
+        if '.zip' in xml_file.lower() else (None, None)
+    with ExitStack() as stack:
+        if archive:
+            zf = stack.enter_context(zipfile.ZipFile(archive))
+            stream = stack.enter_context(zf.open(member))
+            yield ProgressFile(stream, progress) if progress else stream
+            return
+
+        stream = stack.enter_context(open(xml_file, 'rb'))
+        if progress:
+            stream = ProgressFile(stream, progress)
+        decompress = XML_COMPRESSION.get(
+            os.path.splitext(xml_file)[1].lower())
+        if decompress:
+            stream = stack.enter_context(decompress(stream, 'rb'))
+        yield stream
+
+
+def xml_root(xml_file, progress=None, parallel=False):
+    """Root element of an XML path, or the element itself if already parsed
 
-def xml_to_tower_report(xml_file, output=None, comments=None):
+    Args:
+        xml_file: path or parsed root element
+        progress (utils.progress.Progress): report bytes parsed and check
+            for cancellation while parsing
+        parallel (bool or int): parse the tables across processes (int:
+            number of processes) into a ParsedXml, see
+            utils.xml_tables.parallel_xml
     """
+    if et.iselement(xml_file) or isinstance(xml_file, ParsedXml):
+        return xml_file
+    if parallel:
+        if progress:
+            progress.check()
+        return parallel_xml(xml_file, None if parallel is True
+                            else int(parallel))
+    with open_xml(xml_file, progress) as f:
+        return et.parse(f).getroot()
+
+
+def staking_hubs(xml_tables, comments=None):
+    """Structure hub rows of the construction staking report, in row order
 
     Args:
-        xml_file:
-        output:
-        comments: tuple of ints, comment numbers (2, 3, 6)
+        xml_tables (dict): tagname: table element, see root_tables
+        comments: structure comment numbers to read besides comment 1
+    """
+    tags = STAKING_COLUMNS + tuple('structure_comment_{}'.format(int(i))
+                                   for i in comments or ())
+    rows = xml_table_element_dict(xml_tables['construction_staking_report'],
+                                  tags=tags, where=STRUCTURE_HUB)
+    return [row for _, row in sorted(rows.items())]
+
+
+def xml_attachments(xml_tables, structures):
+    """AttachmentTable of structure_attachment_coordinates"""
+    return AttachmentTable.from_xml(
+        xml_table_element_dict(xml_tables['structure_attachment_coordinates'],
+                               tags=ATTACHMENT_COLUMNS, as_list=True),
+        structures)
+
+
+def hub_structures(root, xml_tables=None):
+    """StructureTable of construction staking report structure hubs"""
+    if xml_tables is None:
+        xml_tables = root_tables(root)
+    return StructureTable.from_xml(
+        structure_lat_lon(staking_hubs(xml_tables), root_header(root)))
+
+
+def line_topology(xml_tables, structures, attachments=None):
+    """LineTopology from section_stringing_data over structures
+
+    Attachments resolve duplicated structure numbers, read from
+    xml_tables when needed and not given.
+    """
+    if attachments is None and structures.duplicates and \
+            'structure_attachment_coordinates' in xml_tables:
+        attachments = xml_attachments(xml_tables, structures)
+    return LineTopology.from_xml(
+        xml_table_element_dict(xml_tables['section_stringing_data'],
+                               as_list=True), structures, attachments)
+
+
+def xml_line(xml_file):
+    """Structure hubs and line topology of an XML file (or parsed root)
 
     Returns:
+        (StructureTable, LineTopology)
+    """
+    root = xml_root(xml_file)
+    xml_tables = root_tables(root)
+    structures = hub_structures(root, xml_tables)
+    return structures, line_topology(xml_tables, structures)
+
 
+def structure_lat_lon(records, header, x_key='x_easting', y_key='y_northing'):
+    """Fill or validate latitude/longitude of structure records in place
+
+    Missing values are computed from X/Y using the state plane zone of the
+    XML header, existing values are checked against the same computation.
     """
-    # Default output
-    if comments and isinstance(comments, (float, int)):
-        comments = [int(comments)]
+    if not records:
+        return records
+
+    lat, lon, mismatches = fill_lat_lon(
+        [float(r.get(x_key, r.get('x'))) for r in records],
+        [float(r.get(y_key, r.get('y'))) for r in records],
+        [r.get('latitude') for r in records],
+        [r.get('longitude') for r in records],
+        header)
+
+    if mismatches:
+        add_warning('\n    - WARNING: {} structures latitude/longitude '
+                    'do not match X/Y in zone {}'.format(
+                        mismatches, (header or {}).get('zone')))
+
+    # Unsupported zones and unknown units are not filled, those
+    # structures get no geotag
+    missing = int(np.sum(~(np.isfinite(lat) & np.isfinite(lon))))
+    if missing:
+        add_warning('\n    - WARNING: {} structures have no latitude/'
+                    'longitude and X/Y cannot be converted (zone {}, '
+                    'surveyfoot {}), geotags left empty'.format(
+                        missing, (header or {}).get('zone') or 'unknown',
+                        (header or {}).get('surveyfoot') or 'unknown'))
+
+    for r, _lat, _lon in zip(records, lat, lon):
+        r['latitude'], r['longitude'] = _lat, _lon
+
+    return records
+
+
+def span_wire_attachments(xml_tables, catenary_field=CATENARY_FIELD,
+                          structures=None):
+    """Attachments at both ends of every phase of every span
+
+    Each section in section_stringing_data is walked in order, conductor k
+    runs from phase int(phasing[k]) of one set to the next structure's set.
+    Wires missing an attachment or attached away from their structures
+    (see drop_mismatched) are dropped.
 
+    Args:
+        xml_tables (dict): tagname: table element, see get_xml_tables
+        catenary_field (str): section_sagging_data catenary constant field
+        structures (StructureTable): default from construction staking
+            report structure hubs
+
+    Returns:
+        (records, attachments, b_pos, a_pos), records are lists of the
+        WIRE_FIELDS attributes up to CATENARY, b_pos and a_pos the
+        AttachmentTable rows of the back and ahead ends
+    """
+    if structures is None:
+        structures = StructureTable.from_xml(staking_hubs(xml_tables))
+
+    attachments = xml_attachments(xml_tables, structures)
+
+    catenary = {}
+    if 'section_sagging_data' in xml_tables:
+        for rec in xml_table_element_dict(
+                xml_tables['section_sagging_data'], as_list=True):
+            try:
+                catenary[rec['sec_no']] = float(rec[catenary_field])
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    rows = xml_table_element_dict(xml_tables['section_stringing_data'],
+                                  as_list=True)
+    wires = drop_mismatched(SpanWireTable.from_xml(
+        rows, structures, attachments=attachments), structures, attachments)
+    found = wires.attached()
+    data = wires.data[found]
+
+    records = []
+    for sect, wire, b, a, b_set, b_ph, a_set, a_ph in zip(*(
+            data[f].tolist() for f in ('section', 'wire', 'bst_row',
+                                       'ast_row', 'bst_set', 'bst_phase',
+                                       'ast_set', 'ast_phase'))):
+        records.append([sect, wire,
+                        rows[b]['struct_number'], b_set, b_ph,
+                        rows[a]['struct_number'], a_set, a_ph,
+                        rows[b]['cable_name'],
+                        catenary.get(rows[b]['section_number'], np.nan)])
+    return records, attachments, data['bst_att'], data['ast_att']
+
+
+def drop_mismatched(wires, structures, attachments, tolerance=SPAN_TOLERANCE):
+    """Detach wires whose attachment span differs from the structure hub
+    span by more than tolerance (ft), with a warning
+
+    Returns:
+        wires, bst_att and ast_att set to -1 where mismatched
+    """
+    mismatch = np.abs(wires.span_mismatch(structures, attachments))
+    bad = np.nan_to_num(mismatch) > tolerance
+    if bad.any():
+        d = wires.data[bad]
+        add_warning('\n    - WARNING: {} wires dropped, attachment span '
+                    'differs from structure span by up to {:.0f} ft in '
+                    'sections {}'.format(
+                        int(bad.sum()), float(mismatch[bad].max()),
+                        ', '.join(str(s) for s in np.unique(d['section']))))
+        wires.data['bst_att'][bad] = -1
+        wires.data['ast_att'][bad] = -1
+    return wires
+
+
+def span_wire_geometry(xml_tables, catenary_field=CATENARY_FIELD,
+                       n_points=21, structures=None):
+    """Build 3D catenary vertices for every phase of every span
+
+    Args:
+        xml_tables (dict): tagname: table element, see get_xml_tables
+        catenary_field (str): section_sagging_data catenary constant field
+        n_points (int): vertices per wire
+        structures (StructureTable): default from construction staking
+            report structure hubs
+
+    Returns:
+        (records, points), records are lists of WIRE_FIELDS attributes
+        (without SHAPE@) and points is a (N, n_points, 3) array
+    """
+    records, attachments, b_pos, a_pos = span_wire_attachments(
+        xml_tables, catenary_field, structures)
+    points = catenary_points(attachments.wire_xyz(b_pos),
+                             attachments.wire_xyz(a_pos),
+                             np.array([r[-1] for r in records]), n_points)
+
+    span_lengths = np.hypot(*(points[:, -1, :2] - points[:, 0, :2]).T)
+    sags = mid_span_sag(points) if len(points) else []
+    for rec, span_length, sag in zip(records, span_lengths, sags):
+        rec.extend([round(float(span_length), 2), round(float(sag), 2)])
+
+    return records, points
+
+
+def write_span_wires(xml_tables, out_wires, sr=None, n_points=21,
+                     catenary_field=CATENARY_FIELD, structures=None,
+                     progress=None):
+    """Write PolylineZ catenary wires for each phase of each span"""
+    records, points = span_wire_geometry(xml_tables, catenary_field,
+                                         n_points, structures)
+    if progress:
+        progress.stage('wires', len(records))
+
+    arcpy.CreateFeatureclass_management(os.path.dirname(out_wires),
+                                        os.path.basename(out_wires),
+                                        geometry_type='POLYLINE',
+                                        has_z='ENABLED',
+                                        spatial_reference=sr)
+    for field in WIRE_FIELDS:
+        if field != 'SHAPE@':
+            arcpy.AddField_management(out_wires, field,
+                                      WIRE_FIELD_TYPES[field])
+
+    with arcpy.da.InsertCursor(out_wires, WIRE_FIELDS) as icurs:
+        for rec, pts in zip(records, points):
+            geom = arcpy.Polyline(
+                arcpy.Array([arcpy.Point(*p) for p in pts.tolist()]),
+                sr, True)
+            icurs.insertRow(rec + [geom])
+            if progress:
+                progress.add_rows()
+
+    add_indexes(out_wires, WIRE_INDEXES, SPATIAL_INDEX)
+    return out_wires
+
+
+def tower_report_fields(columns=()):
+    """TOWER_REPORT_FIELDS plus the COMMENT_nn columns found in columns,
+    built per report so comments of one xml do not carry over"""
+    return TOWER_REPORT_FIELDS + [c for c in columns
+                                  if re.match(r'^COMMENT_\d+$', c) and
+                                  c not in TOWER_REPORT_FIELDS]
+
+
+def tower_report_path(xml_file, output=None):
+    """Default tower report csv path"""
     if not output:
-        output = os.path.splitext(xml_file)[0] + '_XML_TOWER_REPORT.csv'
+        output = os.path.join(xml_dir(xml_file),
+                              xml_stem(xml_file, archive=True) +
+                              '_XML_TOWER_REPORT.csv')
         output = output.upper()
 
-    tree = et.parse(xml_file)
-    root = tree.getroot()
+    return output
+
+
+def xml_to_tower_report_df(xml_file, comments=None, progress=None,
+                           line=None):
+    """Build tower report in memory
+
+    Args:
+        xml_file:
+        comments: tuple of ints, comment numbers (2, 3, 6)
+        progress: optional utils.progress.Progress for parsing
+        line: xml_line result when already built, its structures and
+            dead ends are used as is
+
+    Returns:
+        pandas DataFrame with tower_report_fields columns
+    """
+    if comments and isinstance(comments, (float, int)):
+        comments = [int(comments)]
 
-    tables = {branch.get('tagname'): branch for branch in root if
-              branch.tag == 'table' and int(branch.get('nrows'))}
+    root = xml_root(xml_file, progress)
+    tables = root_tables(root)
 
     # Parse Necessary Tables
-    if 'construction_staking_report' in tables:
-        structure_dict = xml_table_element_dict(
-            tables['construction_staking_report'], as_list=False)
+    if line is not None:
+        structure_table, topology = line
+        rows = staking_hubs(tables, comments) if comments else None
 
-        # Remove non C/L Hub entries
-        to_remove = {i for i in structure_dict if
-                     structure_dict[i]['stake_description'] != 'Structure Hub'}
-        for i in to_remove:
-            structure_dict.pop(i)
+    elif 'construction_staking_report' in tables:
+        rows = staking_hubs(tables, comments)
 
     else:
         if comments:
-            arcpy.AddWarning('\n    - WARNING: Construction staking report '
-                             'not available, cannot add comments')
+            add_warning('\n    - WARNING: Construction staking report '
+                        'not available, cannot add comments')
 
         structure_dict = xml_table_element_dict(
             tables['structure_coordinates_report'],
@@ -180,157 +627,307 @@ def xml_to_tower_report(xml_file, output=None, comments=None):
 
                 structure_dict[i]['structure_comment_1'] = \
                     structure_dict[i]['structure_number']
+        rows = [structure_dict[i] for i in sorted(structure_dict)]
+
+    if line is None:
+        # Fill missing lat/lon from state plane coordinates
+        rows = structure_lat_lon(rows, root_header(root))
+        structure_table = StructureTable.from_xml(rows)
+        topology = None
+    structures = structure_table.data
 
     # Get dead end status
     try:
-        section_xml_dict = xml_table_element_dict(
-            tables['section_geometry_data'])
-        dead_ends = {int(r['from_str']) for
-                     _, r in section_xml_dict.items()}.union(
-            {int(r['to_str']) for _, r in section_xml_dict.items()})
+        if topology is None:
+            topology = line_topology(tables, structure_table)
+        dead_ends = topology.dead_ends()
     except (KeyError, ValueError):
-        arcpy.AddWarning('\n    - WARNING: Could not determine dead end '
-                         'status, true structure numbers required')
+        add_warning('\n    - WARNING: Could not determine dead end '
+                    'status, section stringing does not match '
+                    'structure numbers')
         dead_ends = None
 
-    # Build Report Dict to Write to CSV, Add Geotag and Rename Fields
-    r_dict = {}
-    for cnt, i in enumerate(sorted(structure_dict)):
-        r_dict[cnt] = {}
-        rec = structure_dict[i]
-
-        r_dict[cnt]['QSI_TOWER'] = cnt + 1
-        r_dict[cnt]['STRUCTURE'] = rec['structure_comment_1']
-
-        # X and Y tags differ based on parsed tables
-        r_dict[cnt]['X'] = float(rec.get('x_easting', rec.get('x', None)))
-        r_dict[cnt]['Y'] = float(rec.get('y_northing', rec.get('y', None)))
-        r_dict[cnt]['H'] = float(rec.get('structure_height_or_pole_length',
-                                         rec.get('structure_height', None)))
-        r_dict[cnt]['Z1'] = float(rec.get('z_elevation', rec.get('z', None)))
-        r_dict[cnt]['Z2'] = round(r_dict[cnt]['Z1'] + r_dict[cnt]['H'], 2)
-        r_dict[cnt]['LATITUDE'] = float(rec['latitude'])
-        r_dict[cnt]['LONGITUDE'] = float(rec['longitude'])
-        r_dict[cnt]['STR_GEOTAG'] = calc_geotag(lat=r_dict[cnt]['LATITUDE'],
-                                                lon=r_dict[cnt]['LONGITUDE'])
-
-        if dead_ends is not None:
-            r_dict[cnt]['STR_TYPE'] = 'Dead End' if (cnt + 1) in dead_ends \
-                else 'Tangent'
-        else:
-            r_dict[cnt]['STR_TYPE'] = 'Unknown'
+    # Build Report, Add Geotag and Rename Fields
+    qsi = np.arange(1, len(structures) + 1)
+    if dead_ends is not None:
+        str_type = np.where(dead_ends, 'Dead End', 'Tangent')
+    else:
+        str_type = np.full(len(structures), 'Unknown')
+
+    report = OrderedDict([
+        ('QSI_TOWER', qsi),
+        ('STRUCTURE', [r['structure_comment_1'] for r in rows] if rows
+         else structures['name'].tolist()),
+        ('X', structures['x']),
+        ('Y', structures['y']),
+        ('Z1', structures['z']),
+        ('Z2', np.round(structures['z'] + structures['height'], 2)),
+        ('H', structures['height']),
+        ('LATITUDE', structures['latitude']),
+        ('LONGITUDE', structures['longitude']),
+        ('STR_GEOTAG', structures['geotag']),
+        ('STR_TYPE', str_type)])
+
+    if comments:
+        for i in comments:
+            report['COMMENT_{:02d}'.format(int(i))] = \
+                [r['structure_comment_{}'.format(int(i))] for r in rows]
+
+    # Switched to pandas here because csv encoding was gross
+    return pd.DataFrame(report, columns=tower_report_fields(report))
+
+
+def write_tower_report(df, output):
+    """Save tower report DataFrame to csv"""
+    df.to_csv(output, index=False, quoting=1, quotechar='"',
+              lineterminator='\n', encoding='utf-8')
 
-        if comments:
-            for i in comments:
-                comment_field = 'COMMENT_{:02d}'.format(i)
-                if comment_field not in TOWER_REPORT_FIELDS:
-                    TOWER_REPORT_FIELDS.append(comment_field)
+    return output
 
-                r_dict[cnt][comment_field] = \
-                    rec['structure_comment_{}'.format(int(i))]
 
-    # Write Report, switched to pandas here because csv encoding was gross
-    df = pd.DataFrame(columns=TOWER_REPORT_FIELDS)
+def xml_to_tower_report(xml_file, output=None, comments=None):
+    """
+
+    Args:
+        xml_file:
+        output:
+        comments: tuple of ints, comment numbers (2, 3, 6)
 
-    # Add rows to the DataFrame
-    for k, v in sorted(r_dict.items()):
-        row = {k: v for k, v in v.items()}
-        df = df.append(row, ignore_index=True)
+    Returns:
+        output csv path
+    """
+    output = tower_report_path(xml_file, output)
+    return write_tower_report(xml_to_tower_report_df(xml_file, comments),
+                              output)
 
-    # Save the DataFrame to a CSV file
-    df.to_csv(output, index=False, quoting=1, quotechar='"', line_terminator='\n', encoding='utf-8')
 
-    return output
+def xml_sections(xml_tables):
+    """Section number: Section of section_geometry_data"""
+    sections = {}
+    for row in xml_table_element_dict(xml_tables['section_geometry_data'],
+                                      as_list=True):
+        section = Section.from_xml(row)
+        sections[section.sec_no] = section
+    return sections
+
+
+def span_rows(structures, sections, topology):
+    """Span attributes in stringing order, without geometry
+
+    Multi strung spans are yielded once, by their first section, with the
+    phases and wires of every section strung across them.
+
+    Args:
+        structures (StructureTable): structure hubs
+        sections (dict): see xml_sections
+        topology (LineTopology): see line_topology
+
+    Yields:
+        (SPAN_FIELDS values without SHAPE@, back structure, ahead structure)
+    """
+    sn = 0
+    for sect in topology.section_numbers.tolist():
+        section = sections[sect]
+        for span in topology.section_spans(sect):
+            span_sections = topology.span_sections(span).tolist()
+            if span_sections[0] != sect:
+                continue
+
+            bst = structures.data[topology.span_from[span]]
+            ast = structures.data[topology.span_to[span]]
+
+            # Span level attributes
+            span_tag = '{}-{}'.format(bst['geotag'], ast['geotag'])
+            span_name = '{}-{}'.format(bst['name'], ast['name'])
+            phases = sum(sections[s].phases for s in span_sections)
+            wires = sum(sections[s].total_wires for s in span_sections)
+
+            sn += 1
+            yield ([sn, sect,
+                    int(bst['number']), str(bst['geotag']), str(bst['name']),
+                    float(bst['station']), float(bst['offset']),
+                    int(ast['number']), str(ast['geotag']), str(ast['name']),
+                    float(ast['station']), float(ast['offset']),
+                    span_tag, span_name,
+                    section.wires_per_phase, phases, wires,
+                    section.cable_file, section.notes], bst, ast)
+
+
+def section_rows(structures, sections, topology):
+    """Section attributes in section order, ends from the stringing
+
+    Yields:
+        OrderedDict of SECTION, FROM_STR, TO_STR, CABLE_FILE, SNOWLOAD,
+        PHASES, WIRES_PER_PHASE, SPANS, LENGTH and STRUCTURES
+    """
+    names = structures.data['name']
+    for sect in topology.section_numbers.tolist():
+        section = sections.get(sect)
+        nodes = topology.section_structures(sect)
+        xy = np.column_stack([structures.data['x'][nodes],
+                              structures.data['y'][nodes]])
+        cable = section.cable_file if section else None
+        yield OrderedDict([
+            ('SECTION', sect),
+            ('FROM_STR', str(names[nodes[0]])),
+            ('TO_STR', str(names[nodes[-1]])),
+            ('CABLE_FILE', cable),
+            ('SNOWLOAD', cable.split('-')[-1].replace('.wir', '')
+             if cable else None),
+            ('PHASES', section.phases if section else None),
+            ('WIRES_PER_PHASE', section.wires_per_phase if section else None),
+            ('SPANS', len(nodes) - 1),
+            ('LENGTH', round(float(np.hypot(*np.diff(xy, axis=0).T).sum()),
+                             2)),
+            ('STRUCTURES', ';'.join(str(n) for n in names[nodes]))])
+
+
+def span_wires(xml_tables, structures, topology=None, attachments=None):
+    """SpanWireTable of section_stringing_data, see utils.model"""
+    wires = SpanWireTable.from_xml(
+        xml_table_element_dict(xml_tables['section_stringing_data'],
+                               as_list=True), structures, topology,
+        attachments)
+    if attachments is not None:
+        wires = drop_mismatched(wires, structures, attachments)
+    return wires
+
+
+def circuit_span_rows(structures, sections, wires, attachments):
+    """Circuit spans in stringing order, one per section strung across a
+    span, so multi circuit spans are kept apart
+
+    Each end is placed at the mean wire attachment point of its set (the
+    structure hub when no attachment is found), and lists the phases
+    strung, which link to the attachments by STR_GEOTAG, SET_NO and PHASE.
+
+    Args:
+        structures (StructureTable): structure hubs
+        sections (dict): see xml_sections
+        wires (SpanWireTable): built with topology and attachments
+        attachments (AttachmentTable): attachment points
+
+    Yields:
+        (OrderedDict of CIRCUIT_SPAN_FIELDS without SHAPE@, back XY,
+        ahead XY)
+    """
+    data = wires.data
+    first, group = wires.circuits()
+    n = len(first)
+
+    def mean_xy(node, att):
+        found = att >= 0
+        xy = []
+        for key in ('wire_x', 'wire_y'):
+            values = np.where(found, attachments.data[key][att], 0.)
+            total = np.bincount(group, values, minlength=n)
+            count = np.bincount(group, found, minlength=n)
+            hub = structures.data[key[-1]][node[first]]
+            xy.append(np.where(count > 0, total / np.maximum(count, 1),
+                               hub))
+        return np.column_stack(xy)
+
+    bst_xy = mean_xy(data['bst'], data['bst_att'])
+    ast_xy = mean_xy(data['ast'], data['ast_att'])
+
+    # circuit number within each span, by stringing order
+    span = data['span'][first].tolist()
+    circuit, circuits = [], {}
+    for s in span:
+        circuits[s] = circuits.get(s, 0) + 1
+        circuit.append(circuits[s])
+
+    phases = [[] for _ in range(n)]
+    for g, b_ph, a_ph in zip(group.tolist(), data['bst_phase'].tolist(),
+                             data['ast_phase'].tolist()):
+        phases[g].append((b_ph, a_ph))
+
+    geotags, names = structures.data['geotag'], structures.data['number']
+    for i, w in enumerate(first.tolist()):
+        d = data[w]
+        bst, ast = int(d['bst']), int(d['ast'])
+        section = sections.get(int(d['section']))
+        yield (OrderedDict([
+            ('SECTION', int(d['section'])),
+            ('CIRCUIT', circuit[i] if span[i] >= 0 else 1),
+            ('CIRCUITS', circuits[span[i]] if span[i] >= 0 else 1),
+            ('BST', int(names[bst])),
+            ('BST_TAG', str(geotags[bst])),
+            ('BST_SET', int(d['bst_set'])),
+            ('BST_PHASES', ';'.join(str(b) for b, _ in phases[i])),
+            ('AST', int(names[ast])),
+            ('AST_TAG', str(geotags[ast])),
+            ('AST_SET', int(d['ast_set'])),
+            ('AST_PHASES', ';'.join(str(a) for _, a in phases[i])),
+            ('SPAN_TAG', '{}-{}'.format(geotags[bst], geotags[ast])),
+            ('PHASES', len(phases[i])),
+            ('WIRES_PER_PHASE',
+             section.wires_per_phase if section else None),
+            ('CABLE_FILE', section.cable_file if section else None)]),
+            bst_xy[i], ast_xy[i])
+
+
+def write_circuit_spans(structures, sections, wires, attachments,
+                        out_circuits, sr=None, progress=None):
+    """Write a polyline per circuit span, see circuit_span_rows"""
+    rows = list(circuit_span_rows(structures, sections, wires, attachments))
+    if progress:
+        progress.stage('circuits', len(rows))
+
+    arcpy.CreateFeatureclass_management(os.path.dirname(out_circuits),
+                                        os.path.basename(out_circuits),
+                                        geometry_type='POLYLINE',
+                                        spatial_reference=sr)
+    for field in CIRCUIT_SPAN_FIELDS:
+        if field != 'SHAPE@':
+            arcpy.AddField_management(
+                out_circuits, field,
+                CIRCUIT_SPAN_FIELD_TYPES.get(field, 'TEXT'))
+
+    with arcpy.da.InsertCursor(out_circuits, CIRCUIT_SPAN_FIELDS) as icurs:
+        for row, bst_xy, ast_xy in rows:
+            icurs.insertRow(list(row.values()) + [arcpy.Polyline(
+                arcpy.Array([arcpy.Point(*bst_xy), arcpy.Point(*ast_xy)]),
+                sr)])
+            if progress:
+                progress.add_rows()
+
+    add_indexes(out_circuits, CIRCUIT_SPAN_INDEXES, SPATIAL_INDEX)
+    return out_circuits
 
 
 def xml_to_spans(xml_file, out_spans, out_structures=None,
-                 out_attachments=None, out_wires=None, sr=None):
-    # Get xml tables
-    xml_tables = get_xml_tables(xml_file)
+                 out_attachments=None, out_wires=None, sr=None,
+                 wire_points=21, progress=None, out_blowout=None,
+                 out_swing=None, out_circuits=None, line=None):
+    """Write span polylines of an XML and the optional layers built from
+    the same structures and stringing
 
-    structure_xml_dict = xml_table_element_dict(
-        xml_tables['construction_staking_report'])
+    Args:
+        line: xml_line result when already built (e.g. ahead of time on a
+            background thread), shared by every output
+    """
+    # Get xml tables
+    root = xml_root(xml_file, progress)
+    xml_tables = root_tables(root)
 
     # Structure level information
-    structure_dict = {}
-    for i in structure_xml_dict:
-        row = structure_xml_dict[i]
-        if row['stake_description'] == 'Structure Hub':  # or 'C/L Hub'
-            structure_number = int(row['structure_number'])
-            x = float(row['x_easting'])
-            y = float(row['y_northing'])
-            z = float(row['z_elevation'])
-            longitude = float(row['longitude'])
-            latitude = float(row['latitude'])
-            station = float(row['station'])
-            offset = float(row['offset'])
-            str_name = row['structure_comment_1']
-            str_geotag = calc_geotag(latitude, longitude)
-
-            if not str_name:
-                arcpy.AddWarning('    - WARNING: {} missing '
-                                 'structure_comment_1'.format(str_geotag))
-
-            structure_dict[structure_number] = [int(structure_number),
-                                                str_geotag,
-                                                x, y, z, latitude, longitude,
-                                                station, offset, str_name]
+    structures, topology = line or (hub_structures(root, xml_tables), None)
+    for name, geotag in zip(structures.data['name'],
+                            structures.data['geotag']):
+        if not name:
+            add_warning('    - WARNING: {} missing '
+                        'structure_comment_1'.format(geotag))
 
     # Section level information
-    section_xml_dict = xml_table_element_dict(
-        xml_tables['section_geometry_data'])
-
-    section_dict = {}
-    for i in section_xml_dict:
-        row = section_xml_dict[i]
-        sec_no = row['sec_no']
-        sec_notes = row['sec_notes']
-        from_str = row['from_str']  # for QC
-        to_str = row['to_str']  # for QC
-        number_of_phases = row['number_of_phases']  # for wire/phase values
-        wires_per_phase = row['wires_per_phase']  # for wire/phase values
-        cable_file = row['cable_file_name']
-
-        section_dict[sec_no] = [sec_no, from_str, to_str, number_of_phases,
-                                wires_per_phase, cable_file, sec_notes]
-
-    # Attachments dict
-    _dict = xml_table_element_dict(
-        xml_tables['structure_attachment_coordinates'])
-
-    attachment_dict = OrderedDict()
-    for _, rec in _dict.items():
-        k = '{}|{}|{}'.format(
-            rec['struct_number'], rec['set_no'], rec['phase_no'])
-
-        # Add length attribute
-        i_xyz = np.array([float(rec['insulator_attach_point_{}'.format(c)])
-                          for c in ('x', 'y', 'z')])
-        w_xyz = np.array([float(rec['wire_attach_point_{}'.format(c)])
-                          for c in ('x', 'y', 'z')])
-
-        rec['length'] = np.linalg.norm(i_xyz - w_xyz)
-        rec['STR_GEOTAG'] = structure_dict[int(rec['struct_number'])][1]
-
-        attachment_dict[k] = rec
-
-    # Stringing dict
-    string_xml_dict = xml_table_element_dict(
-        xml_tables['section_stringing_data'])
-
-    string_dict = {}  # section_number: [structure_numbers]
-    for i in range(len(string_xml_dict)):
-        row = string_xml_dict[i]
-        section_number = row['section_number']
-        structure_number = row['struct_number']
-        set_no = row['set_number']
-        phasing = row['phasing']
-        attach_key = '{}|{}|{}'.format(structure_number, set_no, set_no)
-
-        if section_number not in string_dict:
-            string_dict[section_number] = []
-
-        string_dict[section_number].append(structure_number)
+    sections = xml_sections(xml_tables)
+
+    # Attachments
+    attachments = xml_attachments(xml_tables, structures)
+
+    # Stringing: sections, spans and multi-circuit spans
+    if topology is None:
+        topology = line_topology(xml_tables, structures, attachments)
 
     if out_attachments:
         arcpy.CreateFeatureclass_management(os.path.dirname(out_attachments),
@@ -342,15 +939,42 @@ def xml_to_spans(xml_file, out_spans, out_structures=None,
                                       ATTACHMENT_FIELD_TYPES.get(field,
                                                                  'TEXT'))
 
+        data = attachments.data
+        geotags = structures.data['geotag'][data['structure']]
+        columns = [geotags.tolist()] + \
+                  [data[ATTACHMENT_ARRAY_FIELD_MAP[f]].tolist()
+                   if f in ATTACHMENT_ARRAY_FIELD_MAP
+                   else [None] * len(data) for f in ATTACHMENT_FIELDS[1:]]
+
+        if progress:
+            progress.stage('attachments', len(data))
         i_fields = ['SHAPE@XYZ'] + ATTACHMENT_FIELDS
         with arcpy.da.InsertCursor(out_attachments, i_fields) as i_curs:
-            for _, rec in attachment_dict.items():
-                geom = [tuple([float(rec['wire_attach_point_{}'.format(c)])
-                               for c in ('x', 'y', 'z')])]
-                i_row = geom + \
-                        [rec.get(ATTACHMENT_XML_FIELD_MAP.get(f, f), None) for
-                         f in ATTACHMENT_FIELDS]
-                i_curs.insertRow(i_row)
+            xyz = attachments.wire_xyz(slice(None)).tolist()
+            for geom, row in zip(xyz, zip(*columns)):
+                i_curs.insertRow([tuple(geom)] + list(row))
+                if progress:
+                    progress.add_rows()
+        add_indexes(out_attachments, ATTACHMENT_INDEXES, SPATIAL_INDEX)
+
+    # 3D catenary wires per phase
+    if out_wires:
+        write_span_wires(xml_tables, out_wires, sr=sr, n_points=wire_points,
+                         structures=structures, progress=progress)
+
+    # Circuit spans: one per section, set and phases strung across a span
+    if out_circuits:
+        write_circuit_spans(structures, sections,
+                            span_wires(xml_tables, structures, topology,
+                                       attachments),
+                            attachments, out_circuits, sr=sr,
+                            progress=progress)
+
+    # Insulator swing and conductor blowout envelopes per weather case
+    if out_blowout:
+        write_blowout(root, out_blowout, sr=sr, out_swing=out_swing,
+                      xml_tables=xml_tables, structures=structures,
+                      n_points=wire_points, progress=progress)
 
     # Building geometries: Spans
     temp_spans = os.path.join('in_memory', 'temp_spans')
@@ -361,69 +985,19 @@ def xml_to_spans(xml_file, out_spans, out_structures=None,
         if f != 'SHAPE@':
             arcpy.AddField_management(temp_spans, f, SPAN_FIELD_TYPES[f])
 
+    if progress:
+        progress.stage('spans', len(topology))
     with arcpy.da.InsertCursor(temp_spans, SPAN_FIELDS) as icurs:
-        sn = 0
-        span_tags = {}
-        span_tags_multiphase = []
-
-        for sect in sorted([int(i) for i in string_dict.keys()]):
-
-            # List of structures in section
-            structures = string_dict[str(sect)]
-
-            # [sec_no, from_str, to_str, number_of_phases, wires_per_phase]
-            section_info = section_dict[str(sect)]
-            for i in range(len(structures) - 1):
-                bst, ast = structures[i], structures[i + 1]
-
-                bst, bst_tag, bst_x, bst_y, bst_z, bst_lat, bst_lon, \
-                bst_station, bst_offset, bst_num = structure_dict[int(bst)]
-
-                ast, ast_tag, ast_x, ast_y, ast_z, ast_lat, ast_lon, \
-                ast_station, ast_offset, ast_num = structure_dict[int(ast)]
-
-                # Span level attributes
-                span_tag = '{}-{}'.format(bst_tag, ast_tag)
-                span_name = '-'.format(bst_num, ast_num)
-                wires_per_phase = int(section_info[4])
-                phases = int(section_info[3])
-                total_wires = wires_per_phase * phases
-                cable_file = section_info[5]
-                sec_notes = section_info[6]
-
-                # Check for multi strung spans
-                # TODO Change to use dict rather than indexing
-                if span_tag not in span_tags:
-                    sn += 1
-                    span_tags[span_tag] = [phases, total_wires]
-                    icurs.insertRow(
-                        [sn, sect,
-                         bst, bst_tag, bst_num,
-                         bst_station, bst_offset,
-                         ast, ast_tag, ast_num,
-                         ast_station, ast_offset,
-                         span_tag, span_name,
-                         wires_per_phase, phases, total_wires,
-                         cable_file, sec_notes] +
-                        [arcpy.Polyline(
-                            arcpy.Array([arcpy.Point(bst_x, bst_y),
-                                         arcpy.Point(ast_x, ast_y)]))])
-
-                # If a span contains multiple sections
-                else:
-                    span_tags[span_tag][0] += phases
-                    span_tags[span_tag][1] += total_wires
-                    span_tags_multiphase.append(span_tag)
-
-    if span_tags_multiphase:
-        with arcpy.da.UpdateCursor(
-                temp_spans, ('SPAN_TAG', 'PHASES', 'WIRES_TOTAL')) as cursor:
-            for row in cursor:
-                row[1], row[2] = span_tags[row[0]]
-                cursor.updateRow(row)
+        for row, bst, ast in span_rows(structures, sections, topology):
+            icurs.insertRow(row + [arcpy.Polyline(
+                arcpy.Array([arcpy.Point(bst['x'], bst['y']),
+                             arcpy.Point(ast['x'], ast['y'])]))])
+            if progress:
+                progress.add_rows()
 
     arcpy.CopyFeatures_management(temp_spans, out_spans)
 
     arcpy.DefineProjection_management(out_spans, sr)
+    add_indexes(out_spans, SPAN_INDEXES, SPATIAL_INDEX)
 
     return out_spans
@@ -0,0 +1,222 @@
+"""
+Byte/row progress, throughput and cancellation for long running tools
+"""
+
+try:
+    import arcpy
+except ImportError:  # headless, see xmltool.py
+    arcpy = None
+import datetime
+import io
+import os
+import time
+
+from utils.messages import add_message, add_warning
+
+
+class Cancelled(Exception):
+    """Raised between batches once the tool has been cancelled"""
+    pass
+
+
+class Progress(object):
+    """Track bytes parsed and rows written for a run
+
+    Reports percent complete, rows per second and ETA through the arcpy
+    progressor and messages (throttled to one message per interval), and
+    raises Cancelled from check() when the tool is cancelled in Pro or the
+    optional cancel_event is set.
+    """
+
+    def __init__(self, label='', total_bytes=0, interval=5.0, batch=500,
+                 cancel_event=None):
+        """
+        Args:
+            label (str): progressor label prefix
+            total_bytes (int): size of the input(s) being parsed
+            interval (float): seconds between progress messages
+            batch (int): rows between cancellation checks
+            cancel_event (threading.Event): cancel outside of Pro
+        """
+        self.label = label
+        self.total_bytes = total_bytes
+        self.bytes_done = 0
+        self.interval = interval
+        self.batch = batch
+        self.cancel_event = cancel_event
+        self.stage_label = ''
+        self.total_rows = 0
+        self.rows = 0
+        self._stage_start = self._start = time.time()
+        self._last_report = 0
+        self._next_check = batch
+
+        try:
+            arcpy.SetProgressor('step', label, 0, 100, 1)
+        except Exception:
+            pass
+
+    @classmethod
+    def for_files(cls, files, label='', size=None, **kwargs):
+        """Progress sized by the bytes of the input files
+
+        Args:
+            size (callable): bytes of one file, default os.path.getsize
+        """
+        if size is None:
+            size = lambda f: os.path.getsize(f) if os.path.isfile(f) else 0
+        return cls(label, sum(size(f) for f in files), **kwargs)
+
+    @property
+    def cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            return True
+        return bool(getattr(getattr(arcpy, 'env', None), 'isCancelled',
+                            False))
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled(self.stage_label or self.label)
+
+    def stage(self, label, total_rows=0):
+        """Start a new write stage with an optional expected row count"""
+        self.stage_label = label
+        self.total_rows = total_rows
+        self.rows = 0
+        self._stage_start = time.time()
+        self._next_check = self.batch
+        self.check()
+        self.report(force=True)
+
+    def add_bytes(self, n):
+        self.bytes_done += n
+        self.check()
+        self.report()
+
+    def add_rows(self, n=1):
+        self.rows += n
+        if self.rows >= self._next_check:
+            self._next_check = self.rows + self.batch
+            self.check()
+            self.report()
+
+    def rows_per_second(self):
+        elapsed = time.time() - self._stage_start
+        return self.rows / elapsed if elapsed > 0 else 0.
+
+    def fraction(self):
+        """Fraction complete of the current stage (rows, else bytes)"""
+        if self.total_rows:
+            return min(self.rows / self.total_rows, 1.)
+        if self.total_bytes:
+            return min(self.bytes_done / self.total_bytes, 1.)
+        return 0.
+
+    def eta(self):
+        """Seconds remaining for the current stage, None if unknown"""
+        if self.total_rows:
+            rate = self.rows_per_second()
+            return (self.total_rows - self.rows) / rate if rate else None
+        if self.total_bytes and self.bytes_done:
+            elapsed = time.time() - self._start
+            return elapsed * (self.total_bytes - self.bytes_done) / \
+                self.bytes_done
+        return None
+
+    def status(self):
+        parts = ['{:.0%}'.format(self.fraction())]
+        if self.total_bytes:
+            parts.append('{:,.1f}/{:,.1f} MB parsed'.format(
+                self.bytes_done / 1e6, self.total_bytes / 1e6))
+        if self.rows:
+            parts.append('{:,} rows, {:,.0f} rows/s'.format(
+                self.rows, self.rows_per_second()))
+        eta = self.eta()
+        if eta is not None:
+            parts.append('ETA {}'.format(
+                datetime.timedelta(seconds=int(eta))))
+        label = ' '.join(p for p in (self.label, self.stage_label) if p)
+        return '{}: {}'.format(label, ', '.join(parts))
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self._last_report < self.interval:
+            return
+        self._last_report = now
+        status = self.status()
+        try:
+            arcpy.SetProgressorLabel(status)
+            arcpy.SetProgressorPosition(int(self.fraction() * 100))
+        except Exception:
+            pass
+        add_message('      {}'.format(status))
+
+
+class BackgroundProgress(object):
+    """Progress stand-in for work on a background thread (see
+    utils.pipeline), counts bytes and raises Cancelled once stop is set
+    without touching arcpy"""
+
+    def __init__(self, stop=None):
+        self.stop = stop
+        self.bytes_done = 0
+
+    def check(self):
+        if self.stop is not None and self.stop.is_set():
+            raise Cancelled('background')
+
+    def add_bytes(self, n):
+        self.bytes_done += n
+        self.check()
+
+    def add_rows(self, n=1):
+        self.check()
+
+    def stage(self, label, total_rows=0):
+        self.check()
+
+
+class ProgressFile(io.RawIOBase):
+    """Read-only file wrapper that reports bytes read to a Progress
+
+    Passed to ElementTree.parse, so cancellation is checked between the
+    parser's read chunks.
+    """
+
+    def __init__(self, f, progress):
+        self._f = f
+        self.progress = progress
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._f.readinto(b)
+        if n:
+            self.progress.add_bytes(n)
+        return n
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        if data:
+            self.progress.add_bytes(len(data))
+        return data
+
+    def close(self):
+        self._f.close()
+        super(ProgressFile, self).close()
+
+
+def cleanup_outputs(paths):
+    """Delete partially written outputs after a cancel or failure"""
+    for path in paths:
+        if not path:
+            continue
+        try:
+            if arcpy and arcpy.Exists(path):
+                arcpy.Delete_management(path)
+            elif os.path.isfile(path):
+                os.remove(path)
+        except Exception as e:
+            add_warning('\n    - WARNING: Could not remove partial output '
+                        '{}, {}'.format(path, e))
@@ -0,0 +1,231 @@
+"""
+Purpose: Compare tower reports between XML revisions
+"""
+
+import itertools
+import numpy as np
+import pandas as pd
+
+from utils.geotagging import geotag_codes
+from utils.misc import approximate_match_array
+
+# Diff status values
+ADDED = 'Added'
+REMOVED = 'Removed'
+MOVED = 'Moved'
+CHANGED = 'Changed'
+UNCHANGED = 'Unchanged'
+
+DIFF_FIELDS = ['STATUS', 'OLD_KEY', 'NEW_KEY', 'KEY_OFFSET',
+               'CHANGED_FIELDS']
+
+POSITION_FIELDS = ('X', 'Y')
+
+
+def read_report(report):
+    """Return tower report as DataFrame, accepts csv path or DataFrame"""
+    if isinstance(report, pd.DataFrame):
+        return report.reset_index(drop=True)
+
+    return pd.read_csv(report, dtype=str, keep_default_na=False,
+                       encoding='utf-8')
+
+
+def _numeric(series):
+    """Float array when every populated value is numeric, else None"""
+    values = pd.to_numeric(series.replace('', np.nan), errors='coerce')
+    if values.isna().sum() != (series.replace('', np.nan).isna()).sum():
+        return None
+    return values.to_numpy(dtype=float)
+
+
+def _blank(keys):
+    """Boolean mask of missing keys (None, NaN, '' or 'nan')"""
+    return np.array([k is None or k != k or str(k).strip().lower() in
+                     ('', 'nan', 'none') for k in keys], dtype=bool)
+
+
+def match_keys(old_keys, new_keys, n=0):
+    """One to one join of old and new keys, exact first then +/- n geotag
+
+    Args:
+        old_keys, new_keys: array-like of keys
+        n (int): geotag tolerance, 0 for exact matching only
+
+    Returns:
+        (old_idx, new_idx, offset) int arrays of matched positions and the
+        chebyshev geotag offset of each match (0 for exact)
+
+    Missing keys are never matched.
+    """
+    old_keys = np.asarray(old_keys, dtype=object)
+    new_keys = np.asarray(new_keys, dtype=object)
+    old_blank, new_blank = _blank(old_keys), _blank(new_keys)
+
+    # Exact matches, the k-th occurrence of a repeated key pairs with its
+    # k-th occurrence on the other side
+    def occurrences(keys):
+        return pd.MultiIndex.from_arrays(
+            [keys, pd.Series(keys).groupby(keys).cumcount().to_numpy()])
+
+    new_lookup = pd.Series(np.arange(len(new_keys)),
+                           index=occurrences(new_keys))[~new_blank]
+    exact = new_lookup.reindex(occurrences(old_keys)).to_numpy()
+    has = ~np.isnan(exact) & ~old_blank
+
+    old_idx = [np.flatnonzero(has)]
+    new_idx = [exact[has].astype(np.int64)]
+    offset = [np.zeros(has.sum(), dtype=np.int64)]
+
+    if n:
+        old_free, new_free = ~old_blank, ~new_blank
+        old_free[old_idx[0]] = False
+        new_free[new_idx[0]] = False
+
+        o_hemi, o_lon, o_lat = geotag_codes(old_keys)
+        n_hemi, n_lon, n_lat = geotag_codes(new_keys)
+
+        # Single sortable code per geotag, hemisphere kept as leading index
+        hemis = {h: i for i, h in enumerate(sorted(set(o_hemi) |
+                                                   set(n_hemi)))}
+        scale = 10 ** 8
+        o_h = np.array([hemis[h] for h in o_hemi], dtype=np.int64)
+        n_h = np.array([hemis[h] for h in n_hemi], dtype=np.int64)
+
+        def encode(h, lon, lat):
+            return (h * scale * 10 + lon) * scale + lat
+
+        n_code = encode(n_h, n_lon, n_lat)
+        order = np.argsort(n_code, kind='stable')
+        sorted_code = n_code[order]
+
+        # Closest offsets are attempted first
+        offsets = sorted(
+            (p for p in itertools.product(range(-n, n + 1), repeat=2)
+             if p != (0, 0)), key=lambda p: (max(map(abs, p)),
+                                             abs(p[0]) + abs(p[1])))
+
+        for d_lon, d_lat in offsets:
+            cand = np.flatnonzero(old_free & (o_lon >= 0))
+            if not len(cand) or not new_free.any():
+                break
+
+            code = encode(o_h[cand], o_lon[cand] + d_lon,
+                          o_lat[cand] + d_lat)
+            pos = np.searchsorted(sorted_code, code)
+            pos[pos >= len(sorted_code)] = len(sorted_code) - 1
+            hit = sorted_code[pos] == code
+            matched_new = order[pos[hit]]
+            matched_old = cand[hit]
+
+            keep = new_free[matched_new]
+            matched_new, matched_old = matched_new[keep], matched_old[keep]
+            matched_new, first = np.unique(matched_new, return_index=True)
+            matched_old = matched_old[first]
+
+            old_free[matched_old] = False
+            new_free[matched_new] = False
+            old_idx.append(matched_old)
+            new_idx.append(matched_new)
+            offset.append(np.full(len(matched_old),
+                                  max(abs(d_lon), abs(d_lat)),
+                                  dtype=np.int64))
+
+    return (np.concatenate(old_idx), np.concatenate(new_idx),
+            np.concatenate(offset))
+
+
+def diff_reports(old, new, key='STR_GEOTAG', n=1, fields=None,
+                 position_fields=POSITION_FIELDS, margin=0.05, abs_val=1):
+    """Compare two tower reports
+
+    Args:
+        old, new: tower report csv paths or DataFrames
+        key (str): join field
+        n (int): +/- geotag tolerance used when exact key is not found
+        fields (list): fields compared for changes, default all shared fields
+        position_fields (tuple): fields that mark a structure as moved
+        margin (float): relative change allowed, see approximate_match_value
+        abs_val (float): absolute change allowed
+
+    Returns:
+        DataFrame of DIFF_FIELDS followed by OLD_/NEW_ prefixed fields
+    """
+    old, new = read_report(old), read_report(new)
+
+    shared = [f for f in old.columns if f in new.columns and f != key]
+    if fields is None:
+        fields = shared
+    fields = [f for f in fields if f in shared]
+    position_fields = [f for f in position_fields if f in shared]
+
+    old_idx, new_idx, offset = match_keys(
+        old[key].to_numpy(), new[key].to_numpy(),
+        n=n if key == 'STR_GEOTAG' else 0)
+
+    o = old.iloc[old_idx].reset_index(drop=True)
+    w = new.iloc[new_idx].reset_index(drop=True)
+
+    # Column-wise comparison of matched structures
+    changed = {}
+    for field in fields:
+        a, b = _numeric(o[field]), _numeric(w[field])
+        if a is not None and b is not None:
+            same = approximate_match_array(a, b, margin, abs_val)
+        else:
+            same = (o[field].astype(str) == w[field].astype(str)).to_numpy()
+        changed[field] = ~same
+
+    changed = pd.DataFrame(changed, index=o.index, columns=fields)
+
+    moved = changed[position_fields].any(axis=1).to_numpy() \
+        if position_fields else np.zeros(len(o), dtype=bool)
+    attrs = [f for f in fields if f not in position_fields]
+    other = changed[attrs].any(axis=1).to_numpy() \
+        if attrs else np.zeros(len(o), dtype=bool)
+
+    status = np.where(moved, MOVED, np.where(other, CHANGED, UNCHANGED))
+
+    # Comma separated list of differing fields per structure
+    names = np.array(fields, dtype=object)
+    mask = changed.to_numpy()
+    changed_fields = [','.join(names[r]) for r in mask]
+
+    matched = pd.DataFrame({'STATUS': status,
+                            'OLD_KEY': o[key].to_numpy(),
+                            'NEW_KEY': w[key].to_numpy(),
+                            'KEY_OFFSET': offset,
+                            'CHANGED_FIELDS': changed_fields})
+    matched = pd.concat([matched, o.add_prefix('OLD_'), w.add_prefix('NEW_')],
+                        axis=1)
+
+    removed_rows = old.drop(index=old.index[old_idx])
+    removed = pd.concat([pd.DataFrame({
+        'STATUS': REMOVED, 'OLD_KEY': removed_rows[key].to_numpy(),
+        'NEW_KEY': None, 'KEY_OFFSET': None, 'CHANGED_FIELDS': ''}),
+        removed_rows.reset_index(drop=True).add_prefix('OLD_')], axis=1)
+
+    added_rows = new.drop(index=new.index[new_idx])
+    added = pd.concat([pd.DataFrame({
+        'STATUS': ADDED, 'OLD_KEY': None,
+        'NEW_KEY': added_rows[key].to_numpy(), 'KEY_OFFSET': None,
+        'CHANGED_FIELDS': ''}),
+        added_rows.reset_index(drop=True).add_prefix('NEW_')], axis=1)
+
+    return pd.concat([matched, removed, added], ignore_index=True)
+
+
+def diff_summary(diff):
+    """Count of structures per status"""
+    return diff['STATUS'].value_counts().reindex(
+        [ADDED, REMOVED, MOVED, CHANGED, UNCHANGED], fill_value=0).to_dict()
+
+
+def write_diff(diff, output, changes_only=True):
+    if changes_only:
+        diff = diff[diff['STATUS'] != UNCHANGED]
+
+    diff.to_csv(output, index=False, quoting=1, quotechar='"',
+                encoding='utf-8')
+
+    return output
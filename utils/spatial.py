@@ -0,0 +1,145 @@
+"""
+Purpose: Spatial helpers for ordering structures without stringing data
+"""
+
+import numpy as np
+from collections import deque
+
+try:
+    from scipy.spatial import cKDTree as KDTree
+except ImportError:
+    KDTree = None
+
+# Span flags
+FLAG_BRANCH = 'BRANCH'
+FLAG_AMBIGUOUS = 'AMBIGUOUS'
+
+
+class _BruteTree(object):
+    """Minimal cKDTree stand-in when scipy is not available, O(N) query"""
+
+    def __init__(self, data):
+        self.data = np.asarray(data, dtype=float)
+        self.n = len(self.data)
+
+    def query(self, x, k=1):
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 2:
+            res = [self.query(pt, k) for pt in x]
+            return (np.array([r[0] for r in res]),
+                    np.array([r[1] for r in res]))
+
+        d = np.hypot(*(self.data - x).T)
+        k = min(k, self.n)
+        idx = np.argpartition(d, k - 1)[:k]
+        idx = idx[np.argsort(d[idx], kind='stable')]
+        return d[idx], idx
+
+
+def build_tree(xy):
+    if KDTree is not None:
+        return KDTree(xy)
+    return _BruteTree(xy)
+
+
+# Neighbours a tree query may return before _nearest masks the points
+MAX_QUERY_K = 128
+
+
+def _nearest(tree, pt, n, visited, want_visited=False, count=1):
+    """Up to count nearest (distance, index) by visited status
+
+    The tree is queried with a growing k up to MAX_QUERY_K, past that
+    (after a branch jump or dead end the walk can be far from any point
+    of the wanted status) only the points of that status are searched.
+    """
+    k = min(8, n)
+    while k <= MAX_QUERY_K:
+        d, idx = tree.query(pt, k=k)
+        d, idx = np.atleast_1d(d), np.atleast_1d(idx)
+        ok = visited[idx] == want_visited
+        if ok.sum() >= count or k >= n:
+            return d[ok][:count], idx[ok][:count]
+        k = min(k * 4, n)
+
+    idx = np.flatnonzero(visited == want_visited)
+    d = np.hypot(*(tree.data[idx] - pt).T)
+    order = np.argsort(d, kind='stable')[:count]
+    return d[order], idx[order]
+
+
+def line_seed(xy, dead_ends=None):
+    """Index of the structure most likely to be a line end
+
+    The point farthest from the centroid is taken as one end of the line,
+    if dead_ends (bool array) is given the closest dead end to it is used.
+    """
+    xy = np.asarray(xy, dtype=float)
+    far = int(np.argmax(np.hypot(*(xy - xy.mean(axis=0)).T)))
+    if dead_ends is None or not np.any(dead_ends):
+        return far
+
+    candidates = np.flatnonzero(dead_ends)
+    d = np.hypot(*(xy[candidates] - xy[far]).T)
+    return int(candidates[np.argmin(d)])
+
+
+def nearest_neighbour_chain(xy, seed=None, dead_ends=None, jump_factor=3.0,
+                            ambiguity=0.9):
+    """Order structures by walking nearest unvisited neighbours
+
+    Args:
+        xy (ndarray): (N, 2) structure coordinates
+        seed (int): start index, default from line_seed
+        dead_ends (ndarray): bool array used to pick the seed
+        jump_factor (float): steps longer than jump_factor x median of the
+            recent steps start a branch, connected to its nearest visited structure
+        ambiguity (float): flag steps where the second nearest candidate is
+            within this ratio of the nearest
+
+    Returns:
+        list of (from_index, to_index, flag) spans, flag is None,
+        FLAG_BRANCH or FLAG_AMBIGUOUS
+    """
+    xy = np.asarray(xy, dtype=float)
+    n = len(xy)
+    if n < 2:
+        return []
+
+    tree = build_tree(xy)
+    if seed is None:
+        seed = line_seed(xy, dead_ends)
+
+    # Neighbours of every structure queried in one call, the tree is only
+    # searched again when all of them have been visited
+    nbr_d, nbr_i = tree.query(xy, k=min(9, n))
+
+    visited = np.zeros(n, dtype=bool)
+    visited[seed] = True
+    current = seed
+
+    steps, spans = deque(maxlen=25), []
+    for _ in range(n - 1):
+        ok = ~visited[nbr_i[current]]
+        if ok.sum() >= 2 or (ok.any() and visited.sum() == n - 1):
+            d, idx = nbr_d[current][ok][:2], nbr_i[current][ok][:2]
+        else:
+            d, idx = _nearest(tree, xy[current], n, visited, count=2)
+        step, nxt = float(d[0]), int(idx[0])
+
+        flag = None
+        from_idx = current
+        typical = sorted(steps)[len(steps) // 2] if steps else None
+        if typical and step > jump_factor * typical:
+            # Tap or branch, attach to the closest structure already drawn
+            vd, vidx = _nearest(tree, xy[nxt], n, visited, True)
+            from_idx, step, flag = int(vidx[0]), float(vd[0]), FLAG_BRANCH
+        elif len(d) > 1 and d[0] > 0 and d[0] / d[1] > ambiguity:
+            flag = FLAG_AMBIGUOUS
+
+        visited[nxt] = True
+        steps.append(step)
+        spans.append((from_idx, nxt, flag))
+        current = nxt
+
+    return spans
@@ -0,0 +1,265 @@
+"""
+Purpose: Vectorized NAD83 State Plane to latitude/longitude conversion
+Notes: Lambert Conformal Conic and Transverse Mercator formulas follow
+       Snyder, Map Projections - A Working Manual (USGS PP 1395)
+"""
+
+import numpy as np
+
+# GRS80 ellipsoid
+A = 6378137.0
+F = 1 / 298.257222101
+E2 = 2 * F - F ** 2
+E = np.sqrt(E2)
+
+# Linear units, meters per unit
+US_SURVEY_FOOT = 1200 / 3937.
+INTERNATIONAL_FOOT = 0.3048
+METER = 1.0
+
+
+def _dms(d, m=0, s=0):
+    sign = -1 if d < 0 else 1
+    return sign * (abs(d) + m / 60. + s / 3600.)
+
+
+# NAD83 zones (FIPS code), angles in degrees, false easting/northing in m
+# LCC: (lat_1, lat_2, lat_0, lon_0, false_e, false_n)
+# TM:  (lat_0, lon_0, scale, false_e, false_n)
+LCC_ZONES = {
+    401: (_dms(41, 40), _dms(40), _dms(39, 20), _dms(-122), 2000000, 500000),
+    402: (_dms(39, 50), _dms(38, 20), _dms(37, 40), _dms(-122), 2000000,
+          500000),
+    403: (_dms(38, 26), _dms(37, 4), _dms(36, 30), _dms(-120, 30), 2000000,
+          500000),
+    404: (_dms(37, 15), _dms(36), _dms(35, 20), _dms(-119), 2000000, 500000),
+    405: (_dms(35, 28), _dms(34, 2), _dms(33, 30), _dms(-118), 2000000,
+          500000),
+    406: (_dms(33, 53), _dms(32, 47), _dms(32, 10), _dms(-116, 15), 2000000,
+          500000),
+    3601: (_dms(46), _dms(44, 20), _dms(43, 40), _dms(-120, 30), 2500000, 0),
+    3602: (_dms(44), _dms(42, 20), _dms(41, 40), _dms(-120, 30), 1500000, 0),
+}
+
+TM_ZONES = {
+    2701: (_dms(34, 45), _dms(-115, 35), 0.9999, 200000, 8000000),
+    2702: (_dms(34, 45), _dms(-116, 40), 0.9999, 500000, 6000000),
+    2703: (_dms(34, 45), _dms(-118, 35), 0.9999, 800000, 4000000),
+}
+
+
+def header_zone(header):
+    """Zone and linear unit from PLS-CADD <creator> attributes
+
+    Args:
+        header (dict): attributes, see plscadd_xml.xml_header_info
+
+    Returns:
+        (zone, meters_per_unit), zone is None when not NAD83 state plane,
+        meters_per_unit is None when the header does not say (only
+        surveyfoot='yes' does, other projects may be feet or meters)
+    """
+    if not header or \
+            str(header.get('coordinatesystem', '')).lower() != 'nad83':
+        return None, None
+
+    try:
+        zone = int(header.get('zone'))
+    except (TypeError, ValueError):
+        return None, None
+
+    if str(header.get('surveyfoot', '')).lower() == 'yes':
+        return zone, US_SURVEY_FOOT
+
+    return zone, None
+
+
+def _t(phi):
+    es = E * np.sin(phi)
+    return np.tan(np.pi / 4 - phi / 2) / ((1 - es) / (1 + es)) ** (E / 2)
+
+
+def _m(phi):
+    return np.cos(phi) / np.sqrt(1 - E2 * np.sin(phi) ** 2)
+
+
+def _lcc_constants(zone):
+    lat1, lat2, lat0, lon0, fe, fn = [np.radians(v) for v in
+                                      LCC_ZONES[zone][:4]] + \
+                                     list(LCC_ZONES[zone][4:])
+    m1, m2 = _m(lat1), _m(lat2)
+    t0, t1, t2 = _t(lat0), _t(lat1), _t(lat2)
+    n = (np.log(m1) - np.log(m2)) / (np.log(t1) - np.log(t2))
+    f = m1 / (n * t1 ** n)
+    rho0 = A * f * t0 ** n
+
+    return n, f, rho0, lon0, fe, fn
+
+
+def _meridian_arc(phi):
+    return A * ((1 - E2 / 4 - 3 * E2 ** 2 / 64 - 5 * E2 ** 3 / 256) * phi -
+                (3 * E2 / 8 + 3 * E2 ** 2 / 32 + 45 * E2 ** 3 / 1024) *
+                np.sin(2 * phi) +
+                (15 * E2 ** 2 / 256 + 45 * E2 ** 3 / 1024) *
+                np.sin(4 * phi) -
+                (35 * E2 ** 3 / 3072) * np.sin(6 * phi))
+
+
+def _lcc_inverse(x, y, zone):
+    n, f, rho0, lon0, fe, fn = _lcc_constants(zone)
+
+    dx = x - fe
+    dy = rho0 - (y - fn)
+    rho = np.sign(n) * np.hypot(dx, dy)
+    t = (rho / (A * f)) ** (1 / n)
+    theta = np.arctan2(np.sign(n) * dx, np.sign(n) * dy)
+    lon = theta / n + lon0
+
+    phi = np.pi / 2 - 2 * np.arctan(t)
+    for _ in range(10):
+        es = E * np.sin(phi)
+        phi = np.pi / 2 - 2 * np.arctan(
+            t * ((1 - es) / (1 + es)) ** (E / 2))
+
+    return phi, lon
+
+
+def _lcc_forward(phi, lon, zone):
+    n, f, rho0, lon0, fe, fn = _lcc_constants(zone)
+
+    rho = A * f * _t(phi) ** n
+    theta = n * (lon - lon0)
+    return fe + rho * np.sin(theta), fn + rho0 - rho * np.cos(theta)
+
+
+def _tm_inverse(x, y, zone):
+    lat0, lon0, k0, fe, fn = TM_ZONES[zone]
+    lat0, lon0 = np.radians(lat0), np.radians(lon0)
+    ep2 = E2 / (1 - E2)
+
+    m = _meridian_arc(lat0) + (y - fn) / k0
+    mu = m / (A * (1 - E2 / 4 - 3 * E2 ** 2 / 64 - 5 * E2 ** 3 / 256))
+    e1 = (1 - np.sqrt(1 - E2)) / (1 + np.sqrt(1 - E2))
+    phi1 = (mu + (3 * e1 / 2 - 27 * e1 ** 3 / 32) * np.sin(2 * mu) +
+            (21 * e1 ** 2 / 16 - 55 * e1 ** 4 / 32) * np.sin(4 * mu) +
+            (151 * e1 ** 3 / 96) * np.sin(6 * mu) +
+            (1097 * e1 ** 4 / 512) * np.sin(8 * mu))
+
+    sin1, cos1, tan1 = np.sin(phi1), np.cos(phi1), np.tan(phi1)
+    c1 = ep2 * cos1 ** 2
+    t1 = tan1 ** 2
+    n1 = A / np.sqrt(1 - E2 * sin1 ** 2)
+    r1 = A * (1 - E2) / (1 - E2 * sin1 ** 2) ** 1.5
+    d = (x - fe) / (n1 * k0)
+
+    phi = phi1 - (n1 * tan1 / r1) * (
+        d ** 2 / 2 -
+        (5 + 3 * t1 + 10 * c1 - 4 * c1 ** 2 - 9 * ep2) * d ** 4 / 24 +
+        (61 + 90 * t1 + 298 * c1 + 45 * t1 ** 2 - 252 * ep2 -
+         3 * c1 ** 2) * d ** 6 / 720)
+    lon = lon0 + (d - (1 + 2 * t1 + c1) * d ** 3 / 6 +
+                  (5 - 2 * c1 + 28 * t1 - 3 * c1 ** 2 + 8 * ep2 +
+                   24 * t1 ** 2) * d ** 5 / 120) / cos1
+
+    return phi, lon
+
+
+def _tm_forward(phi, lon, zone):
+    lat0, lon0, k0, fe, fn = TM_ZONES[zone]
+    lat0, lon0 = np.radians(lat0), np.radians(lon0)
+    ep2 = E2 / (1 - E2)
+
+    n = A / np.sqrt(1 - E2 * np.sin(phi) ** 2)
+    t = np.tan(phi) ** 2
+    c = ep2 * np.cos(phi) ** 2
+    a = (lon - lon0) * np.cos(phi)
+    m, m0 = _meridian_arc(phi), _meridian_arc(lat0)
+
+    x = fe + k0 * n * (a + (1 - t + c) * a ** 3 / 6 +
+                       (5 - 18 * t + t ** 2 + 72 * c - 58 * ep2) *
+                       a ** 5 / 120)
+    y = fn + k0 * (m - m0 + n * np.tan(phi) * (
+        a ** 2 / 2 + (5 - t + 9 * c + 4 * c ** 2) * a ** 4 / 24 +
+        (61 - 58 * t + t ** 2 + 600 * c - 330 * ep2) * a ** 6 / 720))
+
+    return x, y
+
+
+def _check_zone(zone):
+    zone = int(zone)
+    if zone not in LCC_ZONES and zone not in TM_ZONES:
+        raise KeyError('State plane zone {} not supported'.format(zone))
+    return zone
+
+
+def state_plane_to_lat_lon(x, y, zone, unit=US_SURVEY_FOOT):
+    """Convert state plane coordinates to latitude/longitude
+
+    Args:
+        x, y (array-like): easting/northing
+        zone (int): NAD83 FIPS zone, e.g. 403
+        unit (float): meters per coordinate unit
+
+    Returns:
+        (latitude, longitude) float arrays in decimal degrees
+    """
+    zone = _check_zone(zone)
+    x = np.asarray(x, dtype=float) * unit
+    y = np.asarray(y, dtype=float) * unit
+
+    if zone in LCC_ZONES:
+        phi, lon = _lcc_inverse(x, y, zone)
+    else:
+        phi, lon = _tm_inverse(x, y, zone)
+
+    return np.degrees(phi), np.degrees(lon)
+
+
+def lat_lon_to_state_plane(lat, lon, zone, unit=US_SURVEY_FOOT):
+    """Convert latitude/longitude to state plane coordinates"""
+    zone = _check_zone(zone)
+    phi = np.radians(np.asarray(lat, dtype=float))
+    lam = np.radians(np.asarray(lon, dtype=float))
+
+    if zone in LCC_ZONES:
+        x, y = _lcc_forward(phi, lam, zone)
+    else:
+        x, y = _tm_forward(phi, lam, zone)
+
+    return x / unit, y / unit
+
+
+def fill_lat_lon(x, y, lat, lon, header, tolerance=1e-5):
+    """Fill missing latitude/longitude from X/Y using the XML header
+
+    Args:
+        x, y (array-like): state plane coordinates
+        lat, lon (array-like): existing values, None or NaN where missing
+        header (dict): <creator> attributes
+        tolerance (float): degrees, populated values farther than this from
+            the computed position are counted as mismatches
+
+    Returns:
+        (lat, lon, mismatches), mismatches is the number of populated
+        values outside tolerance, lat/lon unchanged if the zone is
+        unsupported or the unit unknown
+    """
+    lat = np.array([np.nan if v is None else v for v in lat], dtype=float)
+    lon = np.array([np.nan if v is None else v for v in lon], dtype=float)
+
+    zone, unit = header_zone(header)
+    if zone is None or unit is None or \
+            (zone not in LCC_ZONES and zone not in TM_ZONES):
+        return lat, lon, 0
+
+    c_lat, c_lon = state_plane_to_lat_lon(x, y, zone, unit)
+
+    known = ~np.isnan(lat) & ~np.isnan(lon)
+    off = (np.abs(lat - c_lat) > tolerance) | \
+          (np.abs(lon - c_lon) > tolerance)
+    mismatches = int(np.sum(off & known))
+
+    lat = np.where(known, lat, c_lat)
+    lon = np.where(known, lon, c_lon)
+
+    return lat, lon, mismatches
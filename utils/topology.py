@@ -0,0 +1,198 @@
+"""
+Line topology from PLS-CADD section stringing, as compact CSR arrays
+"""
+
+import numpy as np
+from collections import OrderedDict
+
+
+def _csr(rows, n_rows):
+    """Row pointer and stable ordering that groups values by row"""
+    rows = np.asarray(rows, dtype=np.int64)
+    ptr = np.zeros(n_rows + 1, dtype=np.int64)
+    ptr[1:] = np.cumsum(np.bincount(rows, minlength=n_rows))
+    return ptr, np.argsort(rows, kind='stable')
+
+
+class LineTopology(object):
+    """Structures (nodes), spans (edges) and sections of one line
+
+    Everything is held in CSR form (ptr/values array pairs):
+
+        section -> structure indices in stringing order
+        structure -> sections strung through it
+        structure -> adjacent structures / span ids
+        span -> sections strung across it
+
+    Structure indices are rows of the StructureTable used to build it.
+    """
+    __slots__ = ('n_structures', 'section_numbers', 'section_row',
+                 'sec_ptr', 'sec_nodes', 'node_sec_ptr', 'node_secs',
+                 'span_from', 'span_to', 'span_ids', 'span_sec_ptr',
+                 'span_secs', 'adj_ptr', 'adj_nodes', 'adj_spans')
+
+    def __init__(self, n_structures, sections):
+        """
+        Args:
+            n_structures (int): number of structures (nodes)
+            sections (OrderedDict): section number -> structure indices
+        """
+        self.n_structures = n_structures
+        self.section_numbers = np.array(list(sections), dtype=np.int64)
+        self.section_row = {s: i for i, s in enumerate(sections)}
+
+        sec_lists = [list(v) for v in sections.values()]
+        lengths = np.array([len(v) for v in sec_lists], dtype=np.int64)
+        self.sec_ptr = np.concatenate([[0], np.cumsum(lengths)])
+        self.sec_nodes = np.array([n for v in sec_lists for n in v],
+                                  dtype=np.int64)
+
+        # structure -> sections
+        pairs = np.array(sorted({(n, i) for i, v in enumerate(sec_lists)
+                                 for n in v}), dtype=np.int64).reshape(-1, 2)
+        self.node_sec_ptr, order = _csr(pairs[:, 0], n_structures)
+        self.node_secs = pairs[order, 1]
+
+        # spans, numbered in first-strung order
+        self.span_ids = OrderedDict()
+        ends, span_secs = [], []
+        for i, v in enumerate(sec_lists):
+            for a, b in zip(v[:-1], v[1:]):
+                key = (a, b) if a <= b else (b, a)
+                if key not in self.span_ids:
+                    self.span_ids[key] = len(ends)
+                    ends.append((a, b))
+                span_secs.append((self.span_ids[key], i))
+        ends = np.array(ends, dtype=np.int64).reshape(-1, 2)
+        self.span_from, self.span_to = ends[:, 0], ends[:, 1]
+        span_secs = np.array(span_secs, dtype=np.int64).reshape(-1, 2)
+        self.span_sec_ptr, order = _csr(span_secs[:, 0], len(ends))
+        self.span_secs = span_secs[order, 1]
+
+        # structure adjacency, both directions
+        ids = np.arange(len(ends))
+        self.adj_ptr, order = _csr(np.r_[self.span_from, self.span_to],
+                                   n_structures)
+        self.adj_nodes = np.r_[self.span_to, self.span_from][order]
+        self.adj_spans = np.r_[ids, ids][order]
+
+    @classmethod
+    def from_xml(cls, stringing_rows, structures, attachments=None):
+        """Build from section_stringing_data rows
+
+        Args:
+            stringing_rows (list): section_stringing_data dicts, in order
+            structures: utils.model.StructureTable for the same XML
+            attachments: utils.model.AttachmentTable, resolves duplicated
+                structure numbers (see StructureTable.resolve)
+
+        Returns:
+            LineTopology
+        """
+        index = structures.resolve(stringing_rows, attachments).tolist()
+        sections = OrderedDict()
+        for row, node in zip(stringing_rows, index):
+            sections.setdefault(int(row['section_number']), []).append(node)
+
+        # section_stringing_data lists each structure once per section
+        for sect, nodes in sections.items():
+            sections[sect] = [n for i, n in enumerate(nodes)
+                              if i == 0 or n != nodes[i - 1]]
+
+        return cls(len(structures), OrderedDict(sorted(sections.items())))
+
+    def __len__(self):
+        return len(self.span_from)
+
+    # Sections
+    def section_structures(self, section):
+        """Structure indices of a section, in stringing order"""
+        i = self.section_row[section]
+        return self.sec_nodes[self.sec_ptr[i]:self.sec_ptr[i + 1]]
+
+    def section_ends(self, section):
+        """(from, to) structure indices of a section"""
+        i = self.section_row[section]
+        return (int(self.sec_nodes[self.sec_ptr[i]]),
+                int(self.sec_nodes[self.sec_ptr[i + 1] - 1]))
+
+    def section_spans(self, section):
+        """Span ids of a section, in stringing order"""
+        nodes = self.section_structures(section).tolist()
+        return [self.span_ids[(a, b) if a <= b else (b, a)]
+                for a, b in zip(nodes[:-1], nodes[1:])]
+
+    def structure_sections(self, structure):
+        """Section numbers strung through a structure"""
+        rows = self.node_secs[self.node_sec_ptr[structure]:
+                              self.node_sec_ptr[structure + 1]]
+        return self.section_numbers[rows]
+
+    # Spans
+    def span(self, a, b):
+        """Span id between two structures, or None"""
+        return self.span_ids.get((a, b) if a <= b else (b, a))
+
+    def span_sections(self, span):
+        """Section numbers strung across a span"""
+        rows = self.span_secs[self.span_sec_ptr[span]:
+                              self.span_sec_ptr[span + 1]]
+        return self.section_numbers[rows]
+
+    def multi_circuit_spans(self):
+        """Span ids carrying more than one section"""
+        return np.flatnonzero(np.diff(self.span_sec_ptr) > 1)
+
+    # Structures
+    def neighbours(self, structure):
+        return self.adj_nodes[self.adj_ptr[structure]:
+                              self.adj_ptr[structure + 1]]
+
+    def degree(self):
+        return np.diff(self.adj_ptr)
+
+    def dead_ends(self):
+        """Boolean mask of structures that start or end a section"""
+        mask = np.zeros(self.n_structures, dtype=bool)
+        mask[self.sec_nodes[self.sec_ptr[:-1]]] = True
+        mask[self.sec_nodes[self.sec_ptr[1:] - 1]] = True
+        return mask
+
+    def taps(self):
+        """Boolean mask of branch structures (three or more neighbours)"""
+        return self.degree() >= 3
+
+    def dead_end_paths(self):
+        """Structure paths between consecutive dead ends or taps
+
+        Every span belongs to exactly one path. Paths start and end at a
+        dead end, tap or line end and pass only through tangent structures.
+
+        Returns:
+            list of structure index arrays
+        """
+        stops = self.dead_ends() | (self.degree() != 2)
+        seen = np.zeros(len(self), dtype=bool)
+        paths = []
+        starts = np.r_[np.flatnonzero(stops),
+                       np.arange(self.n_structures)]  # loops without stops
+        for start in starts.tolist():
+            for k in range(self.adj_ptr[start], self.adj_ptr[start + 1]):
+                if seen[self.adj_spans[k]]:
+                    continue
+                path = [start]
+                node, k_next = start, k
+                while True:
+                    seen[self.adj_spans[k_next]] = True
+                    node = int(self.adj_nodes[k_next])
+                    path.append(node)
+                    if stops[node] or node == start:
+                        break
+                    ks = [j for j in range(self.adj_ptr[node],
+                                           self.adj_ptr[node + 1])
+                          if not seen[self.adj_spans[j]]]
+                    if not ks:
+                        break
+                    k_next = ks[0]
+                paths.append(np.array(path, dtype=np.int64))
+        return paths
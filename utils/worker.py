@@ -0,0 +1,318 @@
+"""
+Long running conversion worker, keeps arcpy/pandas/numpy and the tool
+modules imported between jobs.
+
+Jobs are dicts, submitted through a folder queue (any process, any
+language: drop a json file in <queue>/pending) or a local socket
+(multiprocessing.connection, authenticated with the per-install key in
+KEY_FILE, jobs and results are sent as json, never pickled):
+
+    {"type": "tower_report", "xml": "a.xml.gz;b.xml", "dst_dir": "...",
+     "export_shapes": true, "comments": [2, 3], "sr": 2227,
+     "catalog": "...", "materials": true, "blowout": true,
+     "parallel": 4, "write_report": false}
+
+    {"type": "xml_to_layer", "xml": "folder_or_zip", "sr": 2227,
+     "dst_dir": "...", "lines": "<line layer>", "conductors": "<table>",
+     "line_name": "...", "catalog": "...", "line_index": "...",
+     "parallel": true, "write_report": true}
+
+"parallel" parses the tables of each xml across processes (true: all
+cores), see utils.xml_tables.parallel_xml. "write_report": false skips the
+tower report csv (default true).
+
+Every job returns {"id", "status", "outputs", "metrics", "error"}.
+"""
+
+import json
+import os
+import secrets
+import threading
+import time
+import traceback
+import uuid
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from utils.messages import add_message, add_warning
+
+DEFAULT_ADDRESS = ('localhost', 6071)
+QUEUE_DIRS = ('pending', 'running', 'done')
+
+# Socket key, created on first use, readable by the current user only
+KEY_FILE = os.path.join(os.path.expanduser('~'), '.xml_worker_key')
+MAX_MESSAGE_BYTES = 1 << 20
+
+_tools = {}
+_job_lock = threading.Lock()  # arcpy work stays on one thread at a time
+
+
+def _load_tools():
+    """Import the tools once, this is the start-up cost the worker saves"""
+    if not _tools:
+        import xml_to_layer
+        from modeling import xml_to_tower_report
+        _tools['xml_to_layer'] = xml_to_layer
+        _tools['tower_report'] = xml_to_tower_report
+    return _tools
+
+
+def _spatial_reference(sr):
+    import arcpy
+    if sr in (None, ''):
+        return None
+    return arcpy.SpatialReference(int(sr) if str(sr).isdigit() else sr)
+
+
+def _tower_report_job(job, progress):
+    tool = _load_tools()['tower_report']
+    from utils.bom import summarize_materials, write_material_summary
+    from utils.plscadd_xml import expand_xml_inputs, xml_dir
+    outputs = []
+    materials = [] if job.get('materials') else None
+    xml_files = sorted(expand_xml_inputs(job['xml']))
+    for xml_file in xml_files:
+        outputs.append(tool.process_xml(
+            xml_file, job.get('dst_dir'), job.get('export_shapes', False),
+            job.get('comments'), _spatial_reference(job.get('sr')),
+            job.get('catalog'), progress, materials,
+            job.get('blowout', False), parallel=job.get('parallel', False),
+            write_report=job.get('write_report', True)))
+    if materials:
+        outputs.append({'materials': write_material_summary(
+            summarize_materials(materials),
+            job.get('dst_dir') or xml_dir(xml_files[0]))})
+    return outputs
+
+
+def _xml_to_layer_job(job, progress):
+    tool = _load_tools()['xml_to_layer']
+    from utils.misc import safe_name
+    from utils.plscadd_xml import expand_xml_inputs, xml_stem
+    xml_files = expand_xml_inputs(job['xml'])
+    sr = _spatial_reference(job.get('sr'))
+    if job.get('line_name') and len(xml_files) == 1:
+        arc_pro_list = tool.get_arc_pro_list(
+            job['lines'], job['line_name'], job['conductors'])
+        tool.process_xml(xml_files[0], sr, job['dst_dir'], arc_pro_list,
+                         job.get('catalog'), progress=progress,
+                         parallel=job.get('parallel', False),
+                         write_report=job.get('write_report', True))
+        return [{'gdb': os.path.join(job['dst_dir'], safe_name(
+            xml_stem(xml_files[0], archive=True)) + '_Shapes.gdb')}]
+    return [{'reconciliation': tool.bulk_reconcile(
+        xml_files, sr, job['dst_dir'], job['lines'], job['conductors'],
+        job.get('catalog'), progress, job.get('line_index'),
+        job.get('parallel', False), job.get('write_report', True))}]
+
+
+JOB_TYPES = {'tower_report': _tower_report_job,
+             'xml_to_layer': _xml_to_layer_job}
+
+
+def run_job(job, cancel_event=None):
+    """Run one job in this process
+
+    Returns:
+        result dict with outputs and metrics (seconds, bytes parsed)
+    """
+    from utils.plscadd_xml import expand_xml_inputs, xml_size
+    from utils.progress import Progress
+
+    job_id = job.get('id') or uuid.uuid4().hex
+    result = {'id': job_id, 'type': job.get('type'), 'status': 'error',
+              'outputs': [], 'metrics': {}, 'error': None}
+    start = time.time()
+    try:
+        if job.get('type') not in JOB_TYPES or not job.get('xml'):
+            raise ValueError('job needs xml and a type in {}'.format(
+                sorted(JOB_TYPES)))
+        xml_files = expand_xml_inputs(job['xml'])
+        progress = Progress.for_files(
+            xml_files, job.get('type', ''), size=xml_size,
+            cancel_event=cancel_event)
+        with _job_lock:
+            result['outputs'] = JOB_TYPES[job['type']](job, progress)
+        result['status'] = 'done'
+        result['metrics'].update({'xml_files': len(xml_files),
+                                  'bytes': progress.bytes_done})
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+    result['metrics']['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+# File queue
+def _queue_paths(queue_dir):
+    paths = [os.path.join(queue_dir, d) for d in QUEUE_DIRS]
+    for path in paths:
+        os.makedirs(path, exist_ok=True)
+    return paths
+
+
+def submit_job(queue_dir, job):
+    """Write a job into the queue folder, returns the job id"""
+    pending = _queue_paths(queue_dir)[0]
+    job = dict(job, id=job.get('id') or uuid.uuid4().hex)
+    tmp = os.path.join(pending, job['id'] + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp, os.path.join(pending, job['id'] + '.json'))
+    return job['id']
+
+
+def job_result(queue_dir, job_id, timeout=None, poll=0.5):
+    """Wait for and return a queued job's result (None on timeout)"""
+    path = os.path.join(queue_dir, 'done', job_id + '.json')
+    start = time.time()
+    while not os.path.exists(path):
+        if timeout is not None and time.time() - start > timeout:
+            return None
+        time.sleep(poll)
+    with open(path) as f:
+        return json.load(f)
+
+
+def _claim(pending, running):
+    """Move the oldest pending job to running, atomic across workers"""
+    names = sorted((n for n in os.listdir(pending) if n.endswith('.json')),
+                   key=lambda n: os.path.getmtime(os.path.join(pending, n)))
+    for name in names:
+        try:
+            os.replace(os.path.join(pending, name),
+                       os.path.join(running, name))
+        except OSError:
+            continue  # taken by another worker
+        return os.path.join(running, name)
+    return None
+
+
+def serve_queue(queue_dir, poll=1.0, stop_event=None, once=False):
+    """Process jobs from <queue_dir>/pending until stopped
+
+    Results are written to <queue_dir>/done/<id>.json, a job without an id
+    takes the name of its file (pending/a.json: done/a.json). Unreadable
+    job files get an error result.
+    """
+    pending, running, done = _queue_paths(queue_dir)
+    _load_tools()
+    add_message('Worker watching {}'.format(pending))
+    while stop_event is None or not stop_event.is_set():
+        path = _claim(pending, running)
+        if path is None:
+            if once:
+                return
+            time.sleep(poll)
+            continue
+
+        job_id = os.path.splitext(os.path.basename(path))[0]
+        try:
+            with open(path) as f:
+                job = json.load(f)
+            if not isinstance(job, dict):
+                raise ValueError('job must be a json object')
+        except (OSError, ValueError) as e:
+            result = {'id': job_id, 'type': None, 'status': 'error',
+                      'outputs': [], 'metrics': {'seconds': 0},
+                      'error': 'invalid job file: {}: {}'.format(
+                          type(e).__name__, e)}
+        else:
+            job['id'] = job.get('id') or job_id
+            result = run_job(job, stop_event)
+        tmp = os.path.join(done, result['id'] + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(result, f, indent=2, default=str)
+        os.replace(tmp, os.path.join(done, result['id'] + '.json'))
+        os.remove(path)
+        add_message('{} {} in {}s'.format(result['id'], result['status'],
+                                          result['metrics']['seconds']))
+
+
+# Local socket
+def worker_authkey(key_file=None):
+    """Socket authkey of this install, a random key created on first use
+
+    The key file is created with user only permissions (on Windows it
+    inherits the user profile's ACL), so other local users can neither
+    submit jobs nor impersonate the worker.
+    """
+    key_file = key_file or KEY_FILE
+    if not os.path.exists(key_file):
+        try:
+            fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o600)
+        except FileExistsError:
+            pass  # created by another worker meanwhile
+        else:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(secrets.token_hex(32).encode())
+    with open(key_file, 'rb') as f:
+        key = f.read().strip()
+    if not key:
+        raise ValueError('empty worker key {}'.format(key_file))
+    return key
+
+
+def _send(conn, obj):
+    conn.send_bytes(json.dumps(obj, default=str).encode('utf-8'))
+
+
+def _recv(conn):
+    return json.loads(conn.recv_bytes(MAX_MESSAGE_BYTES).decode('utf-8'))
+
+
+def serve_socket(address=DEFAULT_ADDRESS, authkey=None, stop_event=None):
+    """Accept json jobs over a local authenticated socket, one at a time"""
+    _load_tools()
+    authkey = authkey or worker_authkey()
+    with Listener(address, authkey=authkey) as listener:
+        add_message('Worker listening on {}:{}'.format(*address))
+        while stop_event is None or not stop_event.is_set():
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError, EOFError) as e:
+                add_warning('Rejected connection, {}'.format(e))
+                continue
+            with conn:
+                try:
+                    job = _recv(conn)
+                except (OSError, EOFError, ValueError) as e:
+                    add_warning('Rejected message, {}'.format(e))
+                    continue
+                if job == 'stop':
+                    _send(conn, {'status': 'stopped'})
+                    return
+                if not isinstance(job, dict):
+                    _send(conn, {'status': 'error',
+                                 'error': 'job must be a json object'})
+                    continue
+                _send(conn, run_job(job, stop_event))
+
+
+def submit(job, address=DEFAULT_ADDRESS, authkey=None):
+    """Send a job to a socket worker and wait for its result"""
+    with Client(tuple(address), authkey=authkey or worker_authkey()) as conn:
+        _send(conn, job)
+        return _recv(conn)
+
+
+def serve(queue_dir=None, address=None, authkey=None):
+    """Serve the queue folder and/or socket until interrupted"""
+    stop_event = threading.Event()
+    threads = []
+    if queue_dir:
+        threads.append(threading.Thread(
+            target=serve_queue, args=(queue_dir,),
+            kwargs={'stop_event': stop_event}, daemon=True))
+    if address:
+        threads.append(threading.Thread(
+            target=serve_socket, args=(address, authkey, stop_event),
+            daemon=True))
+    for t in threads:
+        t.start()
+    try:
+        while any(t.is_alive() for t in threads):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        stop_event.set()
@@ -0,0 +1,280 @@
+"""
+PLS-CADD XML tables as Python dicts, serially or in parallel
+
+The big tables of a PLS-CADD export are independent top level <table>
+blocks, so a file can be cut at table (and row) boundaries and each block
+parsed in its own process. Nothing here imports arcpy, so worker processes
+start quickly.
+"""
+
+import mmap
+import os
+import re
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import xml.etree.cElementTree as et
+except ImportError:
+    import xml.etree.ElementTree as et
+
+TABLE_START_RE = re.compile(rb'<table[\s>]')
+TABLE_END = b'</table>'
+DECLARATION_RE = re.compile(rb'^\s*<\?xml[^>]*\?>')
+
+CHUNK_BYTES = 16 * 1024 * 1024  # rows of larger tables are split in chunks
+
+
+class TableRows(list):
+    """Rows of a table parsed ahead of time, [(rownum, {column: text})],
+    read by xml_table_element_dict in place of the table element"""
+    __slots__ = ()
+
+
+class ParsedXml(object):
+    """Headers and tables of an XML parsed with parallel_xml, stands in for
+    the root element (see utils.plscadd_xml.root_tables and root_header)
+    """
+    __slots__ = ('xml_file', 'headers', 'tables')
+
+    def __init__(self, xml_file, headers, tables):
+        self.xml_file = xml_file
+        self.headers = headers  # tag: attributes, see xml_headers
+        self.tables = tables  # tagname: TableRows, like root_tables
+
+
+def xml_table_element_dict(table, tags=None, as_list=False, where=None):
+    """Converts XML Table Element to Python Dictionary
+       table is element where element.tag=='table' (or TableRows)
+       if tags=None, return all tags. Else, return only Tags.
+       where={column: value or values} keeps only the matching rows, they
+       are tested before any other cell is read (missing or empty cells
+       compare as '')
+    """
+    output = {}
+    if as_list:
+        output = []
+
+    tags = set(tags) - {'rowtext'} if tags else None
+    conditions = [(col, {value} if isinstance(value, str) else set(value))
+                  for col, value in (where or {}).items()]
+
+    if isinstance(table, TableRows):
+        for rownum, row in table:
+            if conditions and not all((row.get(col) or '') in values
+                                      for col, values in conditions):
+                continue
+            row_dict = dict(row) if tags is None else \
+                {k: v for k, v in row.items() if k in tags}
+            if as_list:
+                output.append(row_dict)
+            else:
+                output[rownum] = row_dict
+        return output
+
+    for row in table:
+        if conditions and not all(row.findtext(col, '') in values
+                                  for col, values in conditions):
+            continue
+
+        if tags is None:
+            row_dict = {col.tag: col.text for col in row
+                        if col.tag != 'rowtext'}
+        else:
+            row_dict = {col.tag: col.text for col in row if col.tag in tags}
+
+        if as_list:
+            output.append(row_dict)
+        else:
+            output[int(row.get('rownum'))] = row_dict
+
+    return output
+
+
+def table_blocks(data, tables=None, chunk_bytes=CHUNK_BYTES):
+    """Byte ranges of the top level tables of an XML buffer
+
+    Tables with nrows='0' are skipped like utils.plscadd_xml.root_tables.
+    Tables larger than chunk_bytes are split at row starts.
+
+    Args:
+        data: bytes or mmap of the whole XML
+        tables (iterable): tagnames to keep (all if None)
+        chunk_bytes (int): target size of one block
+
+    Returns:
+        list of (tagname, open tag bytes, [(start, end), ...]), the ranges
+        cover the rows of the table in order
+    """
+    keep = set(tables) if tables is not None else None
+    blocks = []
+    match = TABLE_START_RE.search(data)
+    while match:
+        start = match.start()
+        head_end = data.find(b'>', start) + 1
+        end = data.find(TABLE_END, head_end)
+        if not head_end or end < 0:
+            raise ValueError('unterminated <table> at byte {}'.format(start))
+        open_tag = bytes(data[start:head_end])
+        match = TABLE_START_RE.search(data, end)
+
+        if open_tag.endswith(b'/>'):
+            continue
+        attrs = et.fromstring(open_tag + TABLE_END).attrib
+        name = attrs.get('tagname')
+        if not int(attrs.get('nrows') or 0) or \
+                (keep is not None and name not in keep):
+            continue
+
+        # cut at the next row start past every chunk_bytes
+        row_start = re.compile(b'<' + re.escape(name.encode()) + rb'[\s>/]')
+        cuts = [head_end]
+        pos = head_end + chunk_bytes
+        while pos < end:
+            row = row_start.search(data, pos, end)
+            if row is None:
+                break
+            cuts.append(row.start())
+            pos = row.start() + chunk_bytes
+        cuts.append(end)
+        blocks.append((name, open_tag, list(zip(cuts[:-1], cuts[1:]))))
+    return blocks
+
+
+def _parse_block(declaration, open_tag, body, tags=None, as_list=False,
+                 where=None):
+    """Worker: rows of one block, see xml_table_element_dict"""
+    if isinstance(body, tuple):  # (path, start, end) of a plain file
+        path, start, end = body
+        with open(path, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start)
+    table = et.fromstring(declaration + open_tag + body + TABLE_END)
+    return xml_table_element_dict(table, tags, as_list, where)
+
+
+def _pool_executable():
+    """Python interpreter for worker processes
+
+    Inside ArcGIS Pro sys.executable is the application, workers must be
+    started with the environment's python instead.
+    """
+    import multiprocessing
+    name = os.path.basename(sys.executable).lower()
+    if not name.startswith('python'):
+        for exe in ('pythonw.exe', 'python.exe', 'bin/python'):
+            path = os.path.join(sys.exec_prefix, exe)
+            if os.path.isfile(path):
+                multiprocessing.set_executable(path)
+                break
+
+
+def parallel_table_dicts(xml_file, tables=None, tags=None, as_list=False,
+                         max_workers=None, chunk_bytes=CHUNK_BYTES,
+                         where=None):
+    """Parse the tables of one XML across processes
+
+    Returns exactly what xml_table_element_dict returns for each table of
+    utils.plscadd_xml.get_xml_tables(xml_file).
+
+    Args:
+        xml_file (str): path, compressed or zip member (see open_xml)
+        tables (iterable): tagnames to parse (all if None)
+        tags (iterable): columns to keep (all if None)
+        as_list (bool): rows as a list instead of a rownum dict
+        max_workers (int): processes (default os.cpu_count()), 1 parses
+            in this process
+        chunk_bytes (int): rows of larger tables are split in blocks
+        where (dict): row filter applied in the workers, see
+            xml_table_element_dict
+
+    Returns:
+        OrderedDict of tagname to rows, in file order
+    """
+    from utils.plscadd_xml import XML_COMPRESSION, open_xml
+
+    # plain files are mapped and read back by the workers, compressed and
+    # zip member files are decompressed once here
+    plain = os.path.isfile(xml_file) and \
+        not xml_file.lower().endswith('.zip') and \
+        os.path.splitext(xml_file)[1].lower() not in XML_COMPRESSION
+    with open_xml(xml_file) as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+            if plain else f.read()
+
+    try:
+        declaration = DECLARATION_RE.match(data)
+        declaration = declaration.group(0) if declaration else b''
+        jobs = [((i, name), (declaration, open_tag,
+                             (xml_file, start, end) if plain
+                             else bytes(data[start:end]), tags, as_list,
+                             where))
+                for i, (name, open_tag, ranges) in enumerate(
+                    table_blocks(data, tables, chunk_bytes))
+                for start, end in ranges]
+    finally:
+        if plain:
+            data.close()
+
+    if max_workers == 1 or len(jobs) < 2:
+        results = [_parse_block(*args) for _, args in jobs]
+    else:
+        _pool_executable()
+        with ProcessPoolExecutor(max_workers) as pool:
+            results = list(pool.map(_parse_block,
+                                    *zip(*[args for _, args in jobs])))
+
+    # merge row blocks in order, a repeated tagname replaces the earlier
+    # table like root_tables does
+    output = OrderedDict()
+    blocks = {}
+    for ((block, name), _), rows in zip(jobs, results):
+        if blocks.get(name) != block:
+            blocks[name] = block
+            output.pop(name, None)
+            output[name] = rows
+        elif as_list:
+            output[name].extend(rows)
+        else:
+            output[name].update(rows)
+    return output
+
+
+def xml_headers(xml_file, read_bytes=1 << 16):
+    """Tag: attributes of the elements ahead of the first table (creator,
+    ...), read without parsing the tables"""
+    from utils.plscadd_xml import open_xml
+
+    data = b''
+    with open_xml(xml_file) as f:
+        while True:
+            chunk = f.read(read_bytes)
+            data += chunk
+            table = TABLE_START_RE.search(data)
+            if table or not chunk:
+                break
+    if not table:
+        return OrderedDict()
+
+    prolog = data[:table.start()]
+    declaration = DECLARATION_RE.match(prolog)
+    declaration = declaration.group(0) if declaration else b''
+    root = re.search(rb'<[^?!][^>]*>', prolog[len(declaration):])
+    if root is None:
+        return OrderedDict()
+    children = prolog[len(declaration) + root.end():]
+    return OrderedDict((e.tag, e.attrib) for e in et.fromstring(
+        declaration + b'<headers>' + children + b'</headers>'))
+
+
+def parallel_xml(xml_file, max_workers=None, chunk_bytes=CHUNK_BYTES):
+    """Parse an XML across processes into a ParsedXml
+
+    Every table keeps all columns, builders then read them through
+    xml_table_element_dict as they would the parsed elements.
+    """
+    tables = parallel_table_dicts(xml_file, max_workers=max_workers,
+                                  chunk_bytes=chunk_bytes)
+    return ParsedXml(xml_file, xml_headers(xml_file), OrderedDict(
+        (name, TableRows(rows.items())) for name, rows in tables.items()))
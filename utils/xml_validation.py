@@ -0,0 +1,256 @@
+"""
+Pre-flight checks of PLS-CADD XML tables before any arcpy output is written
+"""
+
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+from utils.messages import add_error, add_warning
+from utils.plscadd_xml import root_tables, xml_root
+from utils.xml_tables import TableRows
+
+ERROR = 'ERROR'
+WARNING = 'WARNING'
+
+STRUCTURE_TABLES = ('construction_staking_report',
+                    'structure_coordinates_report')
+
+# table: columns needed by the builders
+REQUIRED_COLUMNS = OrderedDict([
+    ('construction_staking_report', ('structure_number', 'stake_description',
+                                     'x_easting', 'y_northing',
+                                     'z_elevation')),
+    ('structure_coordinates_report', ('struct_number', 'x', 'y', 'z')),
+    ('section_geometry_data', ('sec_no', 'from_str', 'to_str',
+                               'number_of_phases', 'wires_per_phase',
+                               'cable_file_name')),
+    ('section_stringing_data', ('section_number', 'struct_number',
+                                'set_number', 'phasing')),
+    ('structure_attachment_coordinates', ('struct_number', 'set_no',
+                                          'phase_no', 'wire_attach_point_x',
+                                          'wire_attach_point_y',
+                                          'wire_attach_point_z')),
+])
+
+# table: columns that must parse as numbers
+NUMERIC_COLUMNS = {
+    'construction_staking_report': ('x_easting', 'y_northing',
+                                    'z_elevation'),
+    'structure_coordinates_report': ('x', 'y', 'z'),
+    'section_geometry_data': ('sec_no', 'number_of_phases',
+                              'wires_per_phase'),
+    'section_stringing_data': ('section_number', 'set_number'),
+    'structure_attachment_coordinates': ('set_no', 'phase_no',
+                                         'wire_attach_point_x',
+                                         'wire_attach_point_y',
+                                         'wire_attach_point_z'),
+}
+
+
+class XmlValidationError(Exception):
+    """Raised by check_xml when the XML has errors"""
+
+    def __init__(self, report):
+        self.report = report
+        super(XmlValidationError, self).__init__(
+            '{} XML validation error(s)'.format(len(report.errors)))
+
+
+class ValidationReport(object):
+    """Structured result of validate_xml"""
+
+    def __init__(self, source=None):
+        self.source = source
+        self.issues = []
+
+    def add(self, severity, table, column, message, values=()):
+        values = list(values)
+        self.issues.append(OrderedDict([
+            ('severity', severity), ('table', table), ('column', column),
+            ('message', message), ('count', len(values)),
+            ('examples', [str(v) for v in values[:5]])]))
+
+    @property
+    def errors(self):
+        return [i for i in self.issues if i['severity'] == ERROR]
+
+    @property
+    def warnings(self):
+        return [i for i in self.issues if i['severity'] == WARNING]
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def lines(self):
+        for i in self.issues:
+            where = '.'.join(p for p in (i['table'], i['column']) if p)
+            examples = ' ({})'.format(', '.join(i['examples'])) \
+                if i['examples'] else ''
+            count = ' x{}'.format(i['count']) if i['count'] else ''
+            yield '{} {}: {}{}{}'.format(i['severity'], where, i['message'],
+                                         count, examples)
+
+    def to_frame(self):
+        return pd.DataFrame(self.issues,
+                            columns=['severity', 'table', 'column',
+                                     'message', 'count', 'examples'])
+
+
+def table_columns(table, columns=None):
+    """Table element (or TableRows) to {column: object array of text}, one
+    pass over rows"""
+    if isinstance(table, TableRows):
+        rows = [row for _, row in table]
+    else:
+        rows = [{col.tag: col.text for col in row} for row in table]
+    names = columns or sorted({c for r in rows for c in r} - {'rowtext'})
+    return OrderedDict(
+        (c, np.array([r.get(c) for r in rows], dtype=object)) for c in names
+    ), {c for r in rows for c in r}
+
+
+def _not_numeric(values):
+    """Values that are present but do not parse as numbers"""
+    parsed = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy()
+    present = np.array([v is not None and str(v).strip() != ''
+                        for v in values], dtype=bool)
+    return values[present & np.isnan(parsed)]
+
+
+def _missing(values, keys):
+    """Values not found in keys, vectorized membership"""
+    values = values[np.array([v is not None for v in values],
+                             dtype=bool)].astype(str)
+    return np.unique(values[~np.isin(values, np.asarray(list(keys),
+                                                        dtype=str))])
+
+
+def validate_tables(xml_tables, spans=True, source=None):
+    """Check required columns, numeric columns and cross-table references
+
+    Args:
+        xml_tables (dict): tagname: table element, see root_tables
+        spans (bool): stringing/section/attachment tables are required
+            (span and wire outputs), otherwise their problems are warnings
+        source (str): file name for the report
+
+    Returns:
+        ValidationReport
+    """
+    report = ValidationReport(source)
+    span_level = ERROR if spans else WARNING
+
+    structure_table = next((t for t in STRUCTURE_TABLES if t in xml_tables),
+                           None)
+    if structure_table is None:
+        report.add(ERROR, None, None, 'no structure table, expected one of '
+                   '{}'.format(', '.join(STRUCTURE_TABLES)))
+    elif spans and structure_table != STRUCTURE_TABLES[0]:
+        report.add(ERROR, STRUCTURE_TABLES[0], None,
+                   'required for spans, not in file')
+
+    columns = {}
+    for table, required in REQUIRED_COLUMNS.items():
+        if table in STRUCTURE_TABLES and table != structure_table:
+            continue
+        if table not in xml_tables:
+            if table not in STRUCTURE_TABLES:
+                report.add(span_level, table, None, 'table missing or empty')
+            continue
+
+        wanted = required + ('structure_comment_1',) \
+            if table == STRUCTURE_TABLES[0] else required
+        columns[table], present = table_columns(xml_tables[table], wanted)
+        level = ERROR if table == structure_table else span_level
+        for col in required:
+            if col not in present:
+                report.add(level, table, col, 'required column missing')
+                columns[table].pop(col)
+        for col in NUMERIC_COLUMNS.get(table, ()):
+            if col in columns[table]:
+                bad = _not_numeric(columns[table][col])
+                if len(bad):
+                    report.add(level, table, col, 'not numeric', bad)
+
+    # Structure keys, structure hubs only from the staking report
+    structures = columns.get(structure_table, {})
+    key = 'structure_number' if structure_table == STRUCTURE_TABLES[0] \
+        else 'struct_number'
+    if key not in structures:
+        return report
+
+    keys = structures[key]
+    if 'stake_description' in structures:
+        hubs = structures['stake_description'] == 'Structure Hub'
+        if not hubs.any():
+            report.add(ERROR, structure_table, 'stake_description',
+                       "no 'Structure Hub' rows")
+        keys = keys[hubs]
+        if 'structure_comment_1' in structures:
+            names = structures['structure_comment_1'][hubs]
+            empty = np.array([not n for n in names], dtype=bool)
+            if empty.any():
+                report.add(WARNING, structure_table, 'structure_comment_1',
+                           'empty structure name', keys[empty])
+
+    values, counts = np.unique(keys.astype(str), return_counts=True)
+    if (counts > 1).any():
+        report.add(WARNING, structure_table, key,
+                   'duplicate structure number, resolved by attachment '
+                   'position and stringing order',
+                   values[counts > 1])
+    keys = set(values)
+
+    # References into the structure table
+    for table, col in (('section_stringing_data', 'struct_number'),
+                       ('section_geometry_data', 'from_str'),
+                       ('section_geometry_data', 'to_str'),
+                       ('structure_attachment_coordinates', 'struct_number')):
+        if col in columns.get(table, {}):
+            missing = _missing(columns[table][col], keys)
+            if len(missing):
+                report.add(span_level, table, col,
+                           'structure not in {}'.format(structure_table),
+                           missing)
+
+    # Stringing sections must have section geometry
+    stringing = columns.get('section_stringing_data', {})
+    geometry = columns.get('section_geometry_data', {})
+    if 'section_number' in stringing and 'sec_no' in geometry:
+        missing = _missing(stringing['section_number'],
+                           set(geometry['sec_no'].astype(str)))
+        if len(missing):
+            report.add(span_level, 'section_stringing_data',
+                       'section_number', 'section not in '
+                       'section_geometry_data', missing)
+
+    return report
+
+
+def validate_xml(xml_file, spans=True):
+    """Validate an XML file (or parsed root) before processing
+
+    Returns:
+        ValidationReport
+    """
+    source = xml_file if isinstance(xml_file, str) else None
+    return validate_tables(root_tables(xml_root(xml_file)), spans, source)
+
+
+def check_xml(xml_file, spans=True):
+    """Validate, log every issue and raise XmlValidationError on errors
+
+    Returns:
+        ValidationReport (warnings only)
+    """
+    report = validate_xml(xml_file, spans)
+    for issue, line in zip(report.issues, report.lines()):
+        if issue['severity'] == ERROR:
+            add_error('\n    - {}'.format(line))
+        else:
+            add_warning('\n    - {}'.format(line))
+    if not report.ok:
+        raise XmlValidationError(report)
+    return report
@@ -3,8 +3,14 @@ Produce formatted layer for snow load quality control
 """
 
 import arcpy
+import copy
+import csv
+import difflib
 import os
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ET
 
 if __name__ == "__main__" and __package__ is None:
@@ -14,11 +20,24 @@ if __name__ == "__main__" and __package__ is None:
                 os.path.dirname(
                     os.path.abspath(__file__)))))
 
-
-from utils.messages import add_message, add_warning
-from utils.misc import safe_name
-from utils.plscadd_xml import xml_to_spans, xml_to_tower_report
+# First, its reload_modules re-executes the utils modules, names imported
+# from them before it (Cancelled, XmlValidationError) would go stale
 from modeling.xml_to_tower_report import tower_report_to_shape
+from utils.catalog import catalog_line
+from utils.line_index import LineIndex
+from utils.matching import ordered_assignment, similarity_matrix
+from utils.messages import add_error, add_message, add_warning
+from utils.misc import add_indexes, safe_name
+from utils.model import ConductorRecord
+from utils.plscadd_xml import (expand_xml_inputs, hub_structures, root_tables,
+                               xml_line, xml_root, xml_size, xml_stem,
+                               xml_to_spans, xml_to_tower_report_df,
+                               write_tower_report, SPATIAL_INDEX,
+                               TOWER_REPORT_INDEXES)
+from utils.pipeline import prefetch
+from utils.progress import (BackgroundProgress, Cancelled, Progress,
+                            cleanup_outputs)
+from utils.xml_validation import XmlValidationError, check_xml
 
 arcpy.env.overwriteOutput = True
 
@@ -53,8 +72,11 @@ EXT_WIRE = '.wir'
 FIELD_TO = 'TO_STR'
 FIELD_FROM = 'FROM_STR'
 
+# Attribute indexes of the section layers, see utils.misc.add_indexes
+SECTION_INDEXES = [FIELD_SECTION, FIELD_CABLE, FIELD_FROM, FIELD_TO]
+
 
-def prep_for_qc(spans, sections):
+def prep_for_qc(spans, sections, line=None):
     """
     Dissolves input layer by CABLE_FILE attribute, then adds
     a SNOWLOAD attribute based on cable file name. All results are in-memory and
@@ -63,6 +85,8 @@ def prep_for_qc(spans, sections):
     Args:
         lyr: layer from active map
         sym: optional symbology file to apply to output
+        line: optional (StructureTable, LineTopology) from xml_line, FROM/TO
+            are then taken from section ends instead of span order
     """
     #todo:
     # add back in "to" and "from" to sections feature class
@@ -83,6 +107,21 @@ def prep_for_qc(spans, sections):
         for row in cursor:
             row[1] = row[0].split('-')[-1].replace(EXT_WIRE, '')
             cursor.updateRow(row)
+
+    if line is not None:
+        structures, topology = line
+        names = structures.data['name']
+        with arcpy.da.UpdateCursor(sections, (FIELD_SECTION, FIELD_FROM,
+                                              FIELD_TO)) as cursor:
+            for row in cursor:
+                if row[0] not in topology.section_row:
+                    continue
+                from_str, to_str = topology.section_ends(row[0])
+                row[1], row[2] = str(names[from_str]), str(names[to_str])
+                cursor.updateRow(row)
+        add_indexes(sections, SECTION_INDEXES, SPATIAL_INDEX)
+        return
+
     # Populate lis of "from" structures from the spans list
     with arcpy.da.SearchCursor(spans, spans_feature_list) as cursor:
         for row in cursor:
@@ -112,6 +151,8 @@ def prep_for_qc(spans, sections):
             de_list_to_counter += 1
             cursor.updateRow(row)
 
+    add_indexes(sections, SECTION_INDEXES, SPATIAL_INDEX)
+
 def apply_unique_symbology_to_sections_layer(dst_gdb):
     '''This currently does not work.'''
     relpath = os.path.dirname(sys.argv[0])
@@ -141,51 +182,27 @@ def apply_unique_symbology_to_sections_layer(dst_gdb):
 
     
 
-def similarity_ratio(str1, str2):
-    def string_sim():
-        set1 = set(str1)
-        set2 = set(str2)
-        common_chars = set1.intersection(set2)
-        if len(set1) == 0 and len(set2) == 0:
-            return 0
-        else:
-            similarity_ratio = len(common_chars) / (len(set1) + len(set2) - len(common_chars))
-            
-            return similarity_ratio
-    if str1 == str2:
-        return 1.4
-    elif str1 in str2 or str2 in str1:
-        return 1.3
-    elif "/" in str1 and "/" in str2:
-        
-        if str1.split("/")[1] == str2.split("/")[1]:
-            
-            return 1.2
-        elif str1.split("/")[1] in str2.split("/")[1] or str2.split("/")[1] in str1.split("/")[1]:
-            
-            return 1.1
-        else:
-            return string_sim()
-    else:    
-        return string_sim()
-            
-def get_arc_pro_list():
-    '''This function takes the OH-conductor info table (standalone table), and returns a list of dictionaries with 
-    "SAP_FUNC_LOC_NO",
-    "CONDUCTOR_TYPE",
-    "CONDUCTOR_SIZE",
-    "CONDUCTOR_STRAND",
-    "FROM_SAP_STRUCTURE_NO",
-    "TO_SAP_STRUCTURE_NO",
+def get_arc_pro_list(input_feature_layer=None, line_name=None, standalone_table=None):
+    '''This function takes the OH-conductor info table (standalone table), and returns a list of ConductorRecord with
+    sap_func_loc_no,
+    conductor_type,
+    conductor_size,
+    conductor_strand,
+    from_structure,
+    to_structure,
     and 
-    "BEST_MATCH_QSI_TOWER",
-    "BEST_MATCH_PERCENT",
-    as 0 so they can be replaced later'''
+    best_match,
+    best_match_percent,
+    as 0 so they can be replaced later.
+    Inputs default to the tool parameters.'''
 
     arcpy.AddMessage(f"getting arc pro list")
-    input_feature_layer = arcpy.GetParameter(3)
-    line_name = arcpy.GetParameter(4)
-    standalone_table = arcpy.GetParameter(5)
+    if input_feature_layer is None:
+        input_feature_layer = arcpy.GetParameter(3)
+    if line_name is None:
+        line_name = arcpy.GetParameter(4)
+    if standalone_table is None:
+        standalone_table = arcpy.GetParameter(5)
 
     field = "LINE_NAME"
     where_clause = f"{arcpy.AddFieldDelimiters(input_feature_layer, field)} = '{line_name}'"
@@ -201,30 +218,190 @@ def get_arc_pro_list():
         # Construct where_clause_2 using saps_func_location_number
         where_clause_2 = f"SAP_FUNC_LOC_NO = '{saps_func_location_number}'"
         # Search cursor to find related records in standalone_table
-        with arcpy.da.SearchCursor(standalone_table, ["SAP_FUNC_LOC_NO", "CONDUCTOR_TYPE", "CONDUCTOR_SIZE", "CONDUCTOR_STRAND", "FROM_SAP_STRUCTURE_NO", "TO_SAP_STRUCTURE_NO"], where_clause_2) as cursor:
+        with arcpy.da.SearchCursor(standalone_table, CONDUCTOR_FIELDS, where_clause_2) as cursor:
             for row in cursor:
                 # Return all rows in standalone_table where SAP_FUNC_LOC_NO == saps_func_location_number
-                arc_pro_list.append({
-                    "SAP_FUNC_LOC_NO":f"{row[0]}",
-                    "CONDUCTOR_TYPE":f"{row[1]}",
-                    "CONDUCTOR_SIZE":f"{row[2]}",
-                    "CONDUCTOR_STRAND":f"{row[3]}",
-                    "FROM_SAP_STRUCTURE_NO":f"{row[4]}",
-                    "TO_SAP_STRUCTURE_NO":f"{row[5]}",
-                    "BEST_MATCH_QSI_TOWER":0,
-                    "BEST_MATCH_PERCENT":0,
-                    })
+                arc_pro_list.append(ConductorRecord(*[f"{v}" for v in row]))
     else:
         arcpy.AddMessage("No matching saps_func_location_number found.")
     
     # changing CU to copper for fuzzy finder
     for item in arc_pro_list:
-        if item["CONDUCTOR_TYPE"] == "CU":
-            item["CONDUCTOR_TYPE"] = "copper"
+        if item.conductor_type == "CU":
+            item.conductor_type = "copper"
     
     return arc_pro_list
 
 
+CONDUCTOR_FIELDS = ["SAP_FUNC_LOC_NO", "CONDUCTOR_TYPE", "CONDUCTOR_SIZE",
+                    "CONDUCTOR_STRAND", "FROM_SAP_STRUCTURE_NO",
+                    "TO_SAP_STRUCTURE_NO"]
+
+RECONCILIATION_FIELDS = ['LINE_NAME', 'XML_FILE', 'SAP_FUNC_LOC_NO', 'LAYER',
+                         'ARC_FROM_STRUCTURE', 'ARC_TO_STRUCTURE', 'WIRE',
+                         'BEST_MATCH', 'BEST_MATCH_PERCENT']
+
+
+def read_line_sap_numbers(input_feature_layer):
+    """Read every LINE_NAME -> SAP_FUNC_L pair from the line layer in one pass
+
+    Args:
+        input_feature_layer: planning line layer with LINE_NAME and SAP_FUNC_L
+
+    Returns:
+        OrderedDict of line name to SAP functional location number
+    """
+    lines = OrderedDict()
+    with arcpy.da.SearchCursor(input_feature_layer,
+                               ["LINE_NAME", "SAP_FUNC_L"]) as cursor:
+        for line_name, sap_no in cursor:
+            if line_name and sap_no is not None:
+                lines.setdefault(line_name, f"{sap_no}")
+    return lines
+
+
+def read_conductor_records(standalone_table, sap_numbers=None):
+    """Read the OH conductor table once, grouped by SAP_FUNC_LOC_NO
+
+    Args:
+        standalone_table: OH conductor info table
+        sap_numbers (iterable): keep only these SAP numbers (all if None)
+
+    Returns:
+        OrderedDict of SAP number to a list of ConductorRecord
+    """
+    keep = set(sap_numbers) if sap_numbers is not None else None
+    grouped = OrderedDict()
+    with arcpy.da.SearchCursor(standalone_table, CONDUCTOR_FIELDS) as cursor:
+        for row in cursor:
+            record = ConductorRecord(*[f"{v}" for v in row])
+            if keep is not None and record.sap_func_loc_no not in keep:
+                continue
+            # changing CU to copper for fuzzy finder
+            if record.conductor_type == "CU":
+                record.conductor_type = "copper"
+            grouped.setdefault(record.sap_func_loc_no, []).append(record)
+    return grouped
+
+
+def _line_key(name):
+    return safe_name(name).replace('_', '')
+
+
+def match_xml_lines(xml_files, line_names, cutoff=0.8):
+    """Pair each XML export with a line name from the line layer
+
+    Names are compared after safe_name normalisation (so
+    'IGNACIO-MARE ISLAND #2' matches IGNACIO_MARE_ISLAND_2.xml), falling
+    back to the closest name above the cutoff ratio.
+
+    Args:
+        xml_files (list): XML file paths
+        line_names (iterable): LINE_NAME values
+        cutoff (float): minimum difflib ratio for a fuzzy match
+
+    Returns:
+        list of (xml_file, line_name or None)
+    """
+    keys = OrderedDict()
+    for line_name in line_names:
+        keys.setdefault(_line_key(line_name), line_name)
+
+    pairs = []
+    for xml_file in xml_files:
+        key = _line_key(xml_stem(xml_file))
+        if key not in keys:
+            close = difflib.get_close_matches(key, keys, n=1, cutoff=cutoff)
+            key = close[0] if close else None
+        pairs.append((xml_file, keys.get(key)))
+    return pairs
+
+
+def identify_xml_line(index, root, tolerance_ft=150., structures=None):
+    """LINE_NAME the XML's structures lie along, None if no line is found
+
+    Args:
+        index (LineIndex): planning line index
+        root: parsed XML root
+        tolerance_ft (float): max structure to line distance
+        structures (StructureTable): hubs of root when already built
+
+    Returns:
+        line name or None
+    """
+    if structures is None:
+        try:
+            structures = hub_structures(root)
+        except KeyError:
+            return None
+    found = index.identify(structures.data['latitude'],
+                           structures.data['longitude'], tolerance_ft)
+    if found.empty:
+        return None
+    if len(found) > 1:
+        others = ', '.join(f'{n} ({f:.0%})' for n, f in
+                           zip(found['line_name'][1:], found['fraction'][1:]))
+        add_message(f'    - Also near: {others}')
+    return found['line_name'][0]
+
+
+def reconciliation_rows(line_name, xml_file, layer, arc_pro_list):
+    """Flatten matched ConductorRecords into results table rows"""
+    for record in arc_pro_list:
+        yield [line_name, xml_file, record.sap_func_loc_no, layer,
+               record.from_structure, record.to_structure, record.wire,
+               record.best_match, record.best_match_percent]
+
+
+def write_reconciliation(rows, output):
+    """Write the consolidated reconciliation results to csv
+
+    Args:
+        rows (iterable): rows ordered as RECONCILIATION_FIELDS
+        output (str): csv path
+    """
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(RECONCILIATION_FIELDS)
+        writer.writerows(rows)
+    return output
+
+
+def match_conductor_records(arc_pro_list, features, fields):
+    """Match OH conductor records one-to-one against a layer's names
+
+    Scores every record's from_structure against every feature name in one
+    batch, then assigns each feature to at most one record while keeping
+    both in order along the line. Sets best_match/best_match_percent on the
+    matched records.
+
+    Args:
+        arc_pro_list (list): ConductorRecords in line order
+        features: feature class to match against
+        fields (list): [name field, key field]
+
+    Returns:
+        dict of matched key value -> ConductorRecord
+    """
+    with arcpy.da.SearchCursor(features, fields) as cursor:
+        rows = [row for row in cursor]
+    if not rows or not arc_pro_list:
+        return {}
+    names, keys = zip(*rows)
+
+    scores = similarity_matrix([r.from_structure for r in arc_pro_list],
+                               names)
+    matched = {}
+    for i, col in enumerate(ordered_assignment(scores).tolist()):
+        if col < 0:
+            continue
+        record = arc_pro_list[i]
+        record.best_match = keys[col]
+        record.best_match_percent = float(scores[i, col])
+        matched[keys[col]] = record
+    return matched
+
+
 def create_structures_feature_from_OH_conductor(structures, gdb, arc_pro_list):  
     '''takes in the current structures feature class, copies it, then looks at where the structure numbers match with the OH conductor infor and applies the OH conductor info to the coppied feature.
     It then deletes any structure that does not match with an item in OH conductor table.''' 
@@ -246,31 +423,31 @@ def create_structures_feature_from_OH_conductor(structures, gdb, arc_pro_list):
 
     arc_structures_list_of_features = ['STRUCTURE', 'ARC_FROM_STRUCTURE','ARC_TO_STRUCTURE','BEST_MATCH', 'WIRE','QSI_TOWER']
     
-    for section_arc in structures_arc_pro_list:
-        with arcpy.da.SearchCursor(arc_structures, ['STRUCTURE','QSI_TOWER']) as cursor:
-            for row in cursor:
-                
-                if float(similarity_ratio(row[0], section_arc['FROM_SAP_STRUCTURE_NO'])) > section_arc['BEST_MATCH_PERCENT']:
-                    section_arc['BEST_MATCH_PERCENT'] = similarity_ratio(row[0], section_arc['FROM_SAP_STRUCTURE_NO'])
-                    section_arc['BEST_MATCH_QSI_TOWER'] = row[1]
-    for section_arc in structures_arc_pro_list:
-        sql_query = f"QSI_TOWER = {section_arc['BEST_MATCH_QSI_TOWER']}"
-        with arcpy.da.UpdateCursor(arc_structures, arc_structures_list_of_features, sql_query) as cursor:
-            for row in cursor:
-                row[1] = section_arc['FROM_SAP_STRUCTURE_NO']
-                row[2] = section_arc['TO_SAP_STRUCTURE_NO']
-                row[3] = similarity_ratio(row[0], section_arc['FROM_SAP_STRUCTURE_NO'])
-                row[4] = f"{section_arc['CONDUCTOR_TYPE']} {section_arc['CONDUCTOR_SIZE']}{section_arc['CONDUCTOR_STRAND']}"
-                cursor.updateRow(row)
+    matched = match_conductor_records(
+        structures_arc_pro_list, arc_structures, ['STRUCTURE', 'QSI_TOWER'])
+    with arcpy.da.UpdateCursor(arc_structures, arc_structures_list_of_features) as cursor:
+        for row in cursor:
+            section_arc = matched.get(row[5])
+            if section_arc is None:
+                continue
+            row[1] = section_arc.from_structure
+            row[2] = section_arc.to_structure
+            row[3] = section_arc.best_match_percent
+            row[4] = section_arc.wire
+            cursor.updateRow(row)
 
     with arcpy.da.UpdateCursor(arc_structures, ['ARC_FROM_STRUCTURE']) as cursor:
         for row in cursor:
             if row[0] == None:
                 cursor.deleteRow()
 
-def create_sections_feature_from_OH_conductor(sections, gdb, arc_pro_list, sr):  
+    add_indexes(arc_structures, TOWER_REPORT_INDEXES, SPATIAL_INDEX)
+    return structures_arc_pro_list
+
+def create_sections_feature_from_OH_conductor(sections, gdb, arc_pro_list, sr, line=None):  
     '''takes in the current structures feature class, copies it, then looks at where the structure numbers match with the OH conductor infor and applies the OH conductor info to the coppied feature.
-    It then deletes any structure that does not match with an item in OH conductor table.''' 
+    It then deletes any structure that does not match with an item in OH conductor table.
+    With line (StructureTable, LineTopology) each section is redrawn through its strung structures.''' 
     sections_arc_pro_list = arc_pro_list
     arc_sections = os.path.join(gdb, 'arc_sections')
     arcpy.CopyFeatures_management(sections, arc_sections)
@@ -291,29 +468,38 @@ def create_sections_feature_from_OH_conductor(sections, gdb, arc_pro_list, sr):
 
     arc_sections_list_of_features = ['FROM_STR', 'ARC_FROM_STRUCTURE','ARC_TO_STRUCTURE','BEST_MATCH', 'WIRE','SECTION']
     
-    for section_arc in sections_arc_pro_list:
-        with arcpy.da.SearchCursor(sections, ['FROM_STR','SECTION']) as cursor:
-            for row in cursor:
-  
-                if float(similarity_ratio(row[0], section_arc['FROM_SAP_STRUCTURE_NO'])) > section_arc['BEST_MATCH_PERCENT']:
-                    section_arc['BEST_MATCH_PERCENT'] = similarity_ratio(row[0], section_arc['FROM_SAP_STRUCTURE_NO'])
-                    section_arc['BEST_MATCH_QSI_TOWER'] = row[1]
-   
-    for section_arc in sections_arc_pro_list:
-        sql_query = f"SECTION = {section_arc['BEST_MATCH_QSI_TOWER']}"
-        with arcpy.da.UpdateCursor(arc_sections, arc_sections_list_of_features, sql_query) as cursor:
-            for row in cursor:
-                row[1] = section_arc['FROM_SAP_STRUCTURE_NO']
-                row[2] = section_arc['TO_SAP_STRUCTURE_NO']
-                row[3] = similarity_ratio(row[0], section_arc['FROM_SAP_STRUCTURE_NO'])
-                row[4] = f"{section_arc['CONDUCTOR_TYPE']} {section_arc['CONDUCTOR_SIZE']}{section_arc['CONDUCTOR_STRAND']}"
-                cursor.updateRow(row)
+    matched = match_conductor_records(
+        sections_arc_pro_list, sections, ['FROM_STR', 'SECTION'])
+    with arcpy.da.UpdateCursor(arc_sections, arc_sections_list_of_features) as cursor:
+        for row in cursor:
+            section_arc = matched.get(row[5])
+            if section_arc is None:
+                continue
+            row[1] = section_arc.from_structure
+            row[2] = section_arc.to_structure
+            row[3] = section_arc.best_match_percent
+            row[4] = section_arc.wire
+            cursor.updateRow(row)
 ####
     with arcpy.da.UpdateCursor(arc_sections, ['ARC_FROM_STRUCTURE']) as cursor:
         for row in cursor:
             if row[0] == None:
                 cursor.deleteRow()
     
+    if line is not None:
+        structures, topology = line
+        with arcpy.da.UpdateCursor(arc_sections, ["SECTION", "SHAPE@"]) as cursor:
+            for row in cursor:
+                if row[0] not in topology.section_row:
+                    continue
+                xy = structures.data[['x', 'y']][
+                    topology.section_structures(row[0])].tolist()
+                row[1] = arcpy.Polyline(
+                    arcpy.Array([arcpy.Point(*p) for p in xy]), sr)
+                cursor.updateRow(row)
+        add_indexes(arc_sections, SECTION_INDEXES, SPATIAL_INDEX)
+        return sections_arc_pro_list
+
     #makes a list of the first point coordinates for each poly line
     vertices_to_keep = []
     with arcpy.da.SearchCursor(arc_sections, ["SHAPE@"]) as cursor:
@@ -340,62 +526,246 @@ def create_sections_feature_from_OH_conductor(sections, gdb, arc_pro_list, sr):
                 
                 row_count += 1
 
+    add_indexes(arc_sections, SECTION_INDEXES, SPATIAL_INDEX)
+    return sections_arc_pro_list
 
 
-def main():
-    # Inputs
-    xml_file = arcpy.GetParameterAsText(0)
-    xml_sr = arcpy.GetParameter(1)
-    dst_dir = arcpy.GetParameterAsText(2)
-    
+def process_xml(xml_file, xml_sr, dst_dir, arc_pro_list, catalog=None,
+                line_name=None, progress=None, root=None, line=None,
+                parallel=False, write_report=True):
+    """Build the QC layers for one XML and reconcile it with its conductors
 
+    Args:
+        xml_file (str): PLS-CADD XML export, may be compressed or a zip
+            member (see utils.plscadd_xml.open_xml)
+        xml_sr: spatial reference of the XML coordinates
+        dst_dir (str): folder for the output geodatabase
+        arc_pro_list (list): ConductorRecords for the line
+        catalog (str): optional structure catalog to ingest into
+        line_name (str): catalog line name (defaults to the XML name)
+        progress (Progress): bytes/rows progress and cancellation, partial
+            outputs are removed when cancelled
+        root: already parsed root of xml_file, skips parsing
+        line: xml_line(root) when already built
+        parallel (bool or int): parse the tables across processes, see
+            utils.plscadd_xml.xml_root
+        write_report (bool): also write Tower_Report.csv, on a background
+            thread while Structures is loaded
+
+    Returns:
+        (structure matches, section matches) as ConductorRecord lists
+    """
     # Output geodatabase
-    dst_name = safe_name(
-        os.path.basename(xml_file).replace('.xml', '')) + '_Shapes'
+    dst_name = safe_name(xml_stem(xml_file, archive=True)) + '_Shapes'
     dst_gdb = os.path.join(dst_dir, dst_name + '.gdb')
     dst_spans = os.path.join(dst_gdb, 'Spans')
     dst_structures = os.path.join(dst_gdb, 'Structures')
     dst_sections = os.path.join(dst_gdb, 'Sections')
     dst_report = os.path.join(dst_gdb, 'Tower_Report.csv')
 
-
-
-    add_message('\n 1. Creating outputs\n')
-    if not arcpy.Exists(dst_gdb):
+    # Parse and validate once, before any output is created
+    if root is None:
+        if progress:
+            progress.stage('parsing')
+        root = xml_root(xml_file, progress, parallel)
+    add_message('\n 1. Validating xml\n')
+    check_xml(root)
+
+    add_message('\n 2. Creating outputs\n')
+    created = not arcpy.Exists(dst_gdb)
+    if created:
         add_message('    - Processing geodatabase')
         arcpy.CreateFileGDB_management(os.path.dirname(dst_gdb),
                                        os.path.basename(dst_gdb))
 
-    # Create spans and structure using xml
-    add_message('    - Spans')
-    add_message(f"{xml_sr}")
-    xml_to_spans(xml_file, dst_spans, dst_structures, sr=xml_sr)
-    arcpy.DefineProjection_management(dst_spans, xml_sr)
-
-    add_message('    - Structures')
-    xml_to_tower_report(xml_file=xml_file, output=dst_report)
-    tower_report_to_shape(dst_report, dst_structures)
-    arcpy.DefineProjection_management(dst_structures, xml_sr)
-
-    add_message('    - Sections')
-    prep_for_qc(dst_spans, dst_sections)
-
-    # make copy of structures where there are only dead ends
-    structures_de = os.path.join(dst_gdb, 'Structures_DE')
-    arcpy.CopyFeatures_management(dst_structures, structures_de)
+    try:
+        # Shared by every builder below
+        line = line or xml_line(root)
+
+        # Create spans and structure using xml
+        add_message('    - Spans')
+        add_message(f"{xml_sr}")
+        xml_to_spans(root, dst_spans, dst_structures, sr=xml_sr,
+                     progress=progress, line=line)
+        arcpy.DefineProjection_management(dst_spans, xml_sr)
+
+        add_message('    - Structures')
+        report_df = xml_to_tower_report_df(xml_file=root, line=line)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            csv_job = pool.submit(write_tower_report, report_df,
+                                  dst_report) if write_report else None
+            tower_report_to_shape(report_df, dst_structures,
+                                  progress=progress)
+            if csv_job:
+                csv_job.result()
+        arcpy.DefineProjection_management(dst_structures, xml_sr)
+
+        if catalog:
+            add_message('    - Catalog')
+            catalog_line(catalog, line_name or safe_name(
+                xml_stem(xml_file, archive=True)), report_df,
+                dst_spans, xml_file, root_tables(root))
+
+        add_message('    - Sections')
+        if progress:
+            progress.stage('sections')
+        prep_for_qc(dst_spans, dst_sections, line)
+
+        # make copy of structures where there are only dead ends
+        structures_de = os.path.join(dst_gdb, 'Structures_DE')
+        arcpy.CopyFeatures_management(dst_structures, structures_de)
+
+        with arcpy.da.UpdateCursor(structures_de, ["STR_TYPE"]) as cursor:
+            for row in cursor:
+                if row[0] != "Dead End":
+                    cursor.deleteRow()
+        add_indexes(structures_de, TOWER_REPORT_INDEXES, SPATIAL_INDEX)
+
+        #apply_unique_symbology_to_sections_layer(dst_gdb)
+
+        # each layer gets its own copy since matching writes best_match in place
+        if progress:
+            progress.stage('conductor matching')
+        structure_matches = create_structures_feature_from_OH_conductor(
+            dst_structures, dst_gdb, [copy.copy(r) for r in arc_pro_list])
+        section_matches = create_sections_feature_from_OH_conductor(
+            dst_sections, dst_gdb, [copy.copy(r) for r in arc_pro_list],
+            sr=xml_sr, line=line)
+        return structure_matches, section_matches
+    except Cancelled:
+        add_warning(f'\n    - WARNING: Cancelled, removing partial outputs '
+                    f'of {os.path.basename(xml_file)}')
+        cleanup_outputs([dst_gdb] if created else
+                        [dst_spans, dst_structures, dst_sections] +
+                        ([dst_report] if write_report else []))
+        raise
+
+
+def bulk_reconcile(xml_files, xml_sr, dst_dir, input_feature_layer,
+                   standalone_table, catalog=None, progress=None,
+                   line_index=None, parallel=False, write_report=True):
+    """Reconcile every line's XML export against the conductor table in one run
+
+    Each XML is matched to its planning line from where its structures are
+    (see utils.line_index), falling back to the file name. The line layer is
+    indexed once and cached, the conductor table is read once; results for
+    all lines go to a single Conductor_Reconciliation.csv in dst_dir. If the
+    run is cancelled, results of the lines already completed are kept.
 
-    with arcpy.da.UpdateCursor(structures_de, ["STR_TYPE"]) as cursor:
-        for row in cursor:
-            if row[0] != "Dead End":
-                cursor.deleteRow()
+    Args:
+        line_index (str): line index cache (default next to the line layer)
+        parallel (bool or int): parse the tables across processes
+        write_report (bool): also write each line's Tower_Report.csv
 
-    #apply_unique_symbology_to_sections_layer(dst_gdb)
-    
-    create_structures_feature_from_OH_conductor(dst_structures, dst_gdb, get_arc_pro_list())
-    create_sections_feature_from_OH_conductor(dst_sections, dst_gdb, get_arc_pro_list(), sr=xml_sr )
+    Returns:
+        path of the consolidated results table
+    """
+    add_message('\n Reading line index and OH conductor table\n')
+    with LineIndex.for_layer(input_feature_layer, line_index) as index:
+        lines = index.lines()
+        by_name = dict(match_xml_lines(xml_files, lines))
+        conductors = read_conductor_records(standalone_table, lines.values())
+
+        rows = []
+        output = os.path.join(dst_dir, 'Conductor_Reconciliation.csv')
+
+        # The next XML is parsed and its line built while this one is
+        # written, arcpy and the line index stay on this thread
+        stop = threading.Event()
+
+        def prepare(job):
+            i, xml_file = job
+            add_message(f'\n[{i}/{len(xml_files)}] '
+                        f'{os.path.basename(xml_file)}')
+            root = xml_root(xml_file, BackgroundProgress(stop), parallel)
+            try:
+                line = xml_line(root)
+            except Exception:
+                line = None  # rebuilt after check_xml reports why
+            return root, line
+
+        try:
+            for (i, xml_file), prepared, error in prefetch(
+                    prepare, enumerate(xml_files, 1), stop=stop,
+                    check=progress.check if progress else None):
+                try:
+                    if error is not None:
+                        raise error
+                    if progress:
+                        progress.add_bytes(xml_size(xml_file))
+                    root, line = prepared
+                    line_name = identify_xml_line(
+                        index, root, structures=line[0] if line else None)
+                    if line_name not in lines:
+                        line_name = by_name[xml_file]
+                    if line_name is None:
+                        add_warning(f'\n    - WARNING: no planning line '
+                                    f'found for '
+                                    f'{os.path.basename(xml_file)}, skipped')
+                        continue
+                    sap_no = lines[line_name]
+                    add_message(f'    - {line_name} ({sap_no})')
+                    arc_pro_list = conductors.get(sap_no, [])
+                    if not arc_pro_list:
+                        add_warning(f'\n    - WARNING: no OH conductor '
+                                    f'records for {line_name} ({sap_no})')
+                    structure_matches, section_matches = process_xml(
+                        xml_file, xml_sr, dst_dir, arc_pro_list, catalog,
+                        line_name, progress, root, line,
+                        write_report=write_report)
+                except XmlValidationError as e:
+                    add_warning(f'\n    - WARNING: {e}, skipped')
+                    continue
+                except Cancelled:
+                    raise
+                except Exception as e:
+                    # One bad XML does not stop the other lines
+                    add_error(f'\n    - ERROR: Could not process '
+                              f'{os.path.basename(xml_file)}, {e}')
+                    continue
+                rows.extend(reconciliation_rows(
+                    line_name, xml_file, 'STRUCTURES', structure_matches))
+                rows.extend(reconciliation_rows(
+                    line_name, xml_file, 'SECTIONS', section_matches))
+        finally:
+            write_reconciliation(rows, output)
+
+    add_message(f'\n Reconciliation results: {output}')
+    return output
 
 
-    
+def main():
+    # Inputs
+    xml_input = arcpy.GetParameterAsText(0)
+    xml_sr = arcpy.GetParameter(1)
+    dst_dir = arcpy.GetParameterAsText(2)
+    line_name = arcpy.GetParameterAsText(4)
+    catalog = arcpy.GetParameterAsText(6) \
+        if arcpy.GetArgumentCount() > 6 else None
+    line_index = arcpy.GetParameterAsText(7) \
+        if arcpy.GetArgumentCount() > 7 else None
+    write_report = arcpy.GetArgumentCount() <= 8 or \
+        bool(arcpy.GetParameter(8))
+
+    # A folder, zip, several XMLs or no line name runs every line in one job
+    xml_files = expand_xml_inputs(xml_input)
+    progress = Progress.for_files(xml_files, 'xml to layer', size=xml_size)
+    try:
+        if len(xml_files) != 1 or os.path.isdir(xml_input) or \
+                xml_input.lower().endswith('.zip') or not line_name:
+            bulk_reconcile(xml_files, xml_sr, dst_dir, arcpy.GetParameter(3),
+                           arcpy.GetParameter(5), catalog, progress,
+                           line_index or None, write_report=write_report)
+        else:
+            process_xml(xml_files[0], xml_sr, dst_dir, get_arc_pro_list(),
+                        catalog, progress=progress, write_report=write_report)
+    except Cancelled as e:
+        add_warning(f'\n    - WARNING: Cancelled during {e}')
+        return
+    except XmlValidationError as e:
+        add_error(f'\n    - ERROR: {e}, nothing written')
+        return
+    progress.report(force=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,58 @@
+r"""
+Run the XML conversion worker, or submit a job to one
+
+    python xml_worker.py serve --queue D:\xml_queue --port 6071
+    python xml_worker.py submit --queue D:\xml_queue job.json
+    python xml_worker.py submit --port 6071 job.json
+
+The socket is authenticated with a random key created on first use in
+~/.xml_worker_key (or --key-file), readable by the current user only.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+if __name__ == "__main__" and __package__ is None:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from utils.worker import (DEFAULT_ADDRESS, job_result, serve, submit,
+                          submit_job, worker_authkey)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('command', choices=('serve', 'submit'))
+    parser.add_argument('job', nargs='?', help='job json file (submit)')
+    parser.add_argument('--queue', help='queue folder')
+    parser.add_argument('--port', type=int, help='local socket port')
+    parser.add_argument('--key-file', help='socket key file, default '
+                        '~/.xml_worker_key')
+    parser.add_argument('--timeout', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    address = (DEFAULT_ADDRESS[0], args.port) if args.port else None
+    authkey = worker_authkey(args.key_file) if address else None
+    if args.command == 'serve':
+        if not (args.queue or address):
+            parser.error('serve needs --queue and/or --port')
+        serve(args.queue, address, authkey)
+        return 0
+
+    with open(args.job) as f:
+        job = json.load(f)
+    if address:
+        result = submit(job, address, authkey)
+    elif args.queue:
+        result = job_result(args.queue, submit_job(args.queue, job),
+                            args.timeout)
+    else:
+        parser.error('submit needs --queue or --port')
+    print(json.dumps(result, indent=2, default=str))
+    return 0 if result and result.get('status') == 'done' else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+r"""
+Headless PLS-CADD XML tools, rows are streamed to stdout as NDJSON or csv
+
+    python xmltool.py report a.xml b.xml.gz --comments 2 3
+    python xmltool.py spans D:\deliveries\2024_06 --format csv > spans.csv
+    python xmltool.py sections delivery.zip
+    python xmltool.py circuits a.xml                (one row per circuit span)
+    python xmltool.py geotags a.xml -n 3
+    python xmltool.py diff old.xml new.xml          (xml or tower report csv)
+
+Every row carries the XML it came from. Messages and warnings go to
+stderr, so the output can be piped (xmltool.py report a.xml | jq ...).
+Runs without arcpy.
+"""
+
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+
+if __name__ == "__main__" and __package__ is None:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from utils.geotagging import geotag_issues
+from utils.plscadd_xml import (circuit_span_rows, expand_xml_inputs,
+                               hub_structures, line_topology, root_tables,
+                               section_rows, span_rows, span_wires,
+                               xml_attachments, xml_root, xml_sections,
+                               xml_stem, xml_to_tower_report_df,
+                               SPAN_FIELDS)
+from utils.report_diff import UNCHANGED, diff_reports
+from utils.xml_validation import XmlValidationError, check_xml
+
+
+def _value(v):
+    """JSON/csv safe scalar (numpy types, NaN as null)"""
+    if hasattr(v, 'item'):
+        v = v.item()
+    if isinstance(v, float) and math.isnan(v):
+        return None
+    return v
+
+
+class RowWriter(object):
+    """Write dict rows as they arrive, flushed so pipes see them at once"""
+
+    def __init__(self, stream, fmt='ndjson'):
+        self.stream = stream
+        self.fmt = fmt
+        self._csv = None
+        self.rows = 0
+
+    def write(self, row):
+        row = {k: _value(v) for k, v in row.items()}
+        if self.fmt == 'csv':
+            if self._csv is None:
+                self._csv = csv.DictWriter(self.stream, list(row),
+                                           extrasaction='ignore',
+                                           lineterminator='\n')
+                self._csv.writeheader()
+            self._csv.writerow(row)
+        else:
+            self.stream.write(json.dumps(row, default=str) + '\n')
+        self.stream.flush()
+        self.rows += 1
+
+
+def _frame_rows(df):
+    columns = list(df.columns)
+    for values in df.itertuples(index=False, name=None):
+        yield dict(zip(columns, values))
+
+
+# Commands, each yields rows for one xml
+def report_rows(xml_file, args):
+    root = xml_root(xml_file, parallel=args.parallel)
+    check_xml(root, spans=False)
+    return _frame_rows(xml_to_tower_report_df(root, comments=args.comments))
+
+
+def _line(xml_file, args):
+    root = xml_root(xml_file, parallel=args.parallel)
+    check_xml(root)
+    xml_tables = root_tables(root)
+    structures = hub_structures(root, xml_tables)
+    return (structures, xml_sections(xml_tables),
+            line_topology(xml_tables, structures))
+
+
+def spans_rows(xml_file, args):
+    fields = SPAN_FIELDS[:-1]
+    for row, bst, ast in span_rows(*_line(xml_file, args)):
+        row = dict(zip(fields, row))
+        row.update(BST_X=bst['x'], BST_Y=bst['y'],
+                   AST_X=ast['x'], AST_Y=ast['y'])
+        yield row
+
+
+def sections_rows(xml_file, args):
+    return section_rows(*_line(xml_file, args))
+
+
+def circuits_rows(xml_file, args):
+    root = xml_root(xml_file, parallel=args.parallel)
+    check_xml(root)
+    xml_tables = root_tables(root)
+    structures = hub_structures(root, xml_tables)
+    attachments = xml_attachments(xml_tables, structures)
+    wires = span_wires(xml_tables, structures,
+                       line_topology(xml_tables, structures, attachments),
+                       attachments)
+    for row, bst, ast in circuit_span_rows(
+            structures, xml_sections(xml_tables), wires, attachments):
+        row.update(BST_X=bst[0], BST_Y=bst[1], AST_X=ast[0], AST_Y=ast[1])
+        yield row
+
+
+def geotags_rows(xml_file, args):
+    root = xml_root(xml_file, parallel=args.parallel)
+    check_xml(root, spans=False)
+    report = xml_to_tower_report_df(root)
+    return geotag_issues(report['STR_GEOTAG'].tolist(),
+                         report['STRUCTURE'].tolist(), args.n)
+
+
+def _report(path, parallel=False):
+    """Tower report DataFrame of an xml or tower report csv"""
+    if path.lower().endswith('.csv'):
+        return path
+    return xml_to_tower_report_df(xml_root(path, parallel=parallel)
+                                  ).astype(str)
+
+
+def diff_rows(args):
+    diff = diff_reports(_report(args.inputs[0], args.parallel),
+                        _report(args.inputs[1], args.parallel), n=args.n)
+    if not args.all:
+        diff = diff[diff['STATUS'] != UNCHANGED]
+    return _frame_rows(diff)
+
+
+COMMANDS = {'report': report_rows, 'spans': spans_rows,
+            'sections': sections_rows, 'circuits': circuits_rows,
+            'geotags': geotags_rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('command', choices=sorted(COMMANDS) + ['diff'])
+    parser.add_argument('inputs', nargs='+',
+                        help='xml files, folders or zips (diff: old new)')
+    parser.add_argument('--format', choices=('ndjson', 'csv'),
+                        default='ndjson')
+    parser.add_argument('--comments', type=int, nargs='*',
+                        help='structure comment numbers (report)')
+    parser.add_argument('-n', type=int, default=None,
+                        help='geotag tolerance (geotags: 3, diff: 1)')
+    parser.add_argument('--all', action='store_true',
+                        help='include unchanged structures (diff)')
+    parser.add_argument('--parallel', type=int, nargs='?', const=True,
+                        default=False, metavar='N',
+                        help='parse tables across N processes (default '
+                             'all cores)')
+    args = parser.parse_args(argv)
+
+    # Data owns stdout, messages printed by the tools go to stderr
+    out = RowWriter(sys.stdout, args.format)
+    sys.stdout = sys.stderr
+    failed = 0
+    try:
+        if args.command == 'diff':
+            if len(args.inputs) != 2:
+                parser.error('diff needs old and new')
+            args.n = 1 if args.n is None else args.n
+            for row in diff_rows(args):
+                out.write(row)
+            return 0
+
+        args.n = 3 if args.n is None else args.n
+        xml_files = []
+        for xml_input in args.inputs:
+            xml_files.extend(expand_xml_inputs(xml_input))
+        for xml_file in xml_files:
+            try:
+                for row in COMMANDS[args.command](xml_file, args):
+                    out.write(dict([('XML', xml_stem(xml_file,
+                                                     archive=True))] +
+                                   list(row.items())))
+            except BrokenPipeError:
+                raise  # an OSError, but the reader went away, stop
+            except (XmlValidationError, KeyError, ValueError, OSError) as e:
+                failed += 1
+                print('{}: {}'.format(xml_file, e), file=sys.stderr)
+    except BrokenPipeError:
+        sys.stderr.close()  # reader went away (| head), not an error
+        return 0
+    finally:
+        sys.stdout = out.stream
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())